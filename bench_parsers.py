@@ -0,0 +1,102 @@
+import os
+import re
+import sys
+import random
+import timeit
+import argparse
+import tempfile
+
+# =========================
+# Caption parser benchmark
+#
+#   python bench_parsers.py [--lines 20000] [--repeat 5]
+#
+# - times parse_rarity / parse_event_optional (alias index, scan fallback) against the old per-call scan
+# - checks both give the same answer for every line before timing anything
+# - waifu is imported against a throwaway SQLite file; the bot itself is not started
+# =========================
+os.environ.setdefault("TOKEN", "0:bench")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+import waifu  # noqa: E402
+
+# the parsers before the alias index: every call re-normalizes each title while scanning the tables
+def scan_rarity(line: str):
+    raw = (line or "").strip()
+    t = waifu.normalize(raw).replace(":", " ")
+    t = re.sub(r"\s+", " ", t).strip()
+
+    if t in waifu.RARITIES:
+        return t
+    for key, meta in waifu.RARITIES.items():
+        if key in t:
+            return key
+        if waifu.normalize(meta["title"]) in t:
+            return key
+        if meta["emoji"] and meta["emoji"] in raw:
+            return key
+    return None
+
+def scan_event(line: str):
+    raw = (line or "").strip()
+    if not raw:
+        return waifu.NO_EVENT_KEY
+
+    t = waifu.normalize(raw)
+    t = t.replace("event", "").replace(":", " ")
+    t = re.sub(r"\s+", " ", t).strip()
+
+    if t in waifu.NO_EVENT_ALIASES:
+        return waifu.NO_EVENT_KEY
+    if t in waifu.EVENTS:
+        return t
+    for key, title in waifu.EVENTS.items():
+        if waifu.normalize(title) in waifu.normalize(raw):
+            return key
+        if key in t:
+            return key
+    return waifu.NO_EVENT_KEY
+
+def typical_lines(rng, count: int):
+    # what uploaders actually type: keys, titles, emojis, with stray case/colons/spaces
+    words = [w for key, meta in waifu.RARITIES.items() for w in (key, meta["title"], meta["emoji"],
+                                                               f"{meta['emoji']} {meta['title']}")]
+    words += [w for key, title in waifu.EVENTS.items() for w in (key, title, key.replace("_", " "))]
+    words += list(waifu.NO_EVENT_ALIASES)
+    out = []
+    for _ in range(count):
+        w = rng.choice(words)
+        out.append(rng.choice(["{}", "{}:", " {} ", "Rarity: {}", "Event: {}"]).format(
+            w.upper() if rng.random() < 0.3 else w))
+    return out
+
+def fuzz_lines(rng, count: int):
+    alphabet = "abcdefghijklmnopqrstuvwxyz :_" + "".join(m["emoji"] for m in waifu.RARITIES.values())
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 40))) for _ in range(count)]
+
+def per_line_us(fn, lines, repeat: int) -> float:
+    run = lambda: [fn(line) for line in lines]
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(lines) * 1e6
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the caption rarity/event parsers")
+    ap.add_argument("--lines", type=int, default=20000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    for label, lines in (("typical", typical_lines(rng, args.lines)), ("fuzz", fuzz_lines(rng, args.lines))):
+        for name, fast, slow in (("rarity", waifu.parse_rarity, scan_rarity),
+                                 ("event", waifu.parse_event_optional, scan_event)):
+            bad = next((line for line in lines if fast(line) != slow(line)), None)
+            if bad is not None:
+                print(f"{label}/{name}: index and scan disagree on {bad!r}", file=sys.stderr)
+                return 1
+            indexed = per_line_us(fast, lines, args.repeat)
+            scanned = per_line_us(slow, lines, args.repeat)
+            print(f"{label:8} {name:7} index {indexed:7.2f}us  scan {scanned:7.2f}us  x{scanned / indexed:.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
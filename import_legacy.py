@@ -0,0 +1,299 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+import psycopg
+
+import storage
+
+# =========================
+# Legacy SQLite -> Postgres importer
+#
+#   python import_legacy.py newfile.py --database-url postgresql://...
+#
+# - streams each legacy table in keyset-ordered chunks (no full table in RAM)
+# - bulk-loads every chunk with COPY into a temp stage table, then merges it
+# - merge + progress update commit together, so a crash resumes at the last chunk
+# - merges never overwrite live rows (ON CONFLICT DO NOTHING / folded-row ledger), so reruns are no-ops
+# - active_spawns is not imported (spawn messages of the old build are long gone)
+# =========================
+MIN_KEY = -(2 ** 63)
+DEFAULT_CHUNK = 5000
+
+def legacy_columns(src, table: str):
+    return {row[1] for row in src.execute(f"PRAGMA table_info({table})")}
+
+def col_or_null(cols, name: str) -> str:
+    return name if name in cols else f"NULL AS {name}"
+
+# each spec: legacy keyset query (key first), stage DDL, merge SQL
+def table_specs(src):
+    char_cols = legacy_columns(src, "characters")
+    return [
+        {
+            "table": "characters",
+            "select": f"""
+                SELECT id, id, name, anime, rarity_key, event_key, image_file_id,
+                       {col_or_null(char_cols, "channel_msg_id")}, uploaded_by, uploaded_at
+                FROM characters WHERE id > ? ORDER BY id LIMIT ?
+            """,
+            "stage": """
+                id BIGINT, name TEXT, anime TEXT, rarity_key TEXT, event_key TEXT, image_file_id TEXT,
+                channel_msg_id BIGINT, uploaded_by BIGINT, uploaded_at BIGINT
+            """,
+            "offset_cols": ("id",),
+            "merge": """
+                INSERT INTO characters (id, name, anime, rarity_key, event_key, image_file_id,
+                                        channel_msg_id, uploaded_by, uploaded_at)
+                SELECT id, name, anime, rarity_key, event_key, image_file_id,
+                       channel_msg_id, uploaded_by, uploaded_at
+                FROM stage_characters
+                ON CONFLICT (id) DO NOTHING
+            """,
+        },
+        {
+            "table": "uploaders",
+            "select": "SELECT tg_id, tg_id, added_by, added_at FROM uploaders WHERE tg_id > ? ORDER BY tg_id LIMIT ?",
+            "stage": "tg_id BIGINT, added_by BIGINT, added_at BIGINT",
+            "offset_cols": (),
+            "merge": """
+                INSERT INTO uploaders (tg_id, added_by, added_at)
+                SELECT tg_id, added_by, added_at FROM stage_uploaders
+                ON CONFLICT (tg_id) DO NOTHING
+            """,
+        },
+        {
+            "table": "chat_settings",
+            "select": """
+                SELECT chat_id, chat_id, spawn_enabled, spawn_every, msg_counter
+                FROM chat_settings WHERE chat_id > ? ORDER BY chat_id LIMIT ?
+            """,
+            "stage": "chat_id BIGINT, spawn_enabled INTEGER, spawn_every INTEGER, msg_counter BIGINT",
+            "offset_cols": (),
+            "merge": """
+                INSERT INTO chat_settings (chat_id, spawn_enabled, spawn_every, msg_counter)
+                SELECT chat_id, spawn_enabled <> 0, spawn_every, msg_counter FROM stage_chat_settings
+                ON CONFLICT (chat_id) DO NOTHING
+            """,
+        },
+        {
+            # legacy rows are one per hunt; live inventory is one row per (user, chat, card) with copies.
+            # legacy_inventory_rows remembers every folded legacy row, so a row is counted once ever.
+            # imported rows get the current reset epochs (a row left stale by a reset is restarted),
+            # and the touched players' leaderboard counters are recounted in the same transaction.
+            "table": "inventory",
+            "select": """
+                SELECT rowid, user_id, chat_id, char_id, obtained_at
+                FROM inventory WHERE rowid > ? ORDER BY rowid LIMIT ?
+            """,
+            "stage": "user_id BIGINT, chat_id BIGINT, char_id BIGINT, obtained_at BIGINT",
+            "offset_cols": ("char_id",),
+            "merge": """
+                WITH fresh AS (
+                    INSERT INTO legacy_inventory_rows (user_id, chat_id, char_id, obtained_at)
+                    SELECT s.user_id, s.chat_id, s.char_id, s.obtained_at
+                    FROM stage_inventory s
+                    JOIN characters c ON c.id = s.char_id
+                    ON CONFLICT DO NOTHING
+                    RETURNING user_id, chat_id, char_id, obtained_at
+                )
+                INSERT INTO inventory (user_id, chat_id, char_id, copies, first_obtained_at, last_obtained_at,
+                                       user_epoch, chat_epoch)
+                SELECT f.user_id, f.chat_id, f.char_id, COUNT(*), MIN(f.obtained_at), MAX(f.obtained_at),
+                       COALESCE(MAX(ue.epoch), 0), COALESCE(MAX(ce.epoch), 0)
+                FROM fresh f
+                LEFT JOIN user_epochs ue ON ue.user_id = f.user_id
+                LEFT JOIN chat_epochs ce ON ce.chat_id = f.chat_id
+                GROUP BY f.user_id, f.chat_id, f.char_id
+                ON CONFLICT (user_id, chat_id, char_id) DO UPDATE SET
+                    copies=CASE WHEN inventory.user_epoch=EXCLUDED.user_epoch AND inventory.chat_epoch=EXCLUDED.chat_epoch
+                                THEN inventory.copies + EXCLUDED.copies ELSE EXCLUDED.copies END,
+                    first_obtained_at=CASE WHEN inventory.user_epoch=EXCLUDED.user_epoch AND inventory.chat_epoch=EXCLUDED.chat_epoch
+                                           THEN LEAST(inventory.first_obtained_at, EXCLUDED.first_obtained_at)
+                                           ELSE EXCLUDED.first_obtained_at END,
+                    last_obtained_at=CASE WHEN inventory.user_epoch=EXCLUDED.user_epoch AND inventory.chat_epoch=EXCLUDED.chat_epoch
+                                          THEN GREATEST(inventory.last_obtained_at, EXCLUDED.last_obtained_at)
+                                          ELSE EXCLUDED.last_obtained_at END,
+                    user_epoch=EXCLUDED.user_epoch,
+                    chat_epoch=EXCLUDED.chat_epoch
+            """,
+            "after": lambda cur: storage.refresh_player_stats(
+                cur, cur.execute("SELECT DISTINCT chat_id, user_id FROM stage_inventory").fetchall()
+            ),
+        },
+        {
+            # legacy favorites are per (chat_id, user_id); live ones are per user -> keep the newest
+            "table": "favorites",
+            "select": """
+                SELECT user_id, user_id, char_id, MAX(set_at)
+                FROM favorites WHERE user_id > ? GROUP BY user_id ORDER BY user_id LIMIT ?
+            """,
+            "stage": "user_id BIGINT, char_id BIGINT, set_at BIGINT",
+            "offset_cols": ("char_id",),
+            "merge": """
+                INSERT INTO favorites (user_id, char_id)
+                SELECT s.user_id, s.char_id
+                FROM stage_favorites s
+                JOIN characters c ON c.id = s.char_id
+                ON CONFLICT (user_id) DO NOTHING
+            """,
+        },
+    ]
+
+# =========================
+# Progress (resume point per source file + table)
+# =========================
+def ensure_progress_table(con):
+    with con.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS legacy_import_progress (
+                source TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                last_key BIGINT NOT NULL,
+                rows_done BIGINT NOT NULL,
+                finished BOOLEAN NOT NULL,
+                updated_at BIGINT NOT NULL,
+                PRIMARY KEY (source, table_name)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS legacy_inventory_rows (
+                user_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                char_id BIGINT NOT NULL,
+                obtained_at BIGINT NOT NULL,
+                PRIMARY KEY (user_id, chat_id, char_id, obtained_at)
+            )
+        """)
+    con.commit()
+
+def load_progress(con, source: str, table: str):
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT last_key, rows_done, finished FROM legacy_import_progress
+            WHERE source=%s AND table_name=%s
+        """, (source, table))
+        row = cur.fetchone()
+    if not row:
+        return MIN_KEY, 0, False
+    return int(row[0]), int(row[1]), bool(row[2])
+
+def save_progress(cur, source: str, table: str, last_key: int, rows_done: int, finished: bool):
+    cur.execute("""
+        INSERT INTO legacy_import_progress (source, table_name, last_key, rows_done, finished, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (source, table_name) DO UPDATE SET
+            last_key=EXCLUDED.last_key,
+            rows_done=EXCLUDED.rows_done,
+            finished=EXCLUDED.finished,
+            updated_at=EXCLUDED.updated_at
+    """, (source, table, last_key, rows_done, finished, int(time.time())))
+
+def reset_progress(con, source: str):
+    with con.cursor() as cur:
+        cur.execute("DELETE FROM legacy_import_progress WHERE source=%s", (source,))
+    con.commit()
+
+# =========================
+# Import
+# =========================
+def shift_ids(row, offset_idx, offset: int):
+    if not offset or not offset_idx:
+        return row
+    row = list(row)
+    for i in offset_idx:
+        if row[i] is not None:
+            row[i] += offset
+    return row
+
+def import_table(src, con, spec, source: str, chunk_size: int, id_offset: int):
+    table = spec["table"]
+    last_key, rows_done, finished = load_progress(con, source, table)
+    if finished:
+        print(f"[{table}] already imported ({rows_done} rows) — skip")
+        return
+
+    stage = f"stage_{table}"
+    with con.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {stage} ({spec['stage']}) ON COMMIT DELETE ROWS")
+    con.commit()
+
+    names = [c.split()[0] for c in spec["stage"].replace("\n", " ").split(",")]
+    offset_idx = [names.index(c) for c in spec["offset_cols"]]
+    started = time.time()
+
+    while True:
+        rows = src.execute(spec["select"], (last_key, chunk_size)).fetchall()
+        if not rows:
+            break
+        with con.cursor() as cur:
+            with cur.copy(f"COPY {stage} ({', '.join(names)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(shift_ids(row[1:], offset_idx, id_offset))
+            cur.execute(spec["merge"])
+            if "after" in spec:
+                spec["after"](cur)
+            last_key = int(rows[-1][0])
+            rows_done += len(rows)
+            save_progress(cur, source, table, last_key, rows_done, False)
+        con.commit()
+        rate = rows_done / max(time.time() - started, 1e-6)
+        print(f"[{table}] {rows_done} rows (key>{last_key}) {rate:.0f} rows/s")
+
+    with con.cursor() as cur:
+        save_progress(cur, source, table, last_key, rows_done, True)
+    con.commit()
+    print(f"[{table}] done: {rows_done} rows")
+
+def reset_character_sequence(con):
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT setval(pg_get_serial_sequence('characters', 'id'),
+                          COALESCE((SELECT MAX(id) FROM characters), 0) + 1, false)
+        """)
+        next_id = cur.fetchone()[0]
+    con.commit()
+    print(f"characters id sequence -> next id {next_id}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Import a legacy HunterBot SQLite file into the Postgres DB.")
+    ap.add_argument("sqlite_path", help="legacy SQLite file (e.g. newfile.py)")
+    ap.add_argument("--database-url", default=os.environ.get("DATABASE_URL"), help="target Postgres (default: $DATABASE_URL)")
+    ap.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK)
+    ap.add_argument("--char-id-offset", type=int, default=0,
+                    help="add this to every legacy character id (avoids collisions with live ids)")
+    ap.add_argument("--restart", action="store_true", help="forget saved progress for this source and start over")
+    args = ap.parse_args(argv)
+
+    if not args.database_url or args.database_url.startswith("sqlite:"):
+        ap.error("--database-url must point to Postgres")
+    if args.chunk_size < 1:
+        ap.error("--chunk-size must be >= 1")
+
+    source = os.path.basename(args.sqlite_path)
+    if args.char_id_offset:
+        source += f"+{args.char_id_offset}"
+
+    storage.configure(args.database_url)
+    storage.init_db()
+
+    src = sqlite3.connect(f"file:{args.sqlite_path}?mode=ro", uri=True)
+    try:
+        with psycopg.connect(args.database_url, autocommit=False) as con:
+            ensure_progress_table(con)
+            if args.restart:
+                reset_progress(con, source)
+            for spec in table_specs(src):
+                import_table(src, con, spec, source, args.chunk_size, args.char_id_offset)
+            reset_character_sequence(con)
+    except sqlite3.DatabaseError as e:
+        print(f"legacy file unreadable: {e}", file=sys.stderr)
+        return 1
+    finally:
+        src.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1497 @@
+import os
+import time
+import sqlite3
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
+
+import psycopg
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+# =========================
+# Backends
+# DATABASE_URL=postgresql://...      -> Postgres / Neon
+# DATABASE_URL=sqlite:///hunter.db   -> SQLite file (WAL), single node only
+# DATABASE_READ_URL=postgresql://... -> optional read replica for read-only lookups (see read_db)
+# =========================
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+SQLITE_STATEMENT_CACHE = 256
+
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_MAX_IDLE = 240  # seconds; below Neon's 5 min idle suspend
+DB_PREPARE = os.environ.get("DB_PREPARE", "1") != "0"  # 0 for poolers without prepared statement support
+DB_READ_STALENESS = float(os.environ.get("DB_READ_STALENESS", "5"))  # seconds of replica lag we tolerate
+DB_READ_LAG_CHECK_EVERY = 5  # seconds between replica lag probes
+DB_COLD_START_SECONDS = float(os.environ.get("DB_COLD_START_SECONDS", "1.0"))  # slower connects count as cold starts
+DB_CHECK_IDLE_AFTER = 30  # seconds; pooled connections idle longer are pinged before reuse
+DB_WARMUP_ATTEMPTS = 6
+DB_WARMUP_MAX_DELAY = 8.0
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free pooled connection
+
+# statement_timeout per query class, in ms (0 = none). Pooled connections start out
+# interactive; db("background"/"admin"/...) raises it for one transaction with SET LOCAL.
+STATEMENT_TIMEOUTS = {
+    "interactive": int(os.environ.get("DB_TIMEOUT_INTERACTIVE_MS", "3000")),
+    "background": int(os.environ.get("DB_TIMEOUT_BACKGROUND_MS", "15000")),
+    "admin": int(os.environ.get("DB_TIMEOUT_ADMIN_MS", "120000")),
+    "maintenance": 0,
+}
+
+class PostgresBackend:
+    name = "postgres"
+    ddl = {"serial_pk": "BIGSERIAL PRIMARY KEY", "concurrently": "CONCURRENTLY"}
+
+    def __init__(self, url: str, pool_name: str = "hunter"):
+        self.url = url
+        self.pool_name = pool_name
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def pool(self) -> ConnectionPool:
+        # per process: after a fork the parent's pool (and its sockets) belong to the parent
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ConnectionPool(
+                        self.url, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, max_idle=DB_POOL_MAX_IDLE,
+                        kwargs=self.connect_kwargs(), name=self.pool_name, open=True,
+                        connection_class=TimedConnection, check=check_if_idle, reset=mark_returned,
+                        configure=self.configure_connection, timeout=DB_POOL_TIMEOUT,
+                    )
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def connection(self):
+        # context manager: commits (or rolls back) and returns the connection to the pool
+        return self.pool().connection()
+
+    @staticmethod
+    def connect_kwargs():
+        kwargs = {"autocommit": False}
+        if not DB_PREPARE:
+            # psycopg would otherwise still auto-prepare any query run prepare_threshold times
+            kwargs["prepare_threshold"] = None
+        return kwargs
+
+    @staticmethod
+    def configure_connection(con):
+        con.execute("SELECT set_config('statement_timeout', %s, false)", (str(STATEMENT_TIMEOUTS["interactive"]),))
+        con.commit()
+
+    @contextmanager
+    def connection_with_timeout(self, timeout_ms: int):
+        with self.connection() as con:
+            con.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout_ms),))
+            yield con
+
+    @contextmanager
+    def migration_connection(self):
+        # autocommit so CREATE INDEX CONCURRENTLY works; advisory lock so only one worker migrates
+        with psycopg.connect(self.url, autocommit=True) as con:
+            con.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                yield con
+            finally:
+                con.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+
+    def transaction(self, con):
+        return con.transaction()
+
+    def lock_chat(self, cur, lock_class: int, chat_id: int):
+        # transaction-scoped: released on commit/rollback; serializes workers on the same chat
+        run(cur, "chat_lock", (lock_class, str(chat_id)))
+
+    def drop_invalid_indexes(self, con):
+        # leftovers of an interrupted CREATE INDEX CONCURRENTLY; IF NOT EXISTS would skip them
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT c.relname FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE NOT i.indisvalid AND n.nspname = current_schema()
+            """)
+            for (name,) in cur.fetchall():
+                cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+@lru_cache(maxsize=1024)
+def _qmark(sql: str) -> str:
+    # psycopg style (%s) -> sqlite style (?)
+    return sql.replace("%s", "?")
+
+class _SqliteCursor:
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sql, params=(), prepare=None):
+        # prepare is accepted for psycopg compatibility; sqlite3 caches statements per connection anyway
+        self._cur.execute(_qmark(sql), params)
+        return self
+
+    def executemany(self, sql, seq):
+        self._cur.executemany(_qmark(sql), seq)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+
+class _SqliteConnection:
+    # one long-lived sqlite3 connection per thread; `with` = one transaction (no close)
+    def __init__(self, raw):
+        self._raw = raw
+
+    def cursor(self):
+        return _SqliteCursor(self._raw.cursor())
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._raw.commit()
+        else:
+            self._raw.rollback()
+
+class SqliteBackend:
+    name = "sqlite"
+    ddl = {"serial_pk": "INTEGER PRIMARY KEY AUTOINCREMENT", "concurrently": ""}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _open(self):
+        # sqlite3 keeps compiled (prepared) statements per connection, keyed by SQL text
+        raw = sqlite3.connect(self.path, timeout=5.0, cached_statements=SQLITE_STATEMENT_CACHE)
+        for pragma in SQLITE_PRAGMAS:
+            raw.execute(pragma)
+        return _SqliteConnection(raw)
+
+    def connection(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._open()
+            self._local.con = con
+        return con
+
+    @contextmanager
+    def migration_connection(self):
+        yield self.connection()
+
+    def transaction(self, con):
+        return con
+
+    def connection_with_timeout(self, timeout_ms: int):
+        # no statement_timeout in sqlite; busy_timeout already bounds waits on the write lock
+        return self.connection()
+
+    def lock_chat(self, cur, lock_class: int, chat_id: int):
+        # single process: the database write lock already serializes writers
+        pass
+
+    def drop_invalid_indexes(self, con):
+        pass
+
+def sqlite_path(url: str) -> str:
+    path = url.split(":", 1)[1]
+    if path.startswith("///"):
+        return path[3:]
+    if path.startswith("//"):
+        return path[2:]
+    return path
+
+def open_backend(url: str):
+    if url.startswith("sqlite:"):
+        return SqliteBackend(sqlite_path(url))
+    return PostgresBackend(url)
+
+_backend = None
+_replica = None
+
+def configure(url: str, read_url: str = None):
+    global _backend, _replica
+    _backend = open_backend(url)
+    _replica = None
+    if read_url:
+        if _backend.name != "postgres" or read_url.startswith("sqlite:"):
+            raise RuntimeError("DATABASE_READ_URL needs a Postgres DATABASE_URL and replica")
+        _replica = PostgresBackend(read_url, pool_name="hunter-read")
+    return _backend
+
+def backend_name() -> str:
+    return _backend.name if _backend else "none"
+
+def db(query_class: str = "interactive"):
+    note_activity()
+    if query_class == "interactive":
+        return _backend.connection()
+    return _backend.connection_with_timeout(STATEMENT_TIMEOUTS[query_class])
+
+def is_timeout(exc: BaseException) -> bool:
+    # cancelled by statement_timeout, no pooled connection in time, or sqlite busy past busy_timeout
+    if isinstance(exc, (psycopg.errors.QueryCanceled, psycopg.errors.LockNotAvailable, PoolTimeout)):
+        return True
+    return isinstance(exc, sqlite3.OperationalError) and "locked" in str(exc)
+
+# =========================
+# Read replica routing
+# read_db() hands out a replica connection for read-only lookups while the replica's
+# replay lag is within DB_READ_STALENESS; otherwise (or without a replica) the primary.
+# A user who just wrote (claim/reset/fav) reads from the primary for that same window,
+# so they always see their own change. Lag is probed at most every DB_READ_LAG_CHECK_EVERY.
+# =========================
+_recent_writers = {}  # user_id -> monotonic deadline for primary reads
+_replica_state = {"lag": None, "checked": 0.0, "reads": 0, "fallbacks": 0}
+_replica_probe_lock = threading.Lock()
+
+def note_write(user_id: int):
+    if _replica is None:
+        return
+    now = time.monotonic()
+    _recent_writers[user_id] = now + DB_READ_STALENESS
+    if len(_recent_writers) > 10_000:
+        for uid, until in list(_recent_writers.items()):
+            if until <= now:
+                _recent_writers.pop(uid, None)
+
+def _probe_replica_lag():
+    try:
+        with _replica.connection() as con:
+            with con.cursor() as cur:
+                cur.execute("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)
+                return float(cur.fetchone()[0])
+    except psycopg.Error as e:
+        print("Replica lag probe failed:", e)
+        return None
+
+def replica_usable() -> bool:
+    now = time.monotonic()
+    if now - _replica_state["checked"] >= DB_READ_LAG_CHECK_EVERY and _replica_probe_lock.acquire(blocking=False):
+        # one thread probes; the others keep using the last verdict
+        try:
+            _replica_state["lag"] = _probe_replica_lag()
+            _replica_state["checked"] = time.monotonic()
+        finally:
+            _replica_probe_lock.release()
+    lag = _replica_state["lag"]
+    return lag is not None and lag <= DB_READ_STALENESS
+
+def read_db(user_id: int = None):
+    if _replica is not None:
+        fresh_write = user_id is not None and _recent_writers.get(user_id, 0) > time.monotonic()
+        if not fresh_write and replica_usable():
+            _replica_state["reads"] += 1
+            note_activity()
+            return _replica.connection()
+        _replica_state["fallbacks"] += 1
+    return db()
+
+def read_routing_stats():
+    # None without a replica; otherwise (lag seconds or None if unreachable, replica reads, primary fallbacks)
+    if _replica is None:
+        return None
+    return _replica_state["lag"], _replica_state["reads"], _replica_state["fallbacks"]
+
+# =========================
+# Connection warm-up (Neon)
+# A suspended Neon compute makes the next connect take seconds. Every pooled connect is
+# timed (slow ones are counted as cold starts), connections that sat idle are pinged before
+# reuse so a suspend-killed socket is replaced instead of failing a query, and warm_up()
+# wakes the compute ahead of users (startup, keepalive, first update after a quiet period).
+# =========================
+_last_activity = time.monotonic()
+_connect_stats = {"connects": 0, "cold_starts": 0, "last": 0.0, "max": 0.0, "dropped": 0, "retries": 0}
+
+class TimedConnection(psycopg.Connection):
+    returned_at = 0.0
+
+    @classmethod
+    def connect(cls, *args, **kwargs):
+        started = time.monotonic()
+        con = super().connect(*args, **kwargs)
+        con.returned_at = time.monotonic()
+        record_connect(con.returned_at - started)
+        return con
+
+def record_connect(seconds: float):
+    _connect_stats["connects"] += 1
+    _connect_stats["last"] = seconds
+    _connect_stats["max"] = max(_connect_stats["max"], seconds)
+    if seconds >= DB_COLD_START_SECONDS:
+        _connect_stats["cold_starts"] += 1
+        print(f"DB cold start: connect took {seconds:.2f}s")
+
+def mark_returned(con):
+    con.returned_at = time.monotonic()
+
+def check_if_idle(con):
+    # the pool drops the connection and hands out another one if this raises
+    if time.monotonic() - con.returned_at < DB_CHECK_IDLE_AFTER:
+        return
+    try:
+        ConnectionPool.check_connection(con)
+    except psycopg.Error:
+        _connect_stats["dropped"] += 1
+        raise
+
+def note_activity():
+    global _last_activity
+    _last_activity = time.monotonic()
+
+def seconds_since_db_activity() -> float:
+    return time.monotonic() - _last_activity
+
+def warm_up(reason: str) -> bool:
+    # one round trip per backend, retried with backoff scaled to the last connect latency
+    if _backend.name != "postgres":
+        return True
+    for backend in (_backend, _replica):
+        if backend is None:
+            continue
+        delay = max(0.25, _connect_stats["last"])
+        for attempt in range(DB_WARMUP_ATTEMPTS):
+            started = time.monotonic()
+            try:
+                with backend.connection() as con:
+                    con.execute("SELECT 1")
+                break
+            except psycopg.OperationalError as e:
+                _connect_stats["retries"] += 1
+                wait = min(DB_WARMUP_MAX_DELAY, delay * 2 ** attempt)
+                print(f"DB warm-up ({reason}) failed after {time.monotonic() - started:.2f}s, retry in {wait:.1f}s:", e)
+                time.sleep(wait)
+        else:
+            return False
+    note_activity()
+    return True
+
+def connect_stats():
+    return dict(_connect_stats)
+
+# =========================
+# Named statements
+# hot queries live here under a name. run() executes them as server-side prepared
+# statements (psycopg prepares each one once per pooled connection) and records timings.
+# =========================
+CHARACTER_COLUMNS = "id, name, anime, rarity_key, event_key, image_file_id, channel_msg_id"
+
+# resets bump a user/chat epoch instead of deleting rows: an inventory row (alias i) is live
+# while its epochs match the current ones; stale rows wait for reclaim_reset_rows()
+LIVE_INVENTORY_JOIN = """
+    LEFT JOIN user_epochs ue ON ue.user_id = i.user_id
+    LEFT JOIN chat_epochs ce ON ce.chat_id = i.chat_id
+"""
+LIVE_INVENTORY = "i.user_epoch = COALESCE(ue.epoch, 0) AND i.chat_epoch = COALESCE(ce.epoch, 0)"
+
+# leaderboard score per copy by rarity (keys are waifu.RARITIES keys; anything else counts 1)
+RARITY_SCORES = {
+    "common": 1, "rare": 2, "epic": 3, "legendary": 5, "flat": 8,
+    "transcendent": 13, "cosmic": 21, "infinity": 34, "oblivion": 55,
+}
+RARITY_SCORE_SQL = "(CASE c.rarity_key {} ELSE 1 END)".format(
+    " ".join(f"WHEN '{key}' THEN {score}" for key, score in RARITY_SCORES.items())
+)
+
+# player_stats: per (scope, user) counters behind /top and /topchat; scope = chat_id, 0 = all chats
+GLOBAL_SCOPE = 0
+PLAYER_METRICS = ("cards", "uniques", "score")
+PLAYER_STATS_SOURCE = f"""
+    inventory i
+    JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+    WHERE i.user_id = player_stats.user_id
+      AND (player_stats.scope = 0 OR i.chat_id = player_stats.scope)
+      AND {LIVE_INVENTORY}
+"""
+
+STATEMENTS = {
+    "chat_lock": "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+    "uploader_exists": "SELECT 1 FROM uploaders WHERE tg_id=%s",
+    # soft-deleted cards (deleted_at set) are invisible everywhere until purge_deleted_characters() drops them
+    "character_by_id": f"SELECT {CHARACTER_COLUMNS} FROM characters WHERE id=%s AND deleted_at IS NULL",
+    "pick_by_rarity": "SELECT id FROM characters WHERE rarity_key=%s AND deleted_at IS NULL ORDER BY RANDOM() LIMIT 1",
+    "chat_settings": """
+        SELECT spawn_enabled, spawn_every, msg_counter, spawn_every_seconds, next_spawn_at
+        FROM chat_settings WHERE chat_id=%s
+    """,
+    "counter_bump": """
+        INSERT INTO chat_settings (chat_id, spawn_enabled, spawn_every, msg_counter)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (chat_id) DO UPDATE SET msg_counter=chat_settings.msg_counter + EXCLUDED.msg_counter
+        RETURNING msg_counter, spawn_every, spawn_enabled
+    """,
+    "active_spawn": "SELECT char_id, spawned_msg_id, claimed_by FROM active_spawns WHERE chat_id=%s",
+    "claim_target": """
+        SELECT s.char_id, s.spawned_msg_id, s.claimed_by, c.rarity_key
+        FROM active_spawns s
+        JOIN characters c ON c.id = s.char_id
+        WHERE s.chat_id=%s
+    """,
+    "spawn_reserve": """
+        INSERT INTO active_spawns (chat_id, char_id, spawned_msg_id, spawned_at, claimed_by, claimed_at)
+        VALUES (%s, %s, 0, %s, NULL, NULL)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            char_id=EXCLUDED.char_id,
+            spawned_msg_id=0,
+            spawned_at=EXCLUDED.spawned_at,
+            claimed_by=NULL,
+            claimed_at=NULL
+        WHERE active_spawns.claimed_by IS NOT NULL
+           OR (active_spawns.spawned_msg_id=0 AND active_spawns.spawned_at < %s)
+        RETURNING chat_id
+    """,
+    "spawn_confirm": """
+        UPDATE active_spawns SET spawned_msg_id=%s, spawned_at=%s
+        WHERE chat_id=%s AND char_id=%s AND spawned_msg_id=0
+    """,
+    "spawn_claim": "UPDATE active_spawns SET claimed_by=%s, claimed_at=%s WHERE chat_id=%s",
+    # a stale (reset) row for the same card is restarted rather than added to
+    "inventory_add": """
+        INSERT INTO inventory (user_id, chat_id, char_id, copies, first_obtained_at, last_obtained_at, user_epoch, chat_epoch)
+        VALUES (%s, %s, %s, 1, %s, %s,
+                COALESCE((SELECT epoch FROM user_epochs WHERE user_id=%s), 0),
+                COALESCE((SELECT epoch FROM chat_epochs WHERE chat_id=%s), 0))
+        ON CONFLICT (user_id, chat_id, char_id) DO UPDATE SET
+            copies=CASE WHEN inventory.user_epoch=EXCLUDED.user_epoch AND inventory.chat_epoch=EXCLUDED.chat_epoch
+                        THEN inventory.copies + 1 ELSE 1 END,
+            first_obtained_at=CASE WHEN inventory.user_epoch=EXCLUDED.user_epoch AND inventory.chat_epoch=EXCLUDED.chat_epoch
+                                   THEN inventory.first_obtained_at ELSE EXCLUDED.first_obtained_at END,
+            last_obtained_at=EXCLUDED.last_obtained_at,
+            user_epoch=EXCLUDED.user_epoch,
+            chat_epoch=EXCLUDED.chat_epoch
+        RETURNING copies
+    """,
+    "owned_chats_of_card": f"""
+        SELECT COUNT(*)
+        FROM inventory i {LIVE_INVENTORY_JOIN}
+        WHERE i.user_id=%s AND i.char_id=%s AND {LIVE_INVENTORY}
+    """,
+    # one claim: +1 card in the chat's and the global row; returns the new counters of both
+    "player_stats_bump": """
+        INSERT INTO player_stats (scope, user_id, name, cards, uniques, score)
+        VALUES (%s, %s, %s, 1, %s, %s), (0, %s, %s, 1, %s, %s)
+        ON CONFLICT (scope, user_id) DO UPDATE SET
+            name=COALESCE(EXCLUDED.name, player_stats.name),
+            cards=player_stats.cards + 1,
+            uniques=player_stats.uniques + EXCLUDED.uniques,
+            score=player_stats.score + EXCLUDED.score
+        RETURNING scope, cards, uniques, score
+    """,
+    "player_stats_recompute": f"""
+        UPDATE player_stats SET
+            cards=(SELECT COALESCE(SUM(i.copies), 0) FROM {PLAYER_STATS_SOURCE}),
+            uniques=(SELECT COUNT(DISTINCT i.char_id) FROM {PLAYER_STATS_SOURCE}),
+            score=(SELECT COALESCE(SUM(i.copies * {RARITY_SCORE_SQL}), 0) FROM {PLAYER_STATS_SOURCE})
+        WHERE scope=%s AND user_id=%s
+    """,
+    "player_stats_drop_user": "DELETE FROM player_stats WHERE user_id=%s",
+    "player_stats_drop_chat": "DELETE FROM player_stats WHERE scope=%s RETURNING user_id",
+    "inventory_count": f"""
+        SELECT COALESCE(SUM(i.copies), 0)
+        FROM inventory i {LIVE_INVENTORY_JOIN}
+        WHERE i.user_id=%s AND {LIVE_INVENTORY}
+    """,
+    "chat_inventory_count": f"""
+        SELECT COALESCE(SUM(i.copies), 0), COUNT(DISTINCT i.user_id)
+        FROM inventory i {LIVE_INVENTORY_JOIN}
+        WHERE i.chat_id=%s AND {LIVE_INVENTORY}
+    """,
+    "user_epoch_bump": """
+        INSERT INTO user_epochs (user_id, epoch, reclaimed_epoch) VALUES (%s, 1, 0)
+        ON CONFLICT (user_id) DO UPDATE SET epoch=user_epochs.epoch + 1
+    """,
+    "chat_epoch_bump": """
+        INSERT INTO chat_epochs (chat_id, epoch, reclaimed_epoch) VALUES (%s, 1, 0)
+        ON CONFLICT (chat_id) DO UPDATE SET epoch=chat_epochs.epoch + 1
+    """,
+    "character_exists": "SELECT 1 FROM characters WHERE id=%s AND deleted_at IS NULL",
+    # /fav: existence + ownership + upsert in one statement (Postgres: data-modifying CTE)
+    "fav_set_checked": f"""
+        WITH card AS (SELECT id FROM characters WHERE id=%s AND deleted_at IS NULL),
+        owned AS (
+            SELECT i.char_id FROM inventory i
+            JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+            WHERE i.chat_id=%s AND i.user_id=%s AND i.char_id=%s AND {LIVE_INVENTORY}
+            LIMIT 1
+        ),
+        fav AS (
+            INSERT INTO favorites (user_id, char_id)
+            SELECT %s, char_id FROM owned
+            ON CONFLICT (user_id) DO UPDATE SET char_id=EXCLUDED.char_id
+            RETURNING char_id
+        )
+        SELECT EXISTS (SELECT 1 FROM card), EXISTS (SELECT 1 FROM fav)
+    """,
+    # SQLite has no data-modifying CTEs: upsert only if owned, existence is checked on a miss
+    "fav_set_owned": f"""
+        INSERT INTO favorites (user_id, char_id)
+        SELECT %s, i.char_id FROM inventory i
+        JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+        WHERE i.chat_id=%s AND i.user_id=%s AND i.char_id=%s AND {LIVE_INVENTORY}
+        ON CONFLICT (user_id) DO UPDATE SET char_id=EXCLUDED.char_id
+        RETURNING char_id
+    """,
+    # /harem: the collection plus its cover (owned favorite, else latest hunted) in one query
+    "harem": f"""
+        WITH mine AS (
+            SELECT c.anime, c.id, c.name, c.rarity_key, c.event_key, i.copies, i.last_obtained_at, c.image_file_id
+            FROM inventory i
+            JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+            WHERE i.user_id=%s AND i.chat_id=%s AND {LIVE_INVENTORY}
+        )
+        SELECT anime, id, name, rarity_key, event_key, copies,
+               COALESCE(
+                   (SELECT m.image_file_id FROM mine m JOIN favorites f ON f.char_id = m.id WHERE f.user_id=%s),
+                   (SELECT image_file_id FROM mine ORDER BY last_obtained_at DESC LIMIT 1)
+               ) AS cover
+        FROM mine
+        ORDER BY LOWER(anime) ASC, id ASC
+    """,
+    "collection_rows": f"""
+        SELECT c.anime, c.id, c.name, c.rarity_key, c.event_key, i.copies
+        FROM inventory i
+        JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+        WHERE i.user_id=%s AND i.chat_id=%s AND {LIVE_INVENTORY}
+        ORDER BY LOWER(c.anime) ASC, c.id ASC
+    """,
+    "user_cards": f"""
+        SELECT c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id, SUM(i.copies) as cnt
+        FROM inventory i
+        JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+        WHERE i.user_id=%s AND {LIVE_INVENTORY}
+        GROUP BY c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id
+        ORDER BY c.id ASC
+    """,
+}
+
+for _metric in PLAYER_METRICS:
+    STATEMENTS[f"top_{_metric}"] = f"""
+        SELECT user_id, name, cards, uniques, score
+        FROM player_stats
+        WHERE scope=%s AND {_metric} > 0
+        ORDER BY {_metric} DESC, user_id ASC
+        LIMIT %s
+    """
+
+STATEMENT_HOOKS = []  # callables(name, seconds), called after every run()
+_statement_stats = {}  # name -> [calls, total_seconds, max_seconds]
+_statement_stats_lock = threading.Lock()
+
+def run(cur, name: str, params=()):
+    started = time.perf_counter()
+    try:
+        cur.execute(STATEMENTS[name], params, prepare=DB_PREPARE)
+    finally:
+        elapsed = time.perf_counter() - started
+        with _statement_stats_lock:
+            st = _statement_stats.setdefault(name, [0, 0.0, 0.0])
+            st[0] += 1
+            st[1] += elapsed
+            st[2] = max(st[2], elapsed)
+        for hook in STATEMENT_HOOKS:
+            hook(name, elapsed)
+    return cur
+
+def statement_stats():
+    # [(name, calls, total_seconds, max_seconds)], most total time first
+    with _statement_stats_lock:
+        rows = [(name, st[0], st[1], st[2]) for name, st in _statement_stats.items()]
+    return sorted(rows, key=lambda r: r[2], reverse=True)
+
+# =========================
+# Schema migrations
+# - schema_version holds one row per applied migration
+# - init_db() on an up-to-date DB is a single SELECT (no DDL, no locks)
+# - "concurrent" migrations run outside a transaction (CREATE INDEX CONCURRENTLY on Postgres)
+# - steps are SQL strings ({serial_pk}, {concurrently} filled per backend) or callables(cur)
+# =========================
+MIGRATION_LOCK_KEY = 72_000_001
+
+def lock_inventory(cur):
+    # block hunts while a migration copies inventory, or they land in the table it is about to drop
+    # (SQLite has no LOCK TABLE: its single writer already serializes the migration)
+    if _backend.name == "postgres":
+        cur.execute("LOCK TABLE inventory IN SHARE ROW EXCLUSIVE MODE")
+
+def backfill_player_stats(cur):
+    for scope, unique_expr, group in (("i.chat_id", "COUNT(*)", "i.chat_id, i.user_id"),
+                                      ("0", "COUNT(DISTINCT i.char_id)", "i.user_id")):
+        cur.execute(f"""
+            INSERT INTO player_stats (scope, user_id, name, cards, uniques, score)
+            SELECT {scope}, i.user_id, NULL, SUM(i.copies), {unique_expr}, SUM(i.copies * {RARITY_SCORE_SQL})
+            FROM inventory i
+            JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+            WHERE {LIVE_INVENTORY}
+            GROUP BY {group}
+        """)
+
+MIGRATIONS = [
+    (1, "base tables", False, [
+        """
+        CREATE TABLE IF NOT EXISTS uploaders (
+            tg_id BIGINT PRIMARY KEY,
+            added_by BIGINT NOT NULL,
+            added_at BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS characters (
+            id {serial_pk},
+            name TEXT NOT NULL,
+            anime TEXT NOT NULL,
+            rarity_key TEXT NOT NULL,
+            event_key TEXT NOT NULL,
+            image_file_id TEXT NOT NULL,
+            channel_msg_id BIGINT,
+            uploaded_by BIGINT NOT NULL,
+            uploaded_at BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            spawn_enabled BOOLEAN NOT NULL,
+            spawn_every INTEGER NOT NULL,
+            msg_counter BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS active_spawns (
+            chat_id BIGINT PRIMARY KEY,
+            char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+            spawned_msg_id BIGINT NOT NULL,
+            spawned_at BIGINT NOT NULL,
+            claimed_by BIGINT,
+            claimed_at BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS inventory (
+            id {serial_pk},
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+            obtained_at BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id BIGINT PRIMARY KEY,
+            char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (2, "base indexes", True, [
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_inventory_user ON inventory(user_id)",
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_inventory_chat_user ON inventory(chat_id, user_id)",
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_characters_rarity ON characters(rarity_key)",
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_characters_name ON characters(name)",
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_characters_anime ON characters(anime)",
+    ]),
+    # one row per (user, chat, card) with a copy count instead of one row per hunt
+    (3, "compact inventory", False, [
+        lock_inventory,
+        """
+        CREATE TABLE inventory_compact (
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+            copies INTEGER NOT NULL,
+            first_obtained_at BIGINT NOT NULL,
+            last_obtained_at BIGINT NOT NULL,
+            PRIMARY KEY (user_id, chat_id, char_id)
+        )
+        """,
+        """
+        INSERT INTO inventory_compact (user_id, chat_id, char_id, copies, first_obtained_at, last_obtained_at)
+        SELECT user_id, chat_id, char_id, COUNT(*), MIN(obtained_at), MAX(obtained_at)
+        FROM inventory
+        GROUP BY user_id, chat_id, char_id
+        """,
+        "DROP TABLE inventory",
+        "ALTER TABLE inventory_compact RENAME TO inventory",
+    ]),
+    (4, "inventory char index", True, [
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_inventory_char ON inventory(char_id)",
+    ]),
+    # time-based spawns: 0 = off; next_spawn_at survives restarts
+    (5, "timed spawns", False, [
+        "ALTER TABLE chat_settings ADD COLUMN spawn_every_seconds INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE chat_settings ADD COLUMN next_spawn_at BIGINT",
+    ]),
+    (6, "spawn expiry index", True, [
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_active_spawns_unclaimed_at ON active_spawns(spawned_at) WHERE claimed_by IS NULL",
+    ]),
+    # small key/value store for process state (e.g. the getUpdates offset)
+    (7, "bot state", False, [
+        """
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value BIGINT NOT NULL,
+            updated_at BIGINT NOT NULL
+        )
+        """,
+    ]),
+    # O(1) resets: bump an epoch, rows of older epochs are hidden and reclaimed in the background
+    (8, "reset epochs", False, [
+        "ALTER TABLE inventory ADD COLUMN user_epoch BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE inventory ADD COLUMN chat_epoch BIGINT NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS user_epochs (
+            user_id BIGINT PRIMARY KEY,
+            epoch BIGINT NOT NULL,
+            reclaimed_epoch BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_epochs (
+            chat_id BIGINT PRIMARY KEY,
+            epoch BIGINT NOT NULL,
+            reclaimed_epoch BIGINT NOT NULL
+        )
+        """,
+    ]),
+    (9, "inventory chat index", True, [
+        "CREATE INDEX {concurrently} IF NOT EXISTS idx_inventory_chat ON inventory(chat_id)",
+    ]),
+    # /delete hides a card at once; its inventory rows are purged in batches afterwards
+    (10, "character soft delete", False, [
+        "ALTER TABLE characters ADD COLUMN deleted_at BIGINT",
+    ]),
+    # leaderboard counters, maintained by claim/reset/purge; backfilled from the live inventory
+    (11, "player stats", False, [
+        """
+        CREATE TABLE IF NOT EXISTS player_stats (
+            scope BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            name TEXT,
+            cards BIGINT NOT NULL,
+            uniques BIGINT NOT NULL,
+            score BIGINT NOT NULL,
+            PRIMARY KEY (scope, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_player_stats_cards ON player_stats(scope, cards)",
+        "CREATE INDEX IF NOT EXISTS idx_player_stats_uniques ON player_stats(scope, uniques)",
+        "CREATE INDEX IF NOT EXISTS idx_player_stats_score ON player_stats(scope, score)",
+        "CREATE INDEX IF NOT EXISTS idx_player_stats_user ON player_stats(user_id)",
+        backfill_player_stats,
+    ]),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version() -> int:
+    try:
+        with db() as con:
+            with con.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                return int(cur.fetchone()[0])
+    except (psycopg.errors.UndefinedTable, sqlite3.OperationalError):
+        return 0
+
+def _run_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step.format(**_backend.ddl))
+
+def run_migrations() -> int:
+    with _backend.migration_connection() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at BIGINT NOT NULL
+                )
+            """)
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = int(cur.fetchone()[0])
+
+        for version, name, concurrent, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.time()
+            if concurrent:
+                _backend.drop_invalid_indexes(con)
+                with con.cursor() as cur:
+                    for step in steps:
+                        _run_step(cur, step)
+                with _backend.transaction(con):
+                    with con.cursor() as cur:
+                        cur.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                                    (version, name, int(time.time())))
+            else:
+                with _backend.transaction(con):
+                    with con.cursor() as cur:
+                        for step in steps:
+                            _run_step(cur, step)
+                        cur.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                                    (version, name, int(time.time())))
+            current = version
+            print(f"schema migration {version} ({name}) applied in {time.time() - started:.2f}s")
+    return current
+
+def init_db() -> int:
+    current = schema_version()
+    if current >= LATEST_SCHEMA_VERSION:
+        return current
+    return run_migrations()
+
+# =========================
+# Opt-in: hash-partitioned inventory (Postgres only)
+#   python storage.py partition-inventory 16
+# Every per-user query filters on user_id=%s, so the planner prunes it to one partition.
+# The swap runs in one transaction; writers wait on the SHARE ROW EXCLUSIVE lock while rows are copied.
+# =========================
+def inventory_partition_count() -> int:
+    if _backend.name != "postgres":
+        return 0
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT COUNT(i.inhrelid)
+                FROM pg_partitioned_table p
+                JOIN pg_class c ON c.oid = p.partrelid
+                LEFT JOIN pg_inherits i ON i.inhparent = c.oid
+                WHERE c.oid = to_regclass('inventory')
+            """)
+            return int(cur.fetchone()[0] or 0)
+
+def partition_inventory(partitions: int) -> int:
+    if _backend.name != "postgres":
+        raise RuntimeError("inventory partitioning needs Postgres")
+    if partitions < 2:
+        raise ValueError("partitions must be >= 2")
+    init_db()
+    existing = inventory_partition_count()
+    if existing:
+        return existing
+
+    started = time.time()
+    with db("maintenance") as con:
+        with con.cursor() as cur:
+            cur.execute("LOCK TABLE inventory IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("""
+                CREATE TABLE inventory_part (
+                    user_id BIGINT NOT NULL,
+                    chat_id BIGINT NOT NULL,
+                    char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+                    copies INTEGER NOT NULL,
+                    first_obtained_at BIGINT NOT NULL,
+                    last_obtained_at BIGINT NOT NULL,
+                    user_epoch BIGINT NOT NULL DEFAULT 0,
+                    chat_epoch BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, chat_id, char_id)
+                ) PARTITION BY HASH (user_id)
+            """)
+            for r in range(partitions):
+                cur.execute(f"""
+                    CREATE TABLE inventory_p{r} PARTITION OF inventory_part
+                    FOR VALUES WITH (MODULUS {partitions}, REMAINDER {r})
+                """)
+            cur.execute("""
+                INSERT INTO inventory_part (user_id, chat_id, char_id, copies, first_obtained_at, last_obtained_at,
+                                            user_epoch, chat_epoch)
+                SELECT user_id, chat_id, char_id, copies, first_obtained_at, last_obtained_at,
+                       user_epoch, chat_epoch
+                FROM inventory
+            """)
+            moved = cur.rowcount
+            cur.execute("DROP TABLE inventory")
+            cur.execute("ALTER TABLE inventory_part RENAME TO inventory")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_char ON inventory(char_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_chat ON inventory(chat_id)")
+        con.commit()
+    print(f"inventory partitioned into {partitions} (hash user_id), {moved} rows moved in {time.time() - started:.1f}s")
+    return partitions
+
+# =========================
+# Uploaders
+# =========================
+def uploader_exists(uid: int) -> bool:
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "uploader_exists", (uid,))
+            row = cur.fetchone()
+    return row is not None
+
+def add_uploader(tg_id: int, added_by: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                INSERT INTO uploaders (tg_id, added_by, added_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (tg_id) DO NOTHING
+            """, (tg_id, added_by, int(time.time())))
+        con.commit()
+
+def remove_uploader(tg_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("DELETE FROM uploaders WHERE tg_id=%s", (tg_id,))
+        con.commit()
+
+# =========================
+# Characters
+# =========================
+def character_from_row(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "anime": row[2],
+        "rarity_key": row[3],
+        "event_key": row[4],
+        "image_file_id": row[5],
+        "channel_msg_id": row[6],
+    }
+
+def get_character(char_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "character_by_id", (char_id,))
+            row = cur.fetchone()
+    return character_from_row(row) if row else None
+
+def insert_character(card: dict, uploaded_by: int) -> int:
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                INSERT INTO characters (name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (
+                card["name"], card["anime"], card["rarity_key"], card["event_key"],
+                card["file_id"], uploaded_by, int(time.time())
+            ))
+            new_id = int(cur.fetchone()[0])
+        con.commit()
+    return new_id
+
+def insert_character_with_id(char_id: int, card: dict, uploaded_by: int) -> bool:
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("SELECT 1 FROM characters WHERE id=%s", (char_id,))
+            if cur.fetchone():
+                return False
+
+            cur.execute("""
+                INSERT INTO characters (id, name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                char_id, card["name"], card["anime"], card["rarity_key"], card["event_key"],
+                card["file_id"], uploaded_by, int(time.time())
+            ))
+        con.commit()
+    return True
+
+CHARACTER_EDITABLE_COLUMNS = ("name", "anime", "rarity_key", "event_key", "image_file_id", "channel_msg_id")
+
+def update_character(char_id: int, column: str, value):
+    if column not in CHARACTER_EDITABLE_COLUMNS:
+        raise ValueError(f"column not editable: {column}")
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute(f"UPDATE characters SET {column}=%s WHERE id=%s", (value, char_id))
+        con.commit()
+
+def delete_character(char_id: int) -> bool:
+    # soft delete: hidden at once, copies are purged in the background
+    with db("admin") as con:
+        with con.cursor() as cur:
+            cur.execute("UPDATE characters SET deleted_at=%s WHERE id=%s AND deleted_at IS NULL",
+                        (int(time.time()), char_id))
+            hidden = cur.rowcount > 0
+            cur.execute("DELETE FROM active_spawns WHERE char_id=%s", (char_id,))
+        con.commit()
+    return hidden
+
+PURGE_BATCH = 500
+
+def purge_deleted_characters(batch: int = PURGE_BATCH):
+    # removes up to `batch` inventory rows of the oldest soft-deleted card; the card row goes once none are left.
+    # -> None if nothing is pending, else (char_id, name, rows_deleted, finished)
+    with db("background") as con:
+        with con.cursor() as cur:
+            cur.execute("SELECT id, name FROM characters WHERE deleted_at IS NOT NULL ORDER BY deleted_at LIMIT 1")
+            row = cur.fetchone()
+            if not row:
+                return None
+            char_id, name = row
+            cur.execute("""
+                DELETE FROM inventory WHERE (user_id, chat_id, char_id) IN (
+                    SELECT user_id, chat_id, char_id FROM inventory WHERE char_id=%s LIMIT %s
+                )
+                RETURNING user_id, chat_id
+            """, (char_id, batch))
+            owners = cur.fetchall()
+            deleted = len(owners)
+            finished = deleted < batch
+            scopes = {(chat, user) for user, chat in owners} | {(GLOBAL_SCOPE, user) for user, _ in owners}
+            cur.executemany(STATEMENTS["player_stats_recompute"], sorted(scopes))
+            if finished:
+                cur.execute("DELETE FROM favorites WHERE char_id=%s", (char_id,))
+                cur.execute("DELETE FROM active_spawns WHERE char_id=%s", (char_id,))
+                cur.execute("DELETE FROM characters WHERE id=%s", (char_id,))
+        con.commit()
+    return char_id, name, deleted, finished
+
+def refresh_player_stats(cur, pairs):
+    # recount the leaderboard rows of (chat_id, user_id) pairs plus those users' global rows
+    # (bulk writers that bypass claim_spawn, e.g. import_legacy), inside the caller's transaction
+    scopes = {(chat, user) for chat, user in pairs} | {(GLOBAL_SCOPE, user) for _, user in pairs}
+    if not scopes:
+        return
+    scopes = sorted(scopes)
+    cur.executemany("""
+        INSERT INTO player_stats (scope, user_id, name, cards, uniques, score)
+        VALUES (%s, %s, NULL, 0, 0, 0)
+        ON CONFLICT (scope, user_id) DO NOTHING
+    """, scopes)
+    cur.executemany(STATEMENTS["player_stats_recompute"], scopes)
+
+def top_players(scope: int, metric: str, limit: int):
+    # [(user_id, name, cards, uniques, score)] best first by `metric`
+    if metric not in PLAYER_METRICS:
+        raise ValueError(f"unknown leaderboard metric: {metric}")
+    with read_db() as con:
+        with con.cursor() as cur:
+            return run(cur, f"top_{metric}", (scope, limit)).fetchall()
+
+def pending_deletions():
+    # [(char_id, name, deleted_at, inventory rows left)] for /deletestatus
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT c.id, c.name, c.deleted_at, (SELECT COUNT(*) FROM inventory i WHERE i.char_id = c.id)
+                FROM characters c
+                WHERE c.deleted_at IS NOT NULL
+                ORDER BY c.deleted_at
+            """)
+            return cur.fetchall()
+
+def search_characters_in_db(query: str):
+    q = (query or "").strip()
+    if not q:
+        return []
+    like = f"%{q}%"
+
+    with read_db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT id, name, anime, rarity_key, event_key, image_file_id
+                FROM characters
+                WHERE (LOWER(name) LIKE LOWER(%s) OR LOWER(anime) LIKE LOWER(%s))
+                  AND deleted_at IS NULL
+                ORDER BY id ASC
+            """, (like, like))
+            rows = cur.fetchall()
+    return rows
+
+def pick_random_character_by_rarity(rarity_key: str):
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "pick_by_rarity", (rarity_key,))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+def pick_random_character_any():
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("SELECT id FROM characters WHERE deleted_at IS NULL ORDER BY RANDOM() LIMIT 1")
+            row = cur.fetchone()
+    return row[0] if row else None
+
+# =========================
+# Chat settings / spawns
+# =========================
+def shard_filter(shard, column: str = "chat_id"):
+    # shard=(index, count): extra WHERE clause keeping one worker's chats (same rule as waifu.shard_of)
+    if not shard or shard[1] <= 1:
+        return "", ()
+    return f" AND mod(abs({column}), %s) = %s", (shard[1], shard[0])
+
+def get_or_create_chat_settings(chat_id: int, default_enabled: bool, default_every: int):
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "chat_settings", (chat_id,))
+            row = cur.fetchone()
+            if not row:
+                cur.execute("""
+                    INSERT INTO chat_settings (chat_id, spawn_enabled, spawn_every, msg_counter)
+                    VALUES (%s, %s, %s, %s)
+                """, (chat_id, default_enabled, default_every, 0))
+                con.commit()
+                row = (default_enabled, default_every, 0, 0, None)
+    return {"enabled": bool(row[0]), "every": int(row[1]), "counter": int(row[2]),
+            "every_seconds": int(row[3]), "next_spawn_at": row[4]}
+
+def update_chat_settings(chat_id: int, enabled: bool, every: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                UPDATE chat_settings
+                SET spawn_enabled=%s, spawn_every=%s
+                WHERE chat_id=%s
+            """, (enabled, every, chat_id))
+        con.commit()
+
+def set_spawn_timer(chat_id: int, every_seconds: int, next_spawn_at):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                UPDATE chat_settings SET spawn_every_seconds=%s, next_spawn_at=%s
+                WHERE chat_id=%s
+            """, (every_seconds, next_spawn_at, chat_id))
+        con.commit()
+
+def load_spawn_timers(shard=None):
+    # (chat_id, spawn_every_seconds, next_spawn_at) for every enabled chat with a timer
+    where, params = shard_filter(shard)
+    with db("background") as con:
+        with con.cursor() as cur:
+            cur.execute(f"""
+                SELECT chat_id, spawn_every_seconds, next_spawn_at FROM chat_settings
+                WHERE spawn_enabled AND spawn_every_seconds > 0{where}
+            """, params)
+            return cur.fetchall()
+
+def save_next_spawn_times(rows):
+    # rows: [(next_spawn_at, chat_id), ...] -> one batched write per scheduler flush
+    with db("background") as con:
+        with con.cursor() as cur:
+            cur.executemany("UPDATE chat_settings SET next_spawn_at=%s WHERE chat_id=%s", rows)
+        con.commit()
+
+def increment_msg_counter(chat_id: int, default_enabled: bool, default_every: int):
+    # one atomic round trip (concurrent handler threads must not lose increments)
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "counter_bump", (chat_id, default_enabled, default_every, 1))
+            new, every, enabled = cur.fetchone()
+        con.commit()
+    return int(new), int(every), bool(enabled)
+
+def add_msg_counters(counts: dict, default_enabled: bool, default_every: int):
+    # backlog catch-up: one upsert per chat for n messages at once
+    # returns [(chat_id, old_counter, new_counter, spawn_every, spawn_enabled), ...]
+    out = []
+    with db("background") as con:
+        with con.cursor() as cur:
+            for chat_id, n in counts.items():
+                run(cur, "counter_bump", (chat_id, default_enabled, default_every, n))
+                new, every, enabled = cur.fetchone()
+                out.append((chat_id, int(new) - n, int(new), int(every), bool(enabled)))
+        con.commit()
+    return out
+
+def has_active_spawn(chat_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "active_spawn", (chat_id,))
+            row = cur.fetchone()
+    return row
+
+# spawned_msg_id=0 marks a reservation: the row is written before send_photo,
+# so a second trigger (another thread or worker) sees the chat as busy.
+SPAWN_LOCK_CLASS = 72_000_002
+SPAWN_RESERVATION_TTL = 60
+
+def reserve_spawn_slot(chat_id: int, char_id: int) -> bool:
+    # takes the slot only if there is no spawn, a claimed one, or a stale reservation
+    now = int(time.time())
+    with db() as con:
+        with con.cursor() as cur:
+            _backend.lock_chat(cur, SPAWN_LOCK_CLASS, chat_id)
+            run(cur, "spawn_reserve", (chat_id, char_id, now, now - SPAWN_RESERVATION_TTL))
+            ok = cur.fetchone() is not None
+        con.commit()
+    return ok
+
+def confirm_spawn(chat_id: int, char_id: int, spawned_msg_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "spawn_confirm", (spawned_msg_id, int(time.time()), chat_id, char_id))
+        con.commit()
+
+def release_spawn_reservation(chat_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("DELETE FROM active_spawns WHERE chat_id=%s AND spawned_msg_id=0", (chat_id,))
+        con.commit()
+
+def expire_spawns(older_than: int, shard=None):
+    # one indexed statement per sweep; returns (chat_id, char_id, spawned_msg_id) of every expired spawn
+    where, params = shard_filter(shard)
+    with db("background") as con:
+        with con.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM active_spawns
+                WHERE claimed_by IS NULL AND spawned_at < %s{where}
+                RETURNING chat_id, char_id, spawned_msg_id
+            """, (older_than, *params))
+            rows = cur.fetchall()
+        con.commit()
+    return rows
+
+def clear_active_spawn(chat_id: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("DELETE FROM active_spawns WHERE chat_id=%s", (chat_id,))
+        con.commit()
+
+def load_active_spawns(shard=None):
+    # (chat_id, spawned_msg_id, claimed_by, character dict) for every spawn row, for the in-memory registry
+    where, params = shard_filter(shard, "s.chat_id")
+    with db("background") as con:
+        with con.cursor() as cur:
+            cur.execute(f"""
+                SELECT s.chat_id, s.spawned_msg_id, s.claimed_by,
+                       c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id, c.channel_msg_id
+                FROM active_spawns s
+                JOIN characters c ON c.id = s.char_id
+                WHERE s.spawned_msg_id <> 0{where}
+            """, params)
+            rows = cur.fetchall()
+    return [(r[0], r[1], r[2], character_from_row(r[3:])) for r in rows]
+
+def claim_spawn(chat_id: int, user_id: int, expected_char_id=None, name: str = None):
+    # -> (True, (char_id, spawned_msg_id, {scope: (cards, uniques, score)})) or (False, reason)
+    with db() as con:
+        with con.cursor() as cur:
+            _backend.lock_chat(cur, SPAWN_LOCK_CLASS, chat_id)
+            run(cur, "claim_target", (chat_id,))
+            row = cur.fetchone()
+            if not row:
+                return (False, "❌ No active spawn.")
+            char_id, spawned_msg_id, claimed_by, rarity_key = row
+            if expected_char_id is not None and char_id != expected_char_id:
+                return (False, "❌ No active spawn.")
+            if claimed_by is not None:
+                return (False, "❌ This spawn is already claimed.")
+
+            now = int(time.time())
+            run(cur, "spawn_claim", (user_id, now, chat_id))
+            copies = run(cur, "inventory_add", (user_id, chat_id, char_id, now, now, user_id, chat_id)).fetchone()[0]
+            new_here = copies == 1
+            new_anywhere = new_here and run(cur, "owned_chats_of_card", (user_id, char_id)).fetchone()[0] == 1
+            score = RARITY_SCORES.get(rarity_key, 1)
+            run(cur, "player_stats_bump", (chat_id, user_id, name, int(new_here), score,
+                                           user_id, name, int(new_anywhere), score))
+            stats = {r[0]: (int(r[1]), int(r[2]), int(r[3])) for r in cur.fetchall()}
+        con.commit()
+    note_write(user_id)
+    return (True, (char_id, spawned_msg_id, stats))
+
+# =========================
+# Bot state
+# =========================
+def get_bot_state(key: str):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("SELECT value FROM bot_state WHERE key=%s", (key,))
+            row = cur.fetchone()
+    return int(row[0]) if row else None
+
+def set_bot_state(key: str, value: int):
+    with db() as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                INSERT INTO bot_state (key, value, updated_at) VALUES (%s, %s, %s)
+                ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=EXCLUDED.updated_at
+            """, (key, value, int(time.time())))
+        con.commit()
+
+# =========================
+# Inventory / favorites
+# =========================
+def count_user_inventory(user_id: int) -> int:
+    with db() as con:
+        with con.cursor() as cur:
+            run(cur, "inventory_count", (user_id,))
+            return int(cur.fetchone()[0] or 0)
+
+def reset_user_inventory(user_id: int) -> int:
+    with db("admin") as con:
+        with con.cursor() as cur:
+            total = int(run(cur, "inventory_count", (user_id,)).fetchone()[0] or 0)
+            run(cur, "user_epoch_bump", (user_id,))
+            run(cur, "player_stats_drop_user", (user_id,))
+        con.commit()
+    note_write(user_id)
+    return total
+
+def reset_chat_inventory(chat_id: int):
+    # (cards, players) hidden by the reset; counting them and recounting the players'
+    # global stats is O(chat size), so this runs under the admin timeout
+    with db("admin") as con:
+        with con.cursor() as cur:
+            cards, players = run(cur, "chat_inventory_count", (chat_id,)).fetchone()
+            run(cur, "chat_epoch_bump", (chat_id,))
+            # the chat's cards leave the global counters too: recount those players
+            users = [r[0] for r in run(cur, "player_stats_drop_chat", (chat_id,)).fetchall()]
+            cur.executemany(STATEMENTS["player_stats_recompute"], [(GLOBAL_SCOPE, u) for u in users])
+        con.commit()
+    return int(cards or 0), int(players or 0)
+
+RECLAIM_BATCH = 500
+
+def reclaim_reset_rows(batch: int = RECLAIM_BATCH) -> int:
+    # deletes up to `batch` stale rows of one reset user or chat; 0 = nothing left to reclaim
+    with db("background") as con:
+        with con.cursor() as cur:
+            for table, key in (("user_epochs", "user_id"), ("chat_epochs", "chat_id")):
+                cur.execute(f"SELECT {key}, epoch FROM {table} WHERE reclaimed_epoch < epoch LIMIT 1")
+                row = cur.fetchone()
+                if not row:
+                    continue
+                owner, epoch = row
+                epoch_col = key.replace("_id", "_epoch")
+                cur.execute(f"""
+                    DELETE FROM inventory WHERE (user_id, chat_id, char_id) IN (
+                        SELECT user_id, chat_id, char_id FROM inventory
+                        WHERE {key}=%s AND {epoch_col} < %s
+                        LIMIT %s
+                    )
+                """, (owner, epoch, batch))
+                deleted = cur.rowcount
+                if deleted < batch:
+                    cur.execute(f"UPDATE {table} SET reclaimed_epoch=%s WHERE {key}=%s AND reclaimed_epoch < %s",
+                                (epoch, owner, epoch))
+                con.commit()
+                return max(deleted, 1)
+    return 0
+
+def set_favorite_if_owned(chat_id: int, user_id: int, char_id: int) -> str:
+    # "ok" | "missing" (no such card) | "not_owned" (not in this chat's collection)
+    with db() as con:
+        with con.cursor() as cur:
+            if _backend.name == "postgres":
+                run(cur, "fav_set_checked", (char_id, chat_id, user_id, char_id, user_id))
+                exists, done = cur.fetchone()
+            else:
+                done = run(cur, "fav_set_owned", (user_id, chat_id, user_id, char_id)).fetchone() is not None
+                exists = done or run(cur, "character_exists", (char_id,)).fetchone() is not None
+        con.commit()
+    if done:
+        note_write(user_id)
+        return "ok"
+    return "not_owned" if exists else "missing"
+
+def get_harem(chat_id: int, user_id: int):
+    # (rows as in get_user_collection_rows, cover image_file_id or None)
+    with read_db(user_id) as con:
+        with con.cursor() as cur:
+            rows = run(cur, "harem", (user_id, chat_id, user_id)).fetchall()
+    if not rows:
+        return [], None
+    return [r[:6] for r in rows], rows[0][6]
+
+def get_user_collection_rows(chat_id: int, user_id: int):
+    with read_db(user_id) as con:
+        with con.cursor() as cur:
+            run(cur, "collection_rows", (user_id, chat_id))
+            return cur.fetchall()
+
+def get_user_cards(user_id: int):
+    with read_db(user_id) as con:
+        with con.cursor() as cur:
+            run(cur, "user_cards", (user_id,))
+            return cur.fetchall()
+
+def rarity_deck_stats(user_id: int, rarity_keys):
+    with read_db(user_id) as con:
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT rarity_key, COUNT(*)
+                FROM characters
+                WHERE deleted_at IS NULL
+                GROUP BY rarity_key
+            """)
+            total_rows = cur.fetchall()
+            total_map = {rk: int(cnt) for rk, cnt in total_rows}
+
+            cur.execute(f"""
+                SELECT c.rarity_key, COUNT(DISTINCT i.char_id)
+                FROM inventory i
+                JOIN characters c ON c.id = i.char_id AND c.deleted_at IS NULL {LIVE_INVENTORY_JOIN}
+                WHERE i.user_id=%s AND {LIVE_INVENTORY}
+                GROUP BY c.rarity_key
+            """, (user_id,))
+            owned_rows = cur.fetchall()
+            owned_map = {rk: int(cnt) for rk, cnt in owned_rows}
+
+    for rk in rarity_keys:
+        total_map.setdefault(rk, 0)
+        owned_map.setdefault(rk, 0)
+
+    return total_map, owned_map
+
+def get_card_global_stats(char_id: int):
+    with read_db() as con:
+        with con.cursor() as cur:
+            cur.execute(f"""
+                SELECT COALESCE(SUM(i.copies), 0), COUNT(DISTINCT i.user_id)
+                FROM inventory i {LIVE_INVENTORY_JOIN}
+                WHERE i.char_id=%s AND {LIVE_INVENTORY}
+            """, (char_id,))
+            total_copies, total_unique_users = (int(v or 0) for v in cur.fetchone())
+
+            cur.execute(f"""
+                SELECT i.user_id, SUM(i.copies) as cnt
+                FROM inventory i {LIVE_INVENTORY_JOIN}
+                WHERE i.char_id=%s AND {LIVE_INVENTORY}
+                GROUP BY i.user_id
+                ORDER BY cnt DESC
+                LIMIT 10
+            """, (char_id,))
+            top_users = cur.fetchall()
+
+    return total_copies, total_unique_users, top_users
+
+# release phase: `python storage.py` applies pending migrations before workers start
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="HunterBot storage maintenance")
+    ap.add_argument("command", nargs="?", default="migrate", choices=["migrate", "partition-inventory"])
+    ap.add_argument("partitions", nargs="?", type=int, default=16)
+    args = ap.parse_args()
+
+    configure(os.environ["DATABASE_URL"])
+    if args.command == "partition-inventory":
+        print("inventory partitions:", partition_inventory(args.partitions))
+    else:
+        print("schema version:", init_db())
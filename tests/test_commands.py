@@ -0,0 +1,25 @@
+# command argument parsing; waifu is imported against a throwaway SQLite file (the bot is not started)
+import os
+import tempfile
+
+os.environ.setdefault("TOKEN", "0:test")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'commands.db')}")
+
+import pytest
+
+import waifu
+
+def test_split_command_keeps_the_argument():
+    assert waifu.split_command("/Fav@HunterBot  ۲۵") == ("fav", "hunterbot", "۲۵")
+
+@pytest.mark.parametrize("args, value", [
+    ("25", 25),
+    ("۲۵", 25),   # Persian digits
+    ("٢٥", 25),   # Arabic-Indic digits
+    ("", None),
+    ("-3", None),
+    ("2.5", None),
+    ("²", None),  # a digit to isdigit(), but not to int()
+])
+def test_int_arg(args, value):
+    assert waifu.int_arg(args) == value
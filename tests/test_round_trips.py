@@ -0,0 +1,74 @@
+# user-facing reads/writes collapsed to a single statement (one DB round trip each),
+# counted at the cursor on the SQLite backend
+import pytest
+
+import storage
+
+CHAT = -100
+USER = 5
+
+def card(name):
+    return {"name": name, "anime": "Bleach", "rarity_key": "cosmic", "event_key": "none", "file_id": "F" + name}
+
+@pytest.fixture
+def db(tmp_path):
+    storage.configure(f"sqlite:///{tmp_path / 'hunter.db'}")
+    storage.init_db()
+    owned = storage.insert_character(card("Rangiku"), uploaded_by=1)
+    other = storage.insert_character(card("Orihime"), uploaded_by=1)
+    assert storage.reserve_spawn_slot(CHAT, owned)
+    storage.confirm_spawn(CHAT, owned, 1)
+    assert storage.claim_spawn(CHAT, USER, expected_char_id=owned)[0]
+    return owned, other
+
+@pytest.fixture
+def statements(monkeypatch):
+    # every execute on a storage cursor, named after its STATEMENTS entry (raw SQL otherwise),
+    # so a query issued outside run() is counted too
+    names = {sql: name for name, sql in storage.STATEMENTS.items()}
+    seen = []
+
+    def counted(method):
+        def execute(self, sql, *args, **kwargs):
+            seen.append(names.get(sql, sql))
+            return method(self, sql, *args, **kwargs)
+        return execute
+
+    for method in ("execute", "executemany"):
+        monkeypatch.setattr(storage._SqliteCursor, method, counted(getattr(storage._SqliteCursor, method)))
+    return seen
+
+def test_harem_is_one_round_trip(db, statements):
+    owned, _ = db
+    rows, cover = storage.get_harem(CHAT, USER)
+    assert [r[1] for r in rows] == [owned]
+    assert cover == "FRangiku"
+    assert statements == ["harem"]
+
+def test_harem_cover_prefers_owned_favorite(db, statements):
+    owned, _ = db
+    assert storage.set_favorite_if_owned(CHAT, USER, owned) == "ok"
+    statements.clear()
+    assert storage.get_harem(CHAT, USER)[1] == "FRangiku"
+    assert statements == ["harem"]
+
+def test_fav_owned_card_is_one_round_trip(db, statements):
+    owned, _ = db
+    assert storage.set_favorite_if_owned(CHAT, USER, owned) == "ok"
+    assert statements == ["fav_set_owned"]
+
+def test_fav_miss_on_sqlite_takes_a_second_lookup(db, statements):
+    # SQLite has no data-modifying CTEs: a miss needs one more (in-process) statement to tell
+    # "no such card" from "not owned"; on Postgres fav_set_checked answers both in one
+    _, other = db
+    assert storage.set_favorite_if_owned(CHAT, USER, other) == "not_owned"
+    assert statements == ["fav_set_owned", "character_exists"]
+    statements.clear()
+    assert storage.set_favorite_if_owned(CHAT, USER, 999) == "missing"
+    assert statements == ["fav_set_owned", "character_exists"]
+
+def test_fav_soft_deleted_card_is_missing(db):
+    # the owned copy lingers until the purge; it must not become the favorite meanwhile
+    owned, _ = db
+    assert storage.delete_character(owned)
+    assert storage.set_favorite_if_owned(CHAT, USER, owned) == "missing"
@@ -1,17 +1,35 @@
 import re
+import io
 import time
 import random
 import os
+import threading
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import psycopg
 import telebot
 from telebot import types
+from telebot.handler_backends import BaseMiddleware
+
+import storage
+from storage import (
+    get_character, search_characters_in_db, has_active_spawn, claim_spawn,
+    get_card_global_stats,
+)
 
 # =========================
 # تنظیمات اصلی
 # =========================
 TOKEN = os.environ.get("TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")  # optional read replica
 
 OWNER_ID = 2043594987
 DB_CHANNEL_USERNAME = "@hunter_database"  # کانال دیتابیس
@@ -22,7 +40,7 @@ if not TOKEN:
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL env is missing")
 
-bot = telebot.TeleBot(TOKEN, parse_mode=None)
+bot = telebot.TeleBot(TOKEN, parse_mode=None, use_class_middlewares=True)
 
 # =========================
 # RARITY / EVENTS
@@ -85,87 +103,13 @@ DEFAULT_SPAWN_EVERY = 100
 DEFAULT_SPAWN_ENABLED = True
 
 # =========================
-# DB (Postgres / Neon)
+# DB (Postgres / Neon, or SQLite via DATABASE_URL=sqlite:///file.db)
 # =========================
-def db():
-    # Neon/Postgres
-    return psycopg.connect(DATABASE_URL, autocommit=False)
-
-def init_db():
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS uploaders (
-                tg_id BIGINT PRIMARY KEY,
-                added_by BIGINT NOT NULL,
-                added_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS characters (
-                id BIGSERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                anime TEXT NOT NULL,
-                rarity_key TEXT NOT NULL,
-                event_key TEXT NOT NULL,
-                image_file_id TEXT NOT NULL,
-                channel_msg_id BIGINT,
-                uploaded_by BIGINT NOT NULL,
-                uploaded_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id BIGINT PRIMARY KEY,
-                spawn_enabled BOOLEAN NOT NULL,
-                spawn_every INTEGER NOT NULL,
-                msg_counter BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS active_spawns (
-                chat_id BIGINT PRIMARY KEY,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
-                spawned_msg_id BIGINT NOT NULL,
-                spawned_at BIGINT NOT NULL,
-                claimed_by BIGINT,
-                claimed_at BIGINT
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS inventory (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
-                obtained_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS favorites (
-                user_id BIGINT PRIMARY KEY,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE
-            )
-            """)
-
-            # indexes
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_chat_user ON inventory(chat_id, user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_rarity ON characters(rarity_key)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_name ON characters(name)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_anime ON characters(anime)")
-
-        con.commit()
-
-init_db()
+storage.configure(DATABASE_URL, DATABASE_READ_URL)
+storage.init_db()  # no-op (one SELECT) when the schema is already current
 
 # =========================
-# Resolve DB channel chat_id
+# Resolve DB channel chat_id (lazily, on first channel post — not at boot)
 # =========================
 DB_CHAT_ID = None
 
@@ -179,7 +123,10 @@ def resolve_db_chat_id():
         print("Failed to resolve DB channel id:", e)
         DB_CHAT_ID = DB_CHANNEL_USERNAME
 
-resolve_db_chat_id()
+def db_chat_id():
+    if DB_CHAT_ID is None:
+        resolve_db_chat_id()
+    return DB_CHAT_ID
 
 # =========================
 # Helpers
@@ -190,54 +137,76 @@ def is_owner(uid: int) -> bool:
 def is_uploader(uid: int) -> bool:
     if is_owner(uid):
         return True
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT 1 FROM uploaders WHERE tg_id=%s", (uid,))
-            row = cur.fetchone()
-    return row is not None
+    return storage.uploader_exists(uid)
+
+_WS_RE = re.compile(r"\s+")
 
 def normalize(s: str) -> str:
     s = (s or "").strip().lower()
     s = s.replace("ي", "ی").replace("ك", "ک")
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
-def parse_rarity(line: str):
-    raw = (line or "").strip()
-    t = normalize(raw).replace(":", " ")
-    t = re.sub(r"\s+", " ", t).strip()
+# =========================
+# Rarity / event lookup
+# needles are normalized once at import; common spellings ("🌌 Cosmic", "cosmic",
+# "Halloween 🎃", ...) resolve with one dict hit, anything else falls back to the
+# ordered substring scan (first key in table order wins, as before)
+# =========================
+NO_EVENT_ALIASES = (NO_EVENT_KEY, "noevent", "no event", "none", "null", "-")
 
+_RARITY_NEEDLES = [(key, key, normalize(meta["title"]), meta["emoji"]) for key, meta in RARITIES.items()]
+_EVENT_NEEDLES = [(key, normalize(title)) for key, title in EVENTS.items()]
+
+def _scan_rarity(n: str):
+    t = _WS_RE.sub(" ", n.replace(":", " ")).strip()
     if t in RARITIES:
         return t
-    for key, meta in RARITIES.items():
-        if key in t:
-            return key
-        if normalize(meta["title"]) in t:
-            return key
-        if meta["emoji"] and meta["emoji"] in raw:
+    for key, k, title, emoji in _RARITY_NEEDLES:
+        if k in t or title in t or (emoji and emoji in n):
             return key
     return None
 
-def parse_event_optional(line: str):
-    raw = (line or "").strip()
-    if not raw:
-        return NO_EVENT_KEY
-
-    t = normalize(raw)
-    t = t.replace("event", "").replace(":", " ")
-    t = re.sub(r"\s+", " ", t).strip()
-
-    if t in (NO_EVENT_KEY, "noevent", "no event", "none", "null", "-"):
+def _scan_event(n: str):
+    t = _WS_RE.sub(" ", n.replace("event", "").replace(":", " ")).strip()
+    if t in NO_EVENT_ALIASES:
         return NO_EVENT_KEY
     if t in EVENTS:
         return t
-    for key, title in EVENTS.items():
-        if normalize(title) in normalize(raw):
-            return key
-        if key in t:
+    for key, title in _EVENT_NEEDLES:
+        if title in n or key in t:
             return key
     return NO_EVENT_KEY
 
+def _alias_index(scan, aliases):
+    index = {}
+    for alias in aliases:
+        n = normalize(alias)
+        hit = scan(n)
+        if hit is not None:
+            index.setdefault(n, hit)
+    return index
+
+_RARITY_INDEX = _alias_index(_scan_rarity, [
+    a for key, meta in RARITIES.items()
+    for a in (key, meta["title"], meta["emoji"], f"{meta['emoji']} {meta['title']}", f"{meta['title']} {meta['emoji']}")
+])
+_EVENT_INDEX = _alias_index(_scan_event, [
+    a for key, title in EVENTS.items() for a in (key, title, key.replace("_", " "))
+] + list(NO_EVENT_ALIASES))
+
+def parse_rarity(line: str):
+    n = normalize(line)
+    hit = _RARITY_INDEX.get(n)
+    return hit if hit is not None else _scan_rarity(n)
+
+def parse_event_optional(line: str):
+    n = normalize(line)
+    if not n:
+        return NO_EVENT_KEY
+    hit = _EVENT_INDEX.get(n)
+    return hit if hit is not None else _scan_event(n)
+
 def event_title(key: str) -> str:
     return NO_EVENT_TITLE if key == NO_EVENT_KEY else EVENTS.get(key, NO_EVENT_TITLE)
 
@@ -279,26 +248,6 @@ def extract_card_from_reply(message):
         "file_id": file_id
     }, None
 
-def get_character(char_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT id, name, anime, rarity_key, event_key, image_file_id, channel_msg_id
-                FROM characters WHERE id=%s
-            """, (char_id,))
-            row = cur.fetchone()
-    if not row:
-        return None
-    return {
-        "id": row[0],
-        "name": row[1],
-        "anime": row[2],
-        "rarity_key": row[3],
-        "event_key": row[4],
-        "image_file_id": row[5],
-        "channel_msg_id": row[6],
-    }
-
 def repost_to_channel(char_id: int):
     c = get_character(char_id)
     if not c:
@@ -306,7 +255,7 @@ def repost_to_channel(char_id: int):
 
     if c["channel_msg_id"]:
         try:
-            bot.delete_message(DB_CHAT_ID, c["channel_msg_id"])
+            bot.delete_message(db_chat_id(), c["channel_msg_id"])
         except Exception:
             pass
 
@@ -320,34 +269,12 @@ def repost_to_channel(char_id: int):
         f"[ EVENT : {e_title} ]\n\n"
         "➤ UPDATED/ADDED"
     )
-    sent = bot.send_photo(DB_CHAT_ID, c["image_file_id"], caption=channel_caption)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE characters SET channel_msg_id=%s WHERE id=%s", (sent.message_id, char_id))
-        con.commit()
+    sent = bot.send_photo(db_chat_id(), c["image_file_id"], caption=channel_caption)
+    storage.update_character(char_id, "channel_msg_id", sent.message_id)
 
 # =========================
 # SEARCH HELPERS
 # =========================
-def search_characters_in_db(query: str):
-    q = (query or "").strip()
-    if not q:
-        return []
-    like = f"%{q}%"
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT id, name, anime, rarity_key, event_key, image_file_id
-                FROM characters
-                WHERE LOWER(name) LIKE LOWER(%s)
-                   OR LOWER(anime) LIKE LOWER(%s)
-                ORDER BY id ASC
-            """, (like, like))
-            rows = cur.fetchall()
-    return rows
-
 def short_search_preview(rows, limit=12):
     ids = [str(r[0]) for r in rows[:limit]]
     if not ids:
@@ -361,18 +288,7 @@ def short_search_preview(rows, limit=12):
 # Spawn System
 # =========================
 def get_or_create_chat_settings(chat_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT spawn_enabled, spawn_every, msg_counter FROM chat_settings WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-            if not row:
-                cur.execute("""
-                    INSERT INTO chat_settings (chat_id, spawn_enabled, spawn_every, msg_counter)
-                    VALUES (%s, %s, %s, %s)
-                """, (chat_id, DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY, 0))
-                con.commit()
-                row = (DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY, 0)
-    return {"enabled": bool(row[0]), "every": int(row[1]), "counter": int(row[2])}
+    return storage.get_or_create_chat_settings(chat_id, DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY)
 
 def set_chat_settings(chat_id: int, enabled=None, every=None):
     s = get_or_create_chat_settings(chat_id)
@@ -380,30 +296,17 @@ def set_chat_settings(chat_id: int, enabled=None, every=None):
     every_val = s["every"] if every is None else int(every)
     if every_val < 1:
         every_val = 1
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                UPDATE chat_settings
-                SET spawn_enabled=%s, spawn_every=%s
-                WHERE chat_id=%s
-            """, (enabled_val, every_val, chat_id))
-        con.commit()
+    storage.update_chat_settings(chat_id, enabled_val, every_val)
+    if enabled_val != s["enabled"]:
+        if enabled_val and s["every_seconds"] > 0:
+            due = int(time.time()) + s["every_seconds"]
+            schedule_spawn_timer(chat_id, s["every_seconds"], due)
+            mark_timer_dirty(chat_id, due)
+        elif not enabled_val:
+            cancel_spawn_timer(chat_id)
 
 def increment_counter(chat_id: int):
-    s = get_or_create_chat_settings(chat_id)
-    new_counter = s["counter"] + 1
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE chat_settings SET msg_counter=%s WHERE chat_id=%s", (new_counter, chat_id))
-        con.commit()
-    return new_counter, s["every"], s["enabled"]
-
-def has_active_spawn(chat_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, spawned_msg_id, claimed_by FROM active_spawns WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-    return row
+    return storage.increment_msg_counter(chat_id, DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY)
 
 def weighted_choice_rarity():
     items = [(k, float(v)) for k, v in RARITY_SPAWN_WEIGHTS.items() if float(v) > 0]
@@ -418,29 +321,90 @@ def weighted_choice_rarity():
             return key
     return items[-1][0]
 
-def pick_random_character_by_rarity(rarity_key: str):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT id FROM characters WHERE rarity_key=%s ORDER BY RANDOM() LIMIT 1", (rarity_key,))
-            row = cur.fetchone()
-    return row[0] if row else None
+# =========================
+# Active spawn registry (in-memory, per chat)
+# /hunt guesses are checked here; only the winning guess reaches the DB
+# =========================
+_spawns = {}  # chat_id -> {"char": dict, "name": normalized name, "msg_id": int, "claimed_by": int|None}
+_spawns_lock = threading.Lock()
+
+def register_spawn(chat_id: int, c: dict, msg_id: int, claimed_by=None):
+    with _spawns_lock:
+        _spawns[chat_id] = {"char": c, "name": normalize(c["name"]), "msg_id": msg_id, "claimed_by": claimed_by}
+
+def get_spawn(chat_id: int):
+    return _spawns.get(chat_id)
 
-def pick_random_character_any():
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT id FROM characters ORDER BY RANDOM() LIMIT 1")
-            row = cur.fetchone()
-    return row[0] if row else None
+def reserve_spawn(chat_id: int, char_id: int, user_id: int) -> bool:
+    # first correct guesser wins the in-memory race; everyone else never touches the DB
+    with _spawns_lock:
+        s = _spawns.get(chat_id)
+        if not s or s["char"]["id"] != char_id or s["claimed_by"] is not None:
+            return False
+        s["claimed_by"] = user_id
+        return True
+
+def unreserve_spawn(chat_id: int, char_id: int, user_id: int):
+    # the DB claim failed without deciding anything: give the spawn back to everyone
+    with _spawns_lock:
+        s = _spawns.get(chat_id)
+        if s and s["char"]["id"] == char_id and s["claimed_by"] == user_id:
+            s["claimed_by"] = None
+
+def forget_spawn(chat_id: int, msg_id=None):
+    # msg_id: only forget that exact spawn (a newer one may already have replaced it)
+    with _spawns_lock:
+        s = _spawns.get(chat_id)
+        if s and (msg_id is None or s["msg_id"] == msg_id):
+            del _spawns[chat_id]
+
+def forget_spawns_of_char(char_id: int):
+    with _spawns_lock:
+        for chat_id in [k for k, s in _spawns.items() if s["char"]["id"] == char_id]:
+            del _spawns[chat_id]
+
+def refresh_spawned_char(c: dict):
+    with _spawns_lock:
+        for s in _spawns.values():
+            if s["char"]["id"] == c["id"]:
+                s["char"] = c
+                s["name"] = normalize(c["name"])
+
+def load_spawn_registry():
+    rows = storage.load_active_spawns(my_shard())
+    for chat_id, msg_id, claimed_by, c in rows:
+        register_spawn(chat_id, c, msg_id, claimed_by)
+    print("Spawn registry loaded:", len(rows), "chats")
+
+# one spawn at a time per chat (message counter vs /forcespawn vs other workers)
+_chat_spawn_locks = {}
+_chat_spawn_locks_guard = threading.Lock()
+
+def chat_spawn_lock(chat_id: int) -> threading.Lock:
+    with _chat_spawn_locks_guard:
+        lock = _chat_spawn_locks.get(chat_id)
+        if lock is None:
+            lock = _chat_spawn_locks[chat_id] = threading.Lock()
+        return lock
 
 def spawn_character_in_chat(chat_id: int):
-    active = has_active_spawn(chat_id)
-    if active and active[2] is None:
+    lock = chat_spawn_lock(chat_id)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        return _spawn_locked(chat_id)
+    finally:
+        lock.release()
+
+def _spawn_locked(chat_id: int):
+    active = get_spawn(chat_id)
+    if active and active["claimed_by"] is None:
         return None
 
     rarity_key = weighted_choice_rarity()
-    cid = pick_random_character_by_rarity(rarity_key)
+    cid = storage.pick_random_character_by_rarity(rarity_key)
     if cid is None:
-        cid = pick_random_character_any()
+        cid = storage.pick_random_character_any()
         if cid is None:
             return None
 
@@ -448,108 +412,227 @@ def spawn_character_in_chat(chat_id: int):
     if not c:
         return None
 
+    # reservation row first: another worker racing on this chat backs off before sending anything
+    if not storage.reserve_spawn_slot(chat_id, c["id"]):
+        return None
+
     caption = (
         "✨ A new character has just spawned in the chat!\n"
         "Use /hunt [Name] to hunt them for yourself."
     )
-    msg = bot.send_photo(chat_id, c["image_file_id"], caption=caption)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO active_spawns (chat_id, char_id, spawned_msg_id, spawned_at, claimed_by, claimed_at)
-                VALUES (%s, %s, %s, %s, NULL, NULL)
-                ON CONFLICT (chat_id) DO UPDATE SET
-                    char_id=EXCLUDED.char_id,
-                    spawned_msg_id=EXCLUDED.spawned_msg_id,
-                    spawned_at=EXCLUDED.spawned_at,
-                    claimed_by=NULL,
-                    claimed_at=NULL
-            """, (chat_id, c["id"], msg.message_id, int(time.time())))
-        con.commit()
+    try:
+        msg = bot.send_photo(chat_id, c["image_file_id"], caption=caption)
+    except Exception:
+        storage.release_spawn_reservation(chat_id)
+        raise
+    storage.confirm_spawn(chat_id, c["id"], msg.message_id)
+    register_spawn(chat_id, c, msg.message_id)
 
     return c["id"]
 
-def claim_spawn(chat_id: int, user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, spawned_msg_id, claimed_by FROM active_spawns WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-            if not row:
-                return (False, "❌ No active spawn.")
-            char_id, spawned_msg_id, claimed_by = row
-            if claimed_by is not None:
-                return (False, "❌ This spawn is already claimed.")
-
-            now = int(time.time())
-            cur.execute("UPDATE active_spawns SET claimed_by=%s, claimed_at=%s WHERE chat_id=%s",
-                        (user_id, now, chat_id))
-            cur.execute("INSERT INTO inventory (user_id, chat_id, char_id, obtained_at) VALUES (%s, %s, %s, %s)",
-                        (user_id, chat_id, char_id, now))
-        con.commit()
-    return (True, (char_id, spawned_msg_id))
-
-def name_matches(user_text: str, real_name: str) -> bool:
+def name_matches(user_text: str, normalized_name: str) -> bool:
     u = normalize(user_text)
-    r = normalize(real_name)
     if not u or len(u) < 2:
         return False
-    return (u == r)
+    return (u == normalized_name)
+
+# =========================
+# Spawn admission (global budget)
+# automatic spawns (message counter, timers) go through one fair queue: at most one
+# pending entry per chat, served oldest-first under a token bucket. Over-budget spawns
+# wait instead of being dropped, and handler threads never block on send_photo.
+# =========================
+SPAWN_BUDGET_PER_SEC = float(os.environ.get("SPAWN_BUDGET_PER_SEC", "5"))
+SPAWN_BUDGET_BURST = 10
+if SPAWN_BUDGET_PER_SEC <= 0:
+    raise RuntimeError("SPAWN_BUDGET_PER_SEC must be > 0")
+SPAWN_WORKERS = 4
+
+_spawn_queue = OrderedDict()  # chat_id -> enqueued_at
+_spawn_queue_cv = threading.Condition()
+_spawn_bucket = {"tokens": float(SPAWN_BUDGET_BURST), "at": time.time()}
+_spawn_stats = {"requested": 0, "coalesced": 0, "deferred": 0, "admitted": 0, "wait_total": 0.0, "wait_max": 0.0}
+_spawn_pool = ThreadPoolExecutor(max_workers=SPAWN_WORKERS, thread_name_prefix="spawn")
+
+def _refill_spawn_tokens(now: float) -> float:
+    b = _spawn_bucket
+    b["tokens"] = min(float(SPAWN_BUDGET_BURST), b["tokens"] + (now - b["at"]) * SPAWN_BUDGET_PER_SEC)
+    b["at"] = now
+    return b["tokens"]
+
+def request_spawn(chat_id: int):
+    with _spawn_queue_cv:
+        _spawn_stats["requested"] += 1
+        if chat_id in _spawn_queue:
+            _spawn_stats["coalesced"] += 1
+            return
+        if len(_spawn_queue) + 1 > _refill_spawn_tokens(time.time()):
+            _spawn_stats["deferred"] += 1  # the tokens on hand don't cover everyone queued ahead
+        _spawn_queue[chat_id] = time.time()
+        _spawn_queue_cv.notify()
+
+def run_spawn(chat_id: int):
+    try:
+        spawn_character_in_chat(chat_id)
+    except Exception as e:
+        print("spawn error:", e)
+
+def spawn_admission_loop():
+    while True:
+        with _spawn_queue_cv:
+            while not _spawn_queue:
+                _spawn_queue_cv.wait()
+            now = time.time()
+            tokens = _refill_spawn_tokens(now)
+            if tokens < 1:
+                _spawn_queue_cv.wait((1 - tokens) / SPAWN_BUDGET_PER_SEC)
+                continue
+            _spawn_bucket["tokens"] -= 1
+            chat_id, enqueued_at = _spawn_queue.popitem(last=False)
+            waited = now - enqueued_at
+            _spawn_stats["admitted"] += 1
+            _spawn_stats["wait_total"] += waited
+            _spawn_stats["wait_max"] = max(_spawn_stats["wait_max"], waited)
+        _spawn_pool.submit(run_spawn, chat_id)
+
+def spawn_admission_report() -> str:
+    with _spawn_queue_cv:
+        st = dict(_spawn_stats)
+        queued = len(_spawn_queue)
+        oldest = (time.time() - next(iter(_spawn_queue.values()))) if _spawn_queue else 0.0
+    avg = st["wait_total"] / st["admitted"] if st["admitted"] else 0.0
+    return (
+        f"📈 Spawn queue\n"
+        f"- budget: {SPAWN_BUDGET_PER_SEC:g}/s (burst {SPAWN_BUDGET_BURST})\n"
+        f"- queued: {queued} (oldest {oldest:.1f}s)\n"
+        f"- requested: {st['requested']} | coalesced: {st['coalesced']}\n"
+        f"- admitted: {st['admitted']} | deferred: {st['deferred']}\n"
+        f"- wait avg: {avg:.2f}s | max: {st['wait_max']:.2f}s\n"
+    )
+
+# =========================
+# Timed spawns (spawn_every_seconds)
+# one scheduler thread + a heap of (due, chat_id, gen) over every chat with a timer;
+# firing never reads chat_settings, stale heap entries are skipped by generation,
+# next fire times are written back in batches
+# =========================
+TIMED_SPAWN_MIN_SECONDS = 60
+TIMED_SPAWN_PERSIST_EVERY = 10.0
+TIMED_SPAWN_CATCHUP_SPREAD = 300  # overdue timers after a restart fire spread over this many seconds
+
+_timers = {}       # chat_id -> (every_seconds, gen)
+_timer_heap = []
+_timer_dirty = {}  # chat_id -> next_spawn_at not written yet
+_timer_cv = threading.Condition()
+_timer_gen = itertools.count(1)
+
+def schedule_spawn_timer(chat_id: int, every_seconds: int, due: float):
+    with _timer_cv:
+        gen = next(_timer_gen)
+        _timers[chat_id] = (every_seconds, gen)
+        heapq.heappush(_timer_heap, (due, chat_id, gen))
+        _timer_cv.notify()
+
+def cancel_spawn_timer(chat_id: int):
+    with _timer_cv:
+        _timers.pop(chat_id, None)
+        _timer_dirty.pop(chat_id, None)
+
+def mark_timer_dirty(chat_id: int, due: float):
+    with _timer_cv:
+        _timer_dirty[chat_id] = int(due)
+
+def flush_timer_times():
+    with _timer_cv:
+        rows = [(due, chat_id) for chat_id, due in _timer_dirty.items()]
+        _timer_dirty.clear()
+    if rows:
+        try:
+            storage.save_next_spawn_times(rows)
+        except Exception as e:
+            print("spawn timer persist failed:", e)
+
+def spawn_timer_loop():
+    last_flush = time.time()
+    while True:
+        due_chats = []
+        with _timer_cv:
+            now = time.time()
+            wait = last_flush + TIMED_SPAWN_PERSIST_EVERY - now
+            if _timer_heap:
+                wait = min(wait, _timer_heap[0][0] - now)
+            if wait > 0:
+                _timer_cv.wait(wait)
+                now = time.time()
+            while _timer_heap and _timer_heap[0][0] <= now:
+                due, chat_id, gen = heapq.heappop(_timer_heap)
+                current = _timers.get(chat_id)
+                if current is None or current[1] != gen:
+                    continue
+                every = current[0]
+                nxt = due + every
+                if nxt <= now:
+                    nxt = now + every
+                heapq.heappush(_timer_heap, (nxt, chat_id, gen))
+                _timer_dirty[chat_id] = int(nxt)
+                due_chats.append(chat_id)
+        for chat_id in due_chats:
+            request_spawn(chat_id)
+        if time.time() - last_flush >= TIMED_SPAWN_PERSIST_EVERY:
+            flush_timer_times()
+            last_flush = time.time()
+
+def load_spawn_timers():
+    now = time.time()
+    rows = storage.load_spawn_timers(my_shard())
+    for chat_id, every, next_at in rows:
+        if next_at is None or next_at <= now:
+            due = now + random.uniform(0, min(every, TIMED_SPAWN_CATCHUP_SPREAD))
+        else:
+            due = next_at
+        schedule_spawn_timer(chat_id, every, due)
+    print("Spawn timers loaded:", len(rows), "chats")
+
+# =========================
+# Spawn expiry
+# unclaimed spawns older than SPAWN_TTL_SECONDS are dropped by one DELETE ... RETURNING per sweep
+# =========================
+SPAWN_TTL_SECONDS = int(os.environ.get("SPAWN_TTL_SECONDS", "1800"))  # 0 = never expire
+SPAWN_SWEEP_EVERY = 30
+EXPIRED_EDIT_INTERVAL = 0.05  # keeps caption edits under Telegram's ~30 msg/s bot limit
+EXPIRED_CAPTION = "⌛ This character ran away. Nobody hunted it in time."
+
+def sweep_expired_spawns():
+    rows = storage.expire_spawns(int(time.time()) - SPAWN_TTL_SECONDS, my_shard())
+    for chat_id, char_id, msg_id in rows:
+        forget_spawn(chat_id, msg_id)
+    for chat_id, char_id, msg_id in rows:
+        if not msg_id:
+            continue  # reservation whose send never finished
+        try:
+            bot.edit_message_caption(EXPIRED_CAPTION, chat_id=chat_id, message_id=msg_id)
+        except Exception:
+            pass  # message deleted / too old / bot kicked
+        time.sleep(EXPIRED_EDIT_INTERVAL)
+    return len(rows)
+
+def spawn_sweeper_loop():
+    while True:
+        time.sleep(SPAWN_SWEEP_EVERY)
+        try:
+            n = sweep_expired_spawns()
+            if n:
+                print("expired spawns:", n)
+        except Exception as e:
+            print("spawn sweep error:", e)
 
 # =========================
 # HAREM + FAV helpers
 # =========================
-def get_user_fav_char_id(user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id FROM favorites WHERE user_id=%s", (user_id,))
-            row = cur.fetchone()
-    return int(row[0]) if row else None
-
-def user_owns_char_in_chat(chat_id: int, user_id: int, char_id: int) -> bool:
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT 1 FROM inventory
-                WHERE chat_id=%s AND user_id=%s AND char_id=%s
-                LIMIT 1
-            """, (chat_id, user_id, char_id))
-            ok = cur.fetchone() is not None
-    return ok
-
-def get_harem_cover_file_id(chat_id: int, user_id: int):
-    fav_id = get_user_fav_char_id(user_id)
-    if fav_id and user_owns_char_in_chat(chat_id, user_id, fav_id):
-        c = get_character(fav_id)
-        if c:
-            return c["image_file_id"]
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.image_file_id
-                FROM inventory i
-                JOIN characters c ON c.id=i.char_id
-                WHERE i.chat_id=%s AND i.user_id=%s
-                ORDER BY i.obtained_at DESC
-                LIMIT 1
-            """, (chat_id, user_id))
-            row = cur.fetchone()
-    return row[0] if row else None
-
 def get_user_collection_counts(chat_id: int, user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.anime, c.id, c.name, c.rarity_key, c.event_key, COUNT(*) as cnt
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.chat_id=%s AND i.user_id=%s
-                GROUP BY c.anime, c.id, c.name, c.rarity_key, c.event_key
-                ORDER BY LOWER(c.anime) ASC, c.id ASC
-            """, (chat_id, user_id))
-            rows = cur.fetchall()
+    return group_collection(storage.get_user_collection_rows(chat_id, user_id))
 
+def group_collection(rows):
     if not rows:
         return 0, []
 
@@ -603,37 +686,67 @@ def harem_keyboard(total_unique: int, page: int, total_pages: int, target_user_i
     return kb
 
 def rarity_deck_stats(user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT rarity_key, COUNT(*)
-                FROM characters
-                GROUP BY rarity_key
-            """)
-            total_rows = cur.fetchall()
-            total_map = {rk: int(cnt) for rk, cnt in total_rows}
-
-            cur.execute("""
-                SELECT c.rarity_key, COUNT(DISTINCT i.char_id)
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.user_id=%s
-                GROUP BY c.rarity_key
-            """, (user_id,))
-            owned_rows = cur.fetchall()
-            owned_map = {rk: int(cnt) for rk, cnt in owned_rows}
-
-    for rk in RARITIES.keys():
-        total_map.setdefault(rk, 0)
-        owned_map.setdefault(rk, 0)
-
-    return total_map, owned_map
+    return storage.rarity_deck_stats(user_id, RARITIES.keys())
+
+# =========================
+# Command router
+# one telebot handler for every "/command": the first token is split off once,
+# commands addressed to another bot (@otherbot) are ignored, dispatch is a dict
+# lookup, and the handler gets the rest of the text as `args` ("" if none)
+# =========================
+COMMANDS = {}
+
+def command(*names):
+    def register(fn):
+        for name in names:
+            COMMANDS[name] = fn
+        return fn
+    return register
+
+BOT_USERNAME = None
+
+def bot_username() -> str:
+    global BOT_USERNAME
+    if BOT_USERNAME is None:
+        try:
+            BOT_USERNAME = (bot.get_me().username or "").lower()
+        except Exception as e:
+            print("Failed to resolve bot username:", e)
+            return ""
+    return BOT_USERNAME
+
+def split_command(text: str):
+    # "/Hunt@HunterBot  Rangiku" -> ("hunt", "hunterbot", "Rangiku")
+    parts = text.split(None, 1)
+    name, _, target = parts[0][1:].partition("@")
+    return name.lower(), target.lower(), (parts[1].strip() if len(parts) > 1 else "")
+
+BUSY_REPLY = "⏳ The database is busy right now, please try again in a moment."
+
+def int_arg(args: str):
+    return int(args) if args.isdecimal() else None
+
+@bot.message_handler(func=lambda m: m.text.startswith("/"), content_types=["text"])
+def route_command(message):
+    name, target, args = split_command(message.text)
+    if target and bot_username() and target != bot_username():
+        return
+    handler = COMMANDS.get(name)
+    if not handler:
+        return
+    try:
+        handler(message, args)
+    except Exception as e:
+        if not storage.is_timeout(e):
+            raise
+        print(f"/{name} timed out:", e)
+        bot.reply_to(message, BUSY_REPLY)
 
 # =========================
 # Commands
 # =========================
-@bot.message_handler(commands=["start"])
-def start(message):
+@command("start")
+def start(message, args: str):
     role = "OWNER" if is_owner(message.from_user.id) else ("UPLOADER" if is_uploader(message.from_user.id) else "USER")
     bot.reply_to(
         message,
@@ -642,19 +755,24 @@ def start(message):
         "- /hunt Name   (example: /hunt Rangiku)\n"
         "- /harem (or reply to someone: /harem)\n"
         "- /fav ID   (set harem cover)\n"
-        "- /search text (search cards in DB)\n\n"
+        "- /search text (search cards in DB)\n"
+        "- /top | /topchat [cards|unique|score]\n\n"
         "Owner (spawn settings per chat):\n"
         "- /changetime 20\n"
         "- /spawn on | /spawn off\n"
+        "- /spawntimer 600 | /spawntimer off\n"
         "- /spawnstatus\n"
         "- /forcespawn\n"
         "- /clearspawn\n"
-        "- /reset (reply to user)\n\n"
+        "- /spawnqueue\n"
+        "- /reset (reply to user)\n"
+        "- /resetchat (all collections in this group)\n\n"
         "Uploader:\n"
         "- reply /upload\n"
         "- reply /uploadid 25\n\n"
         "Owner edit:\n"
         "- /delete 25\n"
+        "- /deletestatus\n"
         "- /update 25 name New Name\n"
         "- /update 25 anime New Anime\n"
         "- /update 25 rarity 🌌 Cosmic\n"
@@ -662,22 +780,23 @@ def start(message):
         "- reply /updatephoto 25\n"
         "- /check 25\n"
         "- /rarity\n"
+        "- /profile 200   (profile next N updates)\n"
+        "- /dbstats\n"
     )
 
-@bot.message_handler(commands=["ping"])
-def ping(message):
+@command("ping")
+def ping(message, args: str):
     bot.reply_to(message, "🏓 Pong!")
 
 # =========================
 # /search
 # =========================
-@bot.message_handler(regexp=r"^/search(\s+.+)?$")
-def search_cmd(message):
-    m = re.match(r"^/search\s+(.+)$", (message.text or "").strip(), flags=re.I)
-    if not m:
+@command("search")
+def search_cmd(message, args: str):
+    if not args:
         return bot.reply_to(message, "Usage: /search NameOrAnime\nExample: /search Rangiku")
 
-    q = m.group(1).strip()
+    q = args
     rows = search_characters_in_db(q)
 
     kb = types.InlineKeyboardMarkup()
@@ -698,39 +817,63 @@ def search_cmd(message):
 # =========================
 # Spawn settings (Owner)
 # =========================
-@bot.message_handler(regexp=r"^/changetime(\s+\d+)?$")
-def changetime(message):
+@command("changetime")
+def changetime(message, args: str):
     if not is_owner(message.from_user.id):
         return
     if message.chat.type not in ("group", "supergroup"):
         return bot.reply_to(message, "Use in group.")
-    m = re.match(r"^/changetime\s+(\d+)$", (message.text or "").strip())
-    if not m:
+    n = int_arg(args)
+    if n is None:
         return bot.reply_to(message, "Usage: /changetime 20")
-    n = int(m.group(1))
     if n < 1:
         return bot.reply_to(message, "❌ عدد باید حداقل 1 باشه.")
     set_chat_settings(message.chat.id, every=n)
     bot.reply_to(message, f"✅ Spawn interval set to every {n} messages (this chat).")
 
-@bot.message_handler(regexp=r"^/spawn(\s+(on|off))?$")
-def spawn_toggle(message):
+@command("spawn")
+def spawn_toggle(message, args: str):
     if not is_owner(message.from_user.id):
         return
     if message.chat.type not in ("group", "supergroup"):
         return bot.reply_to(message, "Use in group.")
-    m = re.match(r"^/spawn\s+(on|off)$", (message.text or "").strip())
-    if not m:
+    if args not in ("on", "off"):
         return bot.reply_to(message, "Usage: /spawn on  OR  /spawn off")
-    val = (m.group(1) == "on")
+    val = (args == "on")
     set_chat_settings(message.chat.id, enabled=val)
     bot.reply_to(message, f"✅ Spawn {'enabled' if val else 'disabled'} for this chat.")
 
+@command("spawntimer")
+def spawn_timer_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return
+    if message.chat.type not in ("group", "supergroup"):
+        return bot.reply_to(message, "Use in group.")
+    n = int_arg(args)
+    if n is None and args != "off":
+        return bot.reply_to(message, "Usage: /spawntimer 600  OR  /spawntimer off")
+    chat_id = message.chat.id
+    s = get_or_create_chat_settings(chat_id)
+    if args == "off":
+        storage.set_spawn_timer(chat_id, 0, None)
+        cancel_spawn_timer(chat_id)
+        return bot.reply_to(message, "✅ Timed spawn disabled for this chat.")
+    if n < TIMED_SPAWN_MIN_SECONDS:
+        return bot.reply_to(message, f"❌ Minimum is {TIMED_SPAWN_MIN_SECONDS} seconds.")
+    due = int(time.time()) + n
+    storage.set_spawn_timer(chat_id, n, due)
+    if s["enabled"]:
+        schedule_spawn_timer(chat_id, n, due)
+    txt = f"✅ Timed spawn every {n} seconds (this chat)."
+    if not s["enabled"]:
+        txt += "\n⚠️ Spawn is off here; it starts after /spawn on."
+    bot.reply_to(message, txt)
+
 # =========================
 # Spawn debug (Owner)
 # =========================
-@bot.message_handler(commands=["spawnstatus"])
-def spawn_status(message):
+@command("spawnstatus")
+def spawn_status(message, args: str):
     if message.chat.type not in ("group", "supergroup"):
         return bot.reply_to(message, "Use in group.")
     s = get_or_create_chat_settings(message.chat.id)
@@ -741,17 +884,19 @@ def spawn_status(message):
         f"- enabled: {s['enabled']}\n"
         f"- every: {s['every']}\n"
         f"- counter: {s['counter']}\n"
+        f"- every_seconds: {s['every_seconds'] or 'off'}\n"
     )
     if active:
         txt += f"- active_spawn: YES | char_id={active[0]} | claimed_by={active[2]}\n"
         if active[2] is None:
-            txt += "⚠️ Active spawn is UNCLAIMED → new spawns are blocked until hunted.\n"
+            txt += "⚠️ Active spawn is UNCLAIMED → new spawns are blocked until hunted"
+            txt += f" or expired ({SPAWN_TTL_SECONDS}s).\n" if SPAWN_TTL_SECONDS > 0 else ".\n"
     else:
         txt += "- active_spawn: NO\n"
     bot.reply_to(message, txt)
 
-@bot.message_handler(commands=["forcespawn"])
-def force_spawn(message):
+@command("forcespawn")
+def force_spawn(message, args: str):
     if not is_owner(message.from_user.id):
         return
     if message.chat.type not in ("group", "supergroup"):
@@ -765,56 +910,110 @@ def force_spawn(message):
     except Exception as e:
         bot.reply_to(message, f"❌ Force spawn error:\n{e}")
 
-@bot.message_handler(commands=["clearspawn"])
-def clear_spawn(message):
+@command("spawnqueue")
+def spawn_queue_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return
+    bot.reply_to(message, spawn_admission_report())
+
+@command("clearspawn")
+def clear_spawn(message, args: str):
     if not is_owner(message.from_user.id):
         return
     if message.chat.type not in ("group", "supergroup"):
         return bot.reply_to(message, "Use in group.")
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM active_spawns WHERE chat_id=%s", (message.chat.id,))
-        con.commit()
+    storage.clear_active_spawn(message.chat.id)
+    forget_spawn(message.chat.id)
     bot.reply_to(message, "✅ Active spawn cleared for this chat.")
 
+# =========================
+# Failed /hunt feedback (coalesced per chat)
+# the first HUNT_FEEDBACK_DIRECT failures in a window get a normal reply,
+# the rest are folded into one summary message when the window closes
+# =========================
+HUNT_FEEDBACK_WINDOW = 5.0
+HUNT_FEEDBACK_DIRECT = 2
+HUNT_FEEDBACK_NAMES = 5
+
+HUNT_FAIL_TEXT = {
+    "no_spawn": "❌ No active spawn right now.",
+    "claimed": "❌ This character is already claimed.",
+    "wrong": "❌ Wrong name!",
+}
+HUNT_FAIL_SUMMARY = {
+    "no_spawn": "No active spawn",
+    "claimed": "Already claimed",
+    "wrong": "Wrong name",
+}
+
+_hunt_feedback = {}  # chat_id -> {"started": ts, "direct": n, "pending": {reason: [names]}, "timer": Timer|None}
+_hunt_feedback_lock = threading.Lock()
+
+def hunt_fail_reply(message, reason: str):
+    chat_id = message.chat.id
+    now = time.time()
+    direct = False
+    with _hunt_feedback_lock:
+        st = _hunt_feedback.get(chat_id)
+        if st is None or (not st["pending"] and now - st["started"] >= HUNT_FEEDBACK_WINDOW):
+            st = {"started": now, "direct": 0, "pending": {}, "timer": None}
+            _hunt_feedback[chat_id] = st
+        if st["direct"] < HUNT_FEEDBACK_DIRECT:
+            st["direct"] += 1
+            direct = True
+        else:
+            st["pending"].setdefault(reason, []).append(message.from_user.first_name or "Player")
+            if st["timer"] is None:
+                delay = max(0.0, st["started"] + HUNT_FEEDBACK_WINDOW - now)
+                st["timer"] = threading.Timer(delay, flush_hunt_feedback, args=(chat_id,))
+                st["timer"].daemon = True
+                st["timer"].start()
+    if direct:
+        bot.reply_to(message, HUNT_FAIL_TEXT[reason])
+
+def flush_hunt_feedback(chat_id: int):
+    with _hunt_feedback_lock:
+        st = _hunt_feedback.pop(chat_id, None)
+    if not st or not st["pending"]:
+        return
+    total = sum(len(v) for v in st["pending"].values())
+    lines = [f"❌ {total} more failed /hunt attempts:"]
+    for reason, names in st["pending"].items():
+        shown = ", ".join(names[:HUNT_FEEDBACK_NAMES])
+        more = f" +{len(names) - HUNT_FEEDBACK_NAMES}" if len(names) > HUNT_FEEDBACK_NAMES else ""
+        lines.append(f"- {HUNT_FAIL_SUMMARY[reason]} ×{len(names)} ({shown}{more})")
+    try:
+        bot.send_message(chat_id, "\n".join(lines))
+    except Exception as e:
+        print("hunt feedback send failed:", e)
+
 # =========================
 # Hunt (Players)
 # =========================
-@bot.message_handler(regexp=r"^/hunt(\s+.+)?$")
-def hunt_cmd(message):
+@command("hunt")
+def hunt_cmd(message, args: str):
     if message.chat.type == "private":
         return bot.reply_to(message, "❌ /hunt works only inside groups.")
 
-    m = re.match(r"^/hunt\s+(.+)$", (message.text or "").strip())
-    if not m:
+    if not args:
         return bot.reply_to(message, "Usage: /hunt Name\nExample: /hunt Rangiku")
 
-    guess = m.group(1).strip()
+    guess = args
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, claimed_by FROM active_spawns WHERE chat_id=%s", (message.chat.id,))
-            row = cur.fetchone()
+    spawn = get_spawn(message.chat.id)
+    if not spawn:
+        return hunt_fail_reply(message, "no_spawn")
 
-    if not row:
-        return bot.reply_to(message, "❌ No active spawn right now.")
+    if spawn["claimed_by"] is not None:
+        return hunt_fail_reply(message, "claimed")
 
-    char_id, claimed_by = row
-    if claimed_by is not None:
-        return bot.reply_to(message, "❌ This character is already claimed.")
-
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ Spawn data not found.")
+    if not name_matches(guess, spawn["name"]):
+        return hunt_fail_reply(message, "wrong")
 
-    if not name_matches(guess, c["name"]):
-        return bot.reply_to(message, "❌ Wrong name!")
+    c = spawn["char"]
 
     # GLOBAL CAPACITY 25
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE user_id=%s", (message.from_user.id,))
-            count = int(cur.fetchone()[0] or 0)
+    count = storage.count_user_inventory(message.from_user.id)
 
     MAX_CAPACITY = 25
     if count >= MAX_CAPACITY:
@@ -825,9 +1024,20 @@ def hunt_cmd(message):
             "You can't hunt more characters until the Owner resets your storage."
         )
 
-    ok, info = claim_spawn(message.chat.id, message.from_user.id)
+    if not reserve_spawn(message.chat.id, c["id"], message.from_user.id):
+        return hunt_fail_reply(message, "claimed")
+
+    try:
+        ok, info = claim_spawn(message.chat.id, message.from_user.id, expected_char_id=c["id"],
+                               name=message.from_user.first_name)
+    except Exception:
+        unreserve_spawn(message.chat.id, c["id"], message.from_user.id)
+        raise
     if not ok:
+        # DB disagrees (cleared / claimed elsewhere) -> DB wins, drop the stale entry
+        forget_spawn(message.chat.id)
         return bot.reply_to(message, info)
+    leaderboard_claimed(message.from_user.id, message.from_user.first_name, info[2])
 
     r = RARITIES[c["rarity_key"]]
     e_title = event_title(c["event_key"])
@@ -839,8 +1049,8 @@ def hunt_cmd(message):
         f"{r['emoji']} {r['title']} | Event: {e_title}"
     )
 
-@bot.message_handler(commands=["reset"])
-def reset_collection(message):
+@command("reset")
+def reset_collection(message, args: str):
     if not is_owner(message.from_user.id):
         return bot.reply_to(message, "⛔ Only the Owner can use this command.")
 
@@ -851,12 +1061,8 @@ def reset_collection(message):
         target_id = message.from_user.id
         target_name = message.from_user.first_name
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE user_id=%s", (target_id,))
-            total = int(cur.fetchone()[0] or 0)
-            cur.execute("DELETE FROM inventory WHERE user_id=%s", (target_id,))
-        con.commit()
+    total = storage.reset_user_inventory(target_id)
+    leaderboard_invalidate()
 
     bot.reply_to(
         message,
@@ -865,38 +1071,76 @@ def reset_collection(message):
         f"They can now collect up to 25 new characters again."
     )
 
+@command("resetchat")
+def reset_chat_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return bot.reply_to(message, "⛔ Only the Owner can use this command.")
+
+    chat_id = int(args) if args.lstrip("-").isdigit() else None
+    if chat_id is None:
+        if message.chat.type == "private":
+            return bot.reply_to(message, "Usage: /resetchat (inside the group) or /resetchat <chat_id>")
+        chat_id = message.chat.id
+
+    cards, players = storage.reset_chat_inventory(chat_id)
+    leaderboard_invalidate(chat_id)
+    bot.reply_to(
+        message,
+        f"♻️ All collections in this group have been reset.\n"
+        f"{cards} cards removed from {players} players."
+    )
+
+# old-epoch rows left by /reset and /resetchat, and copies of /delete'd cards,
+# are deleted a batch at a time
+CLEANUP_IDLE = 30.0
+CLEANUP_PAUSE = 0.2
+
+def cleanup_loop():
+    while True:
+        try:
+            busy = storage.reclaim_reset_rows() or purge_deleted_batch()
+        except Exception as e:
+            print("background cleanup failed:", e)
+            busy = 0
+        time.sleep(CLEANUP_PAUSE if busy else CLEANUP_IDLE)
+
+def purge_deleted_batch() -> bool:
+    done = storage.purge_deleted_characters()
+    if not done:
+        return False
+    char_id, name, deleted, finished = done
+    if deleted:
+        leaderboard_invalidate()
+    if finished:
+        try:
+            bot.send_message(OWNER_ID, f"🗑 #{char_id} {name} is fully deleted from all collections.")
+        except Exception:
+            pass
+    return True
+
 # =========================
 # /fav
 # =========================
-@bot.message_handler(regexp=r"^/fav(\s+\d+)?$")
-def fav_cmd(message):
+@command("fav")
+def fav_cmd(message, args: str):
     if message.chat.type == "private":
         return bot.reply_to(message, "❌ /fav فقط داخل گروه کار می‌کنه.")
-    m = re.match(r"^/fav\s+(\d+)$", (message.text or "").strip())
-    if not m:
+    cid = int_arg(args)
+    if cid is None:
         return bot.reply_to(message, "Usage: /fav ID (مثال: /fav 25)")
-    cid = int(m.group(1))
-    if not get_character(cid):
+    status = storage.set_favorite_if_owned(message.chat.id, message.from_user.id, cid)
+    if status == "missing":
         return bot.reply_to(message, "❌ این ID وجود نداره.")
-    if not user_owns_char_in_chat(message.chat.id, message.from_user.id, cid):
+    if status == "not_owned":
         return bot.reply_to(message, "❌ این کارت رو توی همین گروه نداری.")
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO favorites (user_id, char_id)
-                VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET char_id=EXCLUDED.char_id
-            """, (message.from_user.id, cid))
-        con.commit()
-
     bot.reply_to(message, f"✅ Favorite set to #{cid} (for your /harem cover).")
 
 # =========================
 # /harem
 # =========================
-@bot.message_handler(commands=["harem"])
-def harem_cmd(message):
+@command("harem")
+def harem_cmd(message, args: str):
     if message.chat.type == "private":
         return bot.reply_to(message, "❌ /harem فقط داخل گروه کار می‌کنه.")
 
@@ -907,11 +1151,11 @@ def harem_cmd(message):
         target_user_id = message.reply_to_message.from_user.id
         target_name = message.reply_to_message.from_user.first_name
 
-    total_unique, per_anime = get_user_collection_counts(message.chat.id, target_user_id)
+    rows, cover = storage.get_harem(message.chat.id, target_user_id)
+    total_unique, per_anime = group_collection(rows)
     if total_unique == 0:
         return bot.reply_to(message, "You Have Not Hunted any Characters Yet.")
 
-    cover = get_harem_cover_file_id(message.chat.id, target_user_id)
     text, total_pages, page = render_harem_page(target_name, total_unique, per_anime, page=1)
     kb = harem_keyboard(total_unique, page, total_pages, target_user_id)
 
@@ -931,7 +1175,12 @@ def harem_page_callback(call):
 
     chat_id = call.message.chat.id
 
-    total_unique, per_anime = get_user_collection_counts(chat_id, target_user_id)
+    try:
+        total_unique, per_anime = get_user_collection_counts(chat_id, target_user_id)
+    except Exception as e:
+        if not storage.is_timeout(e):
+            raise
+        return bot.answer_callback_query(call.id, BUSY_REPLY)
     if total_unique == 0:
         bot.answer_callback_query(call.id, "No cards.")
         try:
@@ -1033,17 +1282,7 @@ def inline_handler(inline_query):
     else:
         target_user_id = inline_query.from_user.id
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id, COUNT(*) as cnt
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.user_id=%s
-                GROUP BY c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id
-                ORDER BY c.id ASC
-            """, (target_user_id,))
-            rows = cur.fetchall()
+    rows = storage.get_user_cards(target_user_id)
 
     if not rows:
         results = [
@@ -1091,59 +1330,38 @@ def inline_handler(inline_query):
 # =========================
 # Uploader/Admin management
 # =========================
-@bot.message_handler(commands=["adduploader"])
-def add_uploader(message):
+@command("adduploader")
+def add_uploader(message, args: str):
     if not is_owner(message.from_user.id):
         return bot.reply_to(message, "⛔ فقط Owner.")
     if not message.reply_to_message:
         return bot.reply_to(message, "❌ روی پیام شخص ریپلای کن بعد /adduploader بزن.")
     target = message.reply_to_message.from_user
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO uploaders (tg_id, added_by, added_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (tg_id) DO NOTHING
-            """, (target.id, OWNER_ID, int(time.time())))
-        con.commit()
+    storage.add_uploader(target.id, OWNER_ID)
     bot.reply_to(message, f"✅ Uploader added: {target.first_name} (ID: {target.id})")
 
-@bot.message_handler(commands=["deluploader"])
-def del_uploader(message):
+@command("deluploader")
+def del_uploader(message, args: str):
     if not is_owner(message.from_user.id):
         return bot.reply_to(message, "⛔ فقط Owner.")
     if not message.reply_to_message:
         return bot.reply_to(message, "❌ روی پیام شخص ریپلای کن بعد /deluploader بزن.")
     target = message.reply_to_message.from_user
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM uploaders WHERE tg_id=%s", (target.id,))
-        con.commit()
+    storage.remove_uploader(target.id)
     bot.reply_to(message, f"🗑 Uploader removed: {target.first_name} (ID: {target.id})")
 
 # =========================
 # Upload / UploadID
 # =========================
-@bot.message_handler(commands=["upload"])
-def upload_auto(message):
+@command("upload")
+def upload_auto(message, args: str):
     if not is_uploader(message.from_user.id):
         return bot.reply_to(message, "⛔ You are not an uploader.")
     card, err = extract_card_from_reply(message)
     if err:
         return bot.reply_to(message, err)
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO characters (name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                card["name"], card["anime"], card["rarity_key"], card["event_key"],
-                card["file_id"], message.from_user.id, int(time.time())
-            ))
-            new_id = int(cur.fetchone()[0])
-        con.commit()
+    new_id = storage.insert_character(card, message.from_user.id)
 
     try:
         repost_to_channel(new_id)
@@ -1151,14 +1369,13 @@ def upload_auto(message):
     except Exception as ex:
         bot.reply_to(message, f"✅ Uploaded #{new_id} (DB saved)\n⚠️ Channel post failed:\n{ex}")
 
-@bot.message_handler(regexp=r"^/uploadid(\s+\d+)?$")
-def upload_manual_id(message):
+@command("uploadid")
+def upload_manual_id(message, args: str):
     if not is_uploader(message.from_user.id):
         return bot.reply_to(message, "⛔ You are not an uploader.")
-    m = re.match(r"^/uploadid\s+(\d+)$", (message.text or "").strip())
-    if not m:
+    desired_id = int_arg(args)
+    if desired_id is None:
         return bot.reply_to(message, "Usage: /uploadid 25 (reply to photo)")
-    desired_id = int(m.group(1))
     if desired_id <= 0:
         return bot.reply_to(message, "❌ ID باید مثبت باشه.")
 
@@ -1166,20 +1383,8 @@ def upload_manual_id(message):
     if err:
         return bot.reply_to(message, err)
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT 1 FROM characters WHERE id=%s", (desired_id,))
-            if cur.fetchone():
-                return bot.reply_to(message, f"❌ ID {desired_id} قبلاً وجود داره.")
-
-            cur.execute("""
-                INSERT INTO characters (id, name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                desired_id, card["name"], card["anime"], card["rarity_key"], card["event_key"],
-                card["file_id"], message.from_user.id, int(time.time())
-            ))
-        con.commit()
+    if not storage.insert_character_with_id(desired_id, card, message.from_user.id):
+        return bot.reply_to(message, f"❌ ID {desired_id} قبلاً وجود داره.")
 
     try:
         repost_to_channel(desired_id)
@@ -1190,49 +1395,57 @@ def upload_manual_id(message):
 # =========================
 # Delete
 # =========================
-@bot.message_handler(regexp=r"^/delete(\s+\d+)?$")
-def delete_character_cmd(message):
+@command("delete")
+def delete_character_cmd(message, args: str):
     if not is_owner(message.from_user.id):
         return
-    m = re.match(r"^/delete\s+(\d+)$", (message.text or "").strip())
-    if not m:
+    char_id = int_arg(args)
+    if char_id is None:
         return bot.reply_to(message, "Usage: /delete 25")
-    char_id = int(m.group(1))
     c = get_character(char_id)
     if not c:
         return bot.reply_to(message, "❌ not found.")
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM characters WHERE id=%s", (char_id,))
-            cur.execute("DELETE FROM inventory WHERE char_id=%s", (char_id,))
-            cur.execute("DELETE FROM active_spawns WHERE char_id=%s", (char_id,))
-        con.commit()
+    storage.delete_character(char_id)
+    forget_spawns_of_char(char_id)
 
     if c["channel_msg_id"]:
         try:
-            bot.delete_message(DB_CHAT_ID, c["channel_msg_id"])
+            bot.delete_message(db_chat_id(), c["channel_msg_id"])
         except Exception:
             pass
 
-    bot.reply_to(message, f"🗑 Deleted #{char_id} ✅")
+    bot.reply_to(message, f"🗑 Deleted #{char_id} ✅\nCopies in collections are being removed in the background (/deletestatus).")
+
+@command("deletestatus")
+def delete_status_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return
+    rows = storage.pending_deletions()
+    if not rows:
+        return bot.reply_to(message, "✅ No deletions in progress.")
+    now = int(time.time())
+    lines = ["🗑 Deletions in progress:"]
+    for char_id, name, deleted_at, left in rows:
+        lines.append(f"- #{char_id} {name}: {left} collection rows left ({(now - deleted_at) // 60} min ago)")
+    bot.reply_to(message, "\n".join(lines))
 
 # =========================
 # Update fields + Update photo
 # =========================
-@bot.message_handler(regexp=r"^/update(\s+.+)?$")
-def update_field_cmd(message):
+@command("update")
+def update_field_cmd(message, args: str):
     if not is_owner(message.from_user.id):
         return
-    parts = (message.text or "").strip().split(maxsplit=3)
-    if len(parts) < 4:
+    parts = args.split(maxsplit=2)
+    if len(parts) < 3:
         return bot.reply_to(message,
                             "Usage:\n"
                             "/update 25 name New Name\n"
                             "/update 25 anime New Anime\n"
                             "/update 25 rarity 🌌 Cosmic\n"
                             "/update 25 event none")
-    _, sid, field, new_value = parts
+    sid, field, new_value = parts
     try:
         char_id = int(sid)
     except:
@@ -1243,23 +1456,24 @@ def update_field_cmd(message):
 
     field = field.lower().strip()
 
-    with db() as con:
-        with con.cursor() as cur:
-            if field == "name":
-                cur.execute("UPDATE characters SET name=%s WHERE id=%s", (new_value.strip(), char_id))
-            elif field == "anime":
-                cur.execute("UPDATE characters SET anime=%s WHERE id=%s", (new_value.strip(), char_id))
-            elif field == "rarity":
-                rk = parse_rarity(new_value)
-                if not rk:
-                    return bot.reply_to(message, "❌ Rarity نامعتبره. مثال: 🌌 Cosmic")
-                cur.execute("UPDATE characters SET rarity_key=%s WHERE id=%s", (rk, char_id))
-            elif field == "event":
-                ek = parse_event_optional(new_value)
-                cur.execute("UPDATE characters SET event_key=%s WHERE id=%s", (ek, char_id))
-            else:
-                return bot.reply_to(message, "❌ field فقط: name | anime | rarity | event")
-        con.commit()
+    if field == "name":
+        storage.update_character(char_id, "name", new_value.strip())
+    elif field == "anime":
+        storage.update_character(char_id, "anime", new_value.strip())
+    elif field == "rarity":
+        rk = parse_rarity(new_value)
+        if not rk:
+            return bot.reply_to(message, "❌ Rarity نامعتبره. مثال: 🌌 Cosmic")
+        storage.update_character(char_id, "rarity_key", rk)
+    elif field == "event":
+        ek = parse_event_optional(new_value)
+        storage.update_character(char_id, "event_key", ek)
+    else:
+        return bot.reply_to(message, "❌ field فقط: name | anime | rarity | event")
+
+    updated = get_character(char_id)
+    if updated:
+        refresh_spawned_char(updated)
 
     try:
         repost_to_channel(char_id)
@@ -1268,14 +1482,13 @@ def update_field_cmd(message):
 
     bot.reply_to(message, f"✅ Updated #{char_id} ({field})")
 
-@bot.message_handler(regexp=r"^/updatephoto(\s+\d+)?$")
-def update_photo_cmd(message):
+@command("updatephoto")
+def update_photo_cmd(message, args: str):
     if not is_owner(message.from_user.id):
         return
-    m = re.match(r"^/updatephoto\s+(\d+)$", (message.text or "").strip())
-    if not m:
+    char_id = int_arg(args)
+    if char_id is None:
         return bot.reply_to(message, "Usage: reply to NEW photo: /updatephoto 25")
-    char_id = int(m.group(1))
     c = get_character(char_id)
     if not c:
         return bot.reply_to(message, "❌ not found.")
@@ -1283,10 +1496,7 @@ def update_photo_cmd(message):
         return bot.reply_to(message, "❌ باید روی عکس جدید ریپلای کنی.")
     new_file_id = message.reply_to_message.photo[-1].file_id
 
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE characters SET image_file_id=%s WHERE id=%s", (new_file_id, char_id))
-        con.commit()
+    storage.update_character(char_id, "image_file_id", new_file_id)
 
     try:
         repost_to_channel(char_id)
@@ -1298,8 +1508,8 @@ def update_photo_cmd(message):
 # =========================
 # /rarity
 # =========================
-@bot.message_handler(commands=["rarity"])
-def rarity_cmd(message):
+@command("rarity")
+def rarity_cmd(message, args: str):
     user_id = message.from_user.id
     total_map, owned_map = rarity_deck_stats(user_id)
 
@@ -1329,34 +1539,12 @@ def rarity_cmd(message):
 # =========================
 # /check
 # =========================
-def get_card_global_stats(char_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE char_id=%s", (char_id,))
-            total_copies = int(cur.fetchone()[0] or 0)
-
-            cur.execute("SELECT COUNT(DISTINCT user_id) FROM inventory WHERE char_id=%s", (char_id,))
-            total_unique_users = int(cur.fetchone()[0] or 0)
-
-            cur.execute("""
-                SELECT user_id, COUNT(*) as cnt
-                FROM inventory
-                WHERE char_id=%s
-                GROUP BY user_id
-                ORDER BY cnt DESC
-                LIMIT 10
-            """, (char_id,))
-            top_users = cur.fetchall()
-
-    return total_copies, total_unique_users, top_users
-
-@bot.message_handler(regexp=r"^/check(\s+\d+)?$")
-def check_cmd(message):
-    m = re.match(r"^/check\s+(\d+)$", (message.text or "").strip())
-    if not m:
+@command("check")
+def check_cmd(message, args: str):
+    char_id = int_arg(args)
+    if char_id is None:
         return bot.reply_to(message, "Usage: /check 25")
 
-    char_id = int(m.group(1))
     c = get_character(char_id)
     if not c:
         return bot.reply_to(message, "❌ Character not found.")
@@ -1399,1447 +1587,566 @@ def check_cmd(message):
         bot.reply_to(message, text)
 
 # =========================
-# Message counter -> spawn every N messages
+# /top (all chats) + /topchat (this group)
+# boards hold the top LEADERBOARD_KEEP players per metric of one scope, loaded from
+# storage's player_stats counters and kept sorted in memory. A claim in this process
+# moves the claimer in place (counters only grow); resets/purges drop boards instead,
+# and claims made by other shard workers show up after LEADERBOARD_REFRESH.
 # =========================
-@bot.message_handler(func=lambda m: True, content_types=["text", "photo", "sticker", "video", "animation", "document"])
-def every_message_counter(message):
-    if message.chat.type not in ("group", "supergroup"):
-        return
+LEADERBOARD_METRICS = {
+    "cards": "📦 Total cards",
+    "uniques": "🃏 Unique cards",
+    "score": "⭐ Rarity score",
+}
+LEADERBOARD_ALIASES = {"total": "cards", "unique": "uniques", "rarity": "score"}
+LEADERBOARD_SHOW = 10
+LEADERBOARD_KEEP = 50
+LEADERBOARD_REFRESH = 120.0
+LEADERBOARD_MAX_BOARDS = 512
+
+class Leaderboard:
+    def __init__(self, scope: int):
+        self.loaded_at = time.monotonic()
+        self.players = {}  # user_id -> [name, cards, uniques, score]
+        self.ranks = {}    # metric -> sorted [(-value, user_id)], at most LEADERBOARD_KEEP
+        for pos, metric in enumerate(LEADERBOARD_METRICS, start=1):
+            rows = storage.top_players(scope, metric, LEADERBOARD_KEEP)
+            for user_id, name, cards, uniques, score in rows:
+                self.players[user_id] = [name, cards, uniques, score]
+            self.ranks[metric] = sorted((-r[pos + 1], r[0]) for r in rows)
+
+    def update(self, user_id: int, name, values):
+        old = self.players.get(user_id)
+        entry = [name or (old[0] if old else None), *values]
+        ranked = False
+        for pos, metric in enumerate(LEADERBOARD_METRICS, start=1):
+            ranks = self.ranks[metric]
+            if old:
+                key = (-old[pos], user_id)
+                i = bisect.bisect_left(ranks, key)
+                if i < len(ranks) and ranks[i] == key:
+                    del ranks[i]
+            key = (-entry[pos], user_id)
+            if len(ranks) < LEADERBOARD_KEEP or key < ranks[-1]:
+                bisect.insort(ranks, key)
+                del ranks[LEADERBOARD_KEEP:]
+                ranked = ranked or key in ranks
+        if ranked:
+            self.players[user_id] = entry
+        else:
+            self.players.pop(user_id, None)
+
+    def top(self, metric: str, n: int):
+        pos = list(LEADERBOARD_METRICS).index(metric) + 1
+        return [(uid, self.players[uid][0], self.players[uid][pos]) for _, uid in self.ranks[metric][:n]]
+
+_boards = OrderedDict()  # scope -> Leaderboard, LRU
+_boards_lock = threading.Lock()
+
+def leaderboard(scope: int) -> Leaderboard:
+    with _boards_lock:
+        board = _boards.get(scope)
+        if board and time.monotonic() - board.loaded_at < LEADERBOARD_REFRESH:
+            _boards.move_to_end(scope)
+            return board
+    board = Leaderboard(scope)
+    with _boards_lock:
+        _boards[scope] = board
+        _boards.move_to_end(scope)
+        while len(_boards) > LEADERBOARD_MAX_BOARDS:
+            _boards.popitem(last=False)
+    return board
+
+def leaderboard_claimed(user_id: int, name, stats: dict):
+    with _boards_lock:
+        for scope, values in stats.items():
+            board = _boards.get(scope)
+            if board:
+                board.update(user_id, name, values)
+
+def leaderboard_invalidate(scope: int = None):
+    # counters went down: the next read reloads (None = every board)
+    with _boards_lock:
+        if scope is None:
+            _boards.clear()
+        else:
+            _boards.pop(scope, None)
+            _boards.pop(storage.GLOBAL_SCOPE, None)
+
+def render_leaderboard(title: str, scope: int, metric: str) -> str:
+    board = leaderboard(scope)
+    with _boards_lock:
+        rows = board.top(metric, LEADERBOARD_SHOW)
+    lines = [f"🏆 {title} — {LEADERBOARD_METRICS[metric]}", ""]
+    if not rows:
+        lines.append("— Nobody has hunted anything yet.")
+    for i, (uid, name, value) in enumerate(rows, start=1):
+        lines.append(f"{i}. {name or uid} — {value}")
+    lines.append("")
+    lines.append("Rank by: cards · unique · score")
+    return "\n".join(lines)
+
+def leaderboard_metric(args: str):
+    arg = args.strip().lower()
+    if not arg:
+        return "cards"
+    arg = LEADERBOARD_ALIASES.get(arg, arg)
+    return arg if arg in LEADERBOARD_METRICS else None
+
+@command("top")
+def top_cmd(message, args: str):
+    metric = leaderboard_metric(args)
+    if not metric:
+        return bot.reply_to(message, "Usage: /top [cards|unique|score]")
+    bot.reply_to(message, render_leaderboard("Global Leaderboard", storage.GLOBAL_SCOPE, metric))
+
+@command("topchat")
+def top_chat_cmd(message, args: str):
+    if message.chat.type == "private":
+        return bot.reply_to(message, "❌ /topchat works only inside groups.")
+    metric = leaderboard_metric(args)
+    if not metric:
+        return bot.reply_to(message, "Usage: /topchat [cards|unique|score]")
+    bot.reply_to(message, render_leaderboard("Group Leaderboard", message.chat.id, metric))
+
+# =========================
+# /profile (Owner) — cProfile + tracemalloc over the next N updates
+# =========================
+PROFILE_MAX_UPDATES = 5000
+PROFILE_TOP_FUNCS = 40
+PROFILE_TOP_ALLOCS = 25
+
+# only one update is profiled at a time (cProfile can't run two profilers at once on 3.12+):
+# "busy" marks the slot taken; updates arriving meanwhile run unprofiled instead of waiting.
+# _profile_lock only guards the state, it is never held while a handler runs.
+_profile_lock = threading.Lock()
+_profile = {"remaining": 0, "total": 0, "started_at": 0.0, "stats": None, "snapshot": None, "busy": False}
+
+def start_profile(n: int):
+    with _profile_lock:
+        if _profile["remaining"] > 0:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _profile.update(
+            remaining=n, total=n, started_at=time.time(),
+            stats=None, snapshot=tracemalloc.take_snapshot(),
+        )
+    return True
 
-    if message.content_type == "text" and message.text and message.text.startswith("/"):
-        return
+def build_profile_report(stats, base_snapshot, total: int, elapsed: float) -> str:
+    buf = io.StringIO()
+    buf.write(f"{VERSION}\nProfiled updates: {total} | wall time: {elapsed:.1f}s\n\n")
 
-    counter, every, enabled = increment_counter(message.chat.id)
-    if not enabled or every <= 0:
-        return
+    buf.write("=== Top functions by cumulative time ===\n")
+    if stats:
+        stats.stream = buf
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCS)
+    else:
+        buf.write("— no samples\n")
+
+    buf.write("\n=== Top allocation sites (growth since /profile) ===\n")
+    if tracemalloc.is_tracing() and base_snapshot is not None:
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        for stat in snap.compare_to(base_snapshot, "lineno")[:PROFILE_TOP_ALLOCS]:
+            buf.write(f"{stat}\n")
+    else:
+        buf.write("— tracemalloc not running\n")
+    return buf.getvalue()
 
-    if counter % every == 0:
-        try:
-            spawn_character_in_chat(message.chat.id)
-        except Exception as e:
-            print("spawn error:", e)
+def finish_profile(stats, base_snapshot, total: int, started_at: float):
+    try:
+        report = build_profile_report(stats, base_snapshot, total, time.time() - started_at)
+    finally:
+        tracemalloc.stop()
+    try:
+        bot.send_document(
+            OWNER_ID,
+            io.BytesIO(report.encode("utf-8")),
+            visible_file_name=f"profile_{int(time.time())}.txt",
+            caption=f"🧪 Profile done ({total} updates)",
+        )
+    except Exception as e:
+        print("profile report send failed:", e)
 
-print("Bot is running...")
-bot.infinity_polling(timeout=30, long_polling_timeout=30)import re
-import time
-import random
-import os
+class ProfilerMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
 
-import psycopg
-import telebot
-from telebot import types
+    def pre_process(self, message, data):
+        if _profile["remaining"] <= 0 or _profile["busy"]:
+            return
+        with _profile_lock:
+            if _profile["remaining"] <= 0 or _profile["busy"]:
+                return
+            _profile["busy"] = True
+        prof = cProfile.Profile()
+        data["profiler"] = prof
+        prof.enable()
+
+    def post_process(self, message, data, exception):
+        prof = data.get("profiler")
+        if prof is None:
+            return
+        prof.disable()
+        done = None
+        with _profile_lock:
+            _profile["busy"] = False
+            if _profile["remaining"] <= 0:
+                return
+            if _profile["stats"] is None:
+                _profile["stats"] = pstats.Stats(prof)
+            else:
+                _profile["stats"].add(prof)
+            _profile["remaining"] -= 1
+            if _profile["remaining"] <= 0:
+                done = (_profile["stats"], _profile["snapshot"], _profile["total"], _profile["started_at"])
+                _profile.update(stats=None, snapshot=None)
+        if done:
+            finish_profile(*done)
+
+bot.setup_middleware(ProfilerMiddleware())
+
+@command("profile")
+def profile_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return
+    n = int_arg(args)
+    if n is None:
+        return bot.reply_to(message, f"Usage: /profile 200 (1..{PROFILE_MAX_UPDATES} updates)")
+    if n < 1 or n > PROFILE_MAX_UPDATES:
+        return bot.reply_to(message, f"❌ N باید بین 1 و {PROFILE_MAX_UPDATES} باشه.")
+    if not start_profile(n):
+        return bot.reply_to(message, f"⏳ A profile is already running ({_profile['remaining']} updates left).")
+    bot.reply_to(message, f"🧪 Profiling the next {n} updates. Report will be sent to the owner's PM.")
 
 # =========================
-# تنظیمات اصلی
+# /dbstats (Owner): per-statement timings from storage.run()
 # =========================
-TOKEN = os.environ.get("TOKEN")
-DATABASE_URL = os.environ.get("DATABASE_URL")
-
-OWNER_ID = 2043594987
-DB_CHANNEL_USERNAME = "@hunter_database"  # کانال دیتابیس
-VERSION = "HunterBot v13 (Neon/Postgres build)"
+DBSTATS_TOP = 15
 
-if not TOKEN:
-    raise RuntimeError("TOKEN env is missing")
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL env is missing")
-
-bot = telebot.TeleBot(TOKEN, parse_mode=None)
+@command("dbstats")
+def dbstats_cmd(message, args: str):
+    if not is_owner(message.from_user.id):
+        return
+    rows = storage.statement_stats()[:DBSTATS_TOP]
+    if not rows:
+        return bot.reply_to(message, "No statements recorded yet.")
+    lines = [f"🗄 DB statements ({storage.backend_name()}), by total time:"]
+    for name, calls, total, worst in rows:
+        lines.append(f"- {name}: {calls}× avg {total / calls * 1000:.2f}ms max {worst * 1000:.1f}ms")
+    conn = storage.connect_stats()
+    if conn["connects"]:
+        lines.append(
+            f"🔌 connects: {conn['connects']}, cold starts: {conn['cold_starts']} "
+            f"(last {conn['last']:.2f}s, max {conn['max']:.2f}s), dropped idle: {conn['dropped']}, "
+            f"warm-up retries: {conn['retries']}"
+        )
+    replica = storage.read_routing_stats()
+    if replica:
+        lag, reads, fallbacks = replica
+        lag_text = "unreachable" if lag is None else f"lag {lag:.1f}s"
+        lines.append(f"📖 replica: {lag_text}, {reads} reads, {fallbacks} on primary")
+    bot.reply_to(message, "\n".join(lines))
 
 # =========================
-# RARITY / EVENTS
+# Message counter -> spawn every N messages
+# plain group messages are picked out of the raw updates (counter_only_chat) and counted here
+# without going through telebot's handlers; there is no message handler for them
 # =========================
-RARITIES = {
-    "common":       {"emoji": "🔵", "title": "Common"},
-    "rare":         {"emoji": "🟠", "title": "Rare"},
-    "epic":         {"emoji": "🟣", "title": "Epic"},
-    "legendary":    {"emoji": "🟡", "title": "Legendary"},
-    "flat":         {"emoji": "🔮", "title": "Flat"},
-    "transcendent": {"emoji": "🪞", "title": "Transcendent"},
-    "cosmic":       {"emoji": "🌌", "title": "Cosmic"},
-    "infinity":     {"emoji": "♾️", "title": "Infinity"},
-    "oblivion":     {"emoji": "🩸", "title": "Oblivion"},
-}
-
-EVENTS = {
-    "post_apocalyptic_survivor": "Post-Apocalyptic Survivor ☢️",
-    "space_explorer": "Space Explorer 🚀",
-    "festival_fireworks": "Festival Fireworks 🎆",
-    "monster_side": "Monster Side🐉",
-    "rome": "Rome 🏰",
-    "halloween": "Halloween 🎃",
-    "valentine": "Valentine 💝",
-    "wedding": "Wedding 💍",
-    "school": "School 🏫",
-    "cosplay": "Cosplay 🎭",
-    "winter": "Winter ❄️",
-    "christmas": "Christmas 🎄",
-    "summer": "Summer 🏖",
-    "gamer": "Gamer 🎮",
-    "police": "𝗣𝗢𝗟𝗜𝗖𝗘 🚨",
-    "doctor": "Doctor 🧬",
-    "maid": "Maid 🧹",
-    "idol": "Idol 🎤",
-    "office_lady": "Office Lady 💼",
-    "sports": "sports ⚽️",
-    "warrior": "warrior 🛡",
-}
+def count_message(chat_id: int):
+    counter, every, enabled = increment_counter(chat_id)
+    if not enabled or every <= 0:
+        return
 
-NO_EVENT_KEY = "none"
-NO_EVENT_TITLE = "None"
+    if counter % every == 0:
+        request_spawn(chat_id)
+
+# =========================
+# Update offset + backlog catch-up
+# the getUpdates offset is saved every few seconds; after a restart the queued backlog is
+# drained first: plain group messages become one counter update per chat and at most one
+# (fresh) spawn per chat, everything else (commands, callbacks, ...) is processed normally
+# =========================
+UPDATE_OFFSET_KEY = "update_offset"
+OFFSET_SAVE_EVERY = 5.0
+CATCHUP_SPAWN_MAX_AGE = 600  # backlog older than this never triggers a spawn
+CATCHUP_BATCH = 100
+CATCHUP_POLL_TIMEOUT = 1  # seconds Telegram may hold an empty getUpdates (0 would mean apihelper's default)
+COUNTED_CONTENT = ("text", "photo", "sticker", "video", "animation", "document")
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+
+def counter_only_chat(u: dict):
+    # chat_id if this raw update is a plain group message (it only bumps the counter), else None
+    m = u.get("message")
+    if not m or m["chat"]["type"] not in ("group", "supergroup"):
+        return None
+    if not any(k in m for k in COUNTED_CONTENT):
+        return None
+    if m.get("text", "").startswith("/"):
+        return None
+    return m["chat"]["id"]
 
-# =========================
-# Spawn config (قابل تغییر)
-# =========================
-RARITY_SPAWN_WEIGHTS = {
-    "common": 60,
-    "rare": 25,
-    "epic": 10,
-    "legendary": 4,
-    "flat": 1,
-    "transcendent": 0.4,
-    "cosmic": 0.1,
-    "infinity": 0,
-    "oblivion": 0,
-}
+def update_date(u: dict):
+    # unix time the update was made, if its payload carries one (callback queries don't)
+    for v in u.values():
+        if isinstance(v, dict) and "date" in v:
+            return v["date"]
+    return None
 
-DEFAULT_SPAWN_EVERY = 100
-DEFAULT_SPAWN_ENABLED = True
+def catch_up_backlog(dispatch_updates, dispatch_spawn):
+    # drains only what was queued before startup: on a busy bot live traffic would keep the
+    # queue non-empty forever, so an update made after `started` (or a short batch) ends it
+    offset = storage.get_bot_state(UPDATE_OFFSET_KEY)
+    started = time.time()
+    counts, latest, due, passed, drained, spawns = {}, {}, set(), 0, 0, 0
+    while True:
+        raw = telebot.apihelper.get_updates(TOKEN, offset=offset, limit=CATCHUP_BATCH,
+                                            allowed_updates=ALLOWED_UPDATES,
+                                            long_polling_timeout=CATCHUP_POLL_TIMEOUT)
+        if not raw:
+            break
+        rest, batch = [], {}
+        for u in raw:
+            offset = u["update_id"] + 1
+            chat_id = counter_only_chat(u)
+            if chat_id is None:
+                rest.append(u)
+                continue
+            batch[chat_id] = batch.get(chat_id, 0) + 1
+            latest[chat_id] = max(latest.get(chat_id, 0), u["message"]["date"])
+        if rest:
+            dispatch_updates(rest)
+        if batch:
+            # counters go in before the offset moves past them, so a crash can't lose them
+            for chat_id, old, new, every, enabled in storage.add_msg_counters(
+                    batch, DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY):
+                counts[chat_id] = counts.get(chat_id, 0) + new - old
+                if enabled and every > 0 and new // every > old // every:
+                    due.add(chat_id)
+        passed += len(rest)
+        drained += len(raw)
+        storage.set_bot_state(UPDATE_OFFSET_KEY, offset)
+        if len(raw) < CATCHUP_BATCH or any((update_date(u) or 0) >= started for u in raw):
+            break
+
+    fresh_after = time.time() - CATCHUP_SPAWN_MAX_AGE
+    for chat_id in due:
+        if latest[chat_id] >= fresh_after:
+            dispatch_spawn(chat_id)
+            spawns += 1
+    if drained:
+        print(f"Backlog: {drained} updates, {sum(counts.values())} counted in {len(counts)} chats, "
+              f"{passed} processed, {spawns} spawns")
+    return offset
+
+def save_offset_loop(current_offset):
+    saved = None
+    while True:
+        time.sleep(OFFSET_SAVE_EVERY)
+        offset = current_offset()
+        if offset and offset != saved:
+            try:
+                storage.set_bot_state(UPDATE_OFFSET_KEY, offset)
+                saved = offset
+            except Exception as e:
+                print("offset save failed:", e)
+
+# =========================
+# DB keepalive (Neon)
+# during DB_ACTIVE_HOURS (UTC, "8-23", may wrap like "20-4") a ping every DB_KEEPALIVE_SECONDS
+# of DB silence keeps the compute from suspending; outside them it may sleep, and is woken
+# as the window opens. The first update after DB_IDLE_WARMUP_AFTER of silence also warms up.
+# =========================
+DB_KEEPALIVE_SECONDS = int(os.environ.get("DB_KEEPALIVE_SECONDS", "0"))  # 0 = no keepalive pings
+DB_ACTIVE_HOURS = os.environ.get("DB_ACTIVE_HOURS", "0-24")
+DB_IDLE_WARMUP_AFTER = 240
+DB_KEEPALIVE_TICK = 30
+
+def parse_active_hours(spec: str):
+    start, _, end = spec.partition("-")
+    return int(start) % 24, int(end or 24) % 24
+
+def in_active_hours(hour: int = None) -> bool:
+    start, end = parse_active_hours(DB_ACTIVE_HOURS)
+    hour = time.gmtime().tm_hour if hour is None else hour
+    if start == end:
+        return True
+    if start < end:
+        return start <= hour < end
+    return hour >= start or hour < end
 
-# =========================
-# DB (Postgres / Neon)
-# =========================
-def db():
-    # Neon/Postgres
-    return psycopg.connect(DATABASE_URL, autocommit=False)
+def db_keepalive_loop():
+    if storage.backend_name() != "postgres" or DB_KEEPALIVE_SECONDS <= 0:
+        return
+    was_active = in_active_hours()
+    while True:
+        time.sleep(DB_KEEPALIVE_TICK)
+        active = in_active_hours()
+        if active and not was_active:
+            storage.warm_up("active hours")
+        elif active and storage.seconds_since_db_activity() >= DB_KEEPALIVE_SECONDS:
+            storage.warm_up("keepalive")
+        was_active = active
+
+# =========================
+# Ingestion
+# plain group messages (the bulk of traffic) skip Update/Message construction and the
+# handler filter chain: the raw JSON is classified and counted straight away.
+# Only the rest becomes telebot objects. Fast-path updates are not seen by /profile.
+# =========================
+def process_raw_updates(raw):
+    if storage.seconds_since_db_activity() >= DB_IDLE_WARMUP_AFTER:
+        # wake the compute alongside the handlers instead of behind the first one
+        storage.note_activity()
+        threading.Thread(target=storage.warm_up, args=("after idle",), daemon=True).start()
+    slow = []
+    for u in raw:
+        chat_id = counter_only_chat(u)
+        if chat_id is None:
+            slow.append(u)
+        else:
+            bot.worker_pool.put(count_message, chat_id)
+    if slow:
+        bot.process_new_updates([types.Update.de_json(u) for u in slow])
 
-def init_db():
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS uploaders (
-                tg_id BIGINT PRIMARY KEY,
-                added_by BIGINT NOT NULL,
-                added_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS characters (
-                id BIGSERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                anime TEXT NOT NULL,
-                rarity_key TEXT NOT NULL,
-                event_key TEXT NOT NULL,
-                image_file_id TEXT NOT NULL,
-                channel_msg_id BIGINT,
-                uploaded_by BIGINT NOT NULL,
-                uploaded_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id BIGINT PRIMARY KEY,
-                spawn_enabled BOOLEAN NOT NULL,
-                spawn_every INTEGER NOT NULL,
-                msg_counter BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS active_spawns (
-                chat_id BIGINT PRIMARY KEY,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
-                spawned_msg_id BIGINT NOT NULL,
-                spawned_at BIGINT NOT NULL,
-                claimed_by BIGINT,
-                claimed_at BIGINT
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS inventory (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
-                obtained_at BIGINT NOT NULL
-            )
-            """)
-
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS favorites (
-                user_id BIGINT PRIMARY KEY,
-                char_id BIGINT NOT NULL REFERENCES characters(id) ON DELETE CASCADE
-            )
-            """)
-
-            # indexes
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_chat_user ON inventory(chat_id, user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_rarity ON characters(rarity_key)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_name ON characters(name)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_characters_anime ON characters(anime)")
-
-        con.commit()
-
-init_db()
-
-# =========================
-# Resolve DB channel chat_id
-# =========================
-DB_CHAT_ID = None
-
-def resolve_db_chat_id():
-    global DB_CHAT_ID
-    try:
-        chat = bot.get_chat(DB_CHANNEL_USERNAME)
-        DB_CHAT_ID = chat.id
-        print("DB channel resolved:", DB_CHANNEL_USERNAME, "=>", DB_CHAT_ID)
-    except Exception as e:
-        print("Failed to resolve DB channel id:", e)
-        DB_CHAT_ID = DB_CHANNEL_USERNAME
-
-resolve_db_chat_id()
-
-# =========================
-# Helpers
-# =========================
-def is_owner(uid: int) -> bool:
-    return uid == OWNER_ID
-
-def is_uploader(uid: int) -> bool:
-    if is_owner(uid):
-        return True
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT 1 FROM uploaders WHERE tg_id=%s", (uid,))
-            row = cur.fetchone()
-    return row is not None
-
-def normalize(s: str) -> str:
-    s = (s or "").strip().lower()
-    s = s.replace("ي", "ی").replace("ك", "ک")
-    s = re.sub(r"\s+", " ", s)
-    return s
-
-def parse_rarity(line: str):
-    raw = (line or "").strip()
-    t = normalize(raw).replace(":", " ")
-    t = re.sub(r"\s+", " ", t).strip()
-
-    if t in RARITIES:
-        return t
-    for key, meta in RARITIES.items():
-        if key in t:
-            return key
-        if normalize(meta["title"]) in t:
-            return key
-        if meta["emoji"] and meta["emoji"] in raw:
-            return key
-    return None
-
-def parse_event_optional(line: str):
-    raw = (line or "").strip()
-    if not raw:
-        return NO_EVENT_KEY
-
-    t = normalize(raw)
-    t = t.replace("event", "").replace(":", " ")
-    t = re.sub(r"\s+", " ", t).strip()
-
-    if t in (NO_EVENT_KEY, "noevent", "no event", "none", "null", "-"):
-        return NO_EVENT_KEY
-    if t in EVENTS:
-        return t
-    for key, title in EVENTS.items():
-        if normalize(title) in normalize(raw):
-            return key
-        if key in t:
-            return key
-    return NO_EVENT_KEY
-
-def event_title(key: str) -> str:
-    return NO_EVENT_TITLE if key == NO_EVENT_KEY else EVENTS.get(key, NO_EVENT_TITLE)
-
-def extract_card_from_reply(message):
-    if not message.reply_to_message:
-        return None, "❌ باید روی پیام عکس ریپلای کنی."
-    src = message.reply_to_message
-    if not src.photo:
-        return None, "❌ پیام ریپلای باید Photo باشه."
-
-    caption = (src.caption or "").strip()
-    lines = [ln.strip() for ln in caption.splitlines() if ln.strip()]
-
-    if len(lines) not in (3, 4):
-        return None, (
-            "❌ کپشن باید ۳ یا ۴ خط باشه:\n"
-            "3 lines:\nName\nAnime\nRarity\n\n"
-            "4 lines:\nName\nAnime\nRarity\nEvent(optional)"
-        )
-
-    if len(lines) == 3:
-        name, anime, rarity_line = lines
-        event_line = ""
-    else:
-        name, anime, rarity_line, event_line = lines
-
-    rarity_key = parse_rarity(rarity_line)
-    if not rarity_key:
-        return None, "❌ Rarity نامعتبره. مثال: 🌌 Cosmic"
-
-    event_key = parse_event_optional(event_line)
-    file_id = src.photo[-1].file_id
-
-    return {
-        "name": name,
-        "anime": anime,
-        "rarity_key": rarity_key,
-        "event_key": event_key,
-        "file_id": file_id
-    }, None
-
-def get_character(char_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT id, name, anime, rarity_key, event_key, image_file_id, channel_msg_id
-                FROM characters WHERE id=%s
-            """, (char_id,))
-            row = cur.fetchone()
-    if not row:
-        return None
-    return {
-        "id": row[0],
-        "name": row[1],
-        "anime": row[2],
-        "rarity_key": row[3],
-        "event_key": row[4],
-        "image_file_id": row[5],
-        "channel_msg_id": row[6],
-    }
-
-def repost_to_channel(char_id: int):
-    c = get_character(char_id)
-    if not c:
-        raise Exception("Character not found in DB")
-
-    if c["channel_msg_id"]:
-        try:
-            bot.delete_message(DB_CHAT_ID, c["channel_msg_id"])
-        except Exception:
-            pass
-
-    r = RARITIES[c["rarity_key"]]
-    e_title = event_title(c["event_key"])
-    channel_caption = (
-        "OWO! CHECK OUT THIS CHARACTER!\n\n"
-        f"[ ANIME : {c['anime']} ]\n"
-        f"[ ID : {c['id']} {c['name']} ]\n"
-        f"[ RARITY : {r['emoji']} {r['title']} ]\n"
-        f"[ EVENT : {e_title} ]\n\n"
-        "➤ UPDATED/ADDED"
-    )
-    sent = bot.send_photo(DB_CHAT_ID, c["image_file_id"], caption=channel_caption)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE characters SET channel_msg_id=%s WHERE id=%s", (sent.message_id, char_id))
-        con.commit()
-
-# =========================
-# SEARCH HELPERS
-# =========================
-def search_characters_in_db(query: str):
-    q = (query or "").strip()
-    if not q:
-        return []
-    like = f"%{q}%"
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT id, name, anime, rarity_key, event_key, image_file_id
-                FROM characters
-                WHERE LOWER(name) LIKE LOWER(%s)
-                   OR LOWER(anime) LIKE LOWER(%s)
-                ORDER BY id ASC
-            """, (like, like))
-            rows = cur.fetchall()
-    return rows
-
-def short_search_preview(rows, limit=12):
-    ids = [str(r[0]) for r in rows[:limit]]
-    if not ids:
-        return "—"
-    more = ""
-    if len(rows) > limit:
-        more = f" (+{len(rows)-limit} more)"
-    return ", ".join(ids) + more
-
-# =========================
-# Spawn System
-# =========================
-def get_or_create_chat_settings(chat_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT spawn_enabled, spawn_every, msg_counter FROM chat_settings WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-            if not row:
-                cur.execute("""
-                    INSERT INTO chat_settings (chat_id, spawn_enabled, spawn_every, msg_counter)
-                    VALUES (%s, %s, %s, %s)
-                """, (chat_id, DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY, 0))
-                con.commit()
-                row = (DEFAULT_SPAWN_ENABLED, DEFAULT_SPAWN_EVERY, 0)
-    return {"enabled": bool(row[0]), "every": int(row[1]), "counter": int(row[2])}
-
-def set_chat_settings(chat_id: int, enabled=None, every=None):
-    s = get_or_create_chat_settings(chat_id)
-    enabled_val = (s["enabled"] if enabled is None else bool(enabled))
-    every_val = s["every"] if every is None else int(every)
-    if every_val < 1:
-        every_val = 1
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                UPDATE chat_settings
-                SET spawn_enabled=%s, spawn_every=%s
-                WHERE chat_id=%s
-            """, (enabled_val, every_val, chat_id))
-        con.commit()
-
-def increment_counter(chat_id: int):
-    s = get_or_create_chat_settings(chat_id)
-    new_counter = s["counter"] + 1
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE chat_settings SET msg_counter=%s WHERE chat_id=%s", (new_counter, chat_id))
-        con.commit()
-    return new_counter, s["every"], s["enabled"]
-
-def has_active_spawn(chat_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, spawned_msg_id, claimed_by FROM active_spawns WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-    return row
-
-def weighted_choice_rarity():
-    items = [(k, float(v)) for k, v in RARITY_SPAWN_WEIGHTS.items() if float(v) > 0]
-    if not items:
-        return "common"
-    total = sum(w for _, w in items)
-    r = random.random() * total
-    upto = 0.0
-    for key, w in items:
-        upto += w
-        if upto >= r:
-            return key
-    return items[-1][0]
-
-def pick_random_character_by_rarity(rarity_key: str):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT id FROM characters WHERE rarity_key=%s ORDER BY RANDOM() LIMIT 1", (rarity_key,))
-            row = cur.fetchone()
-    return row[0] if row else None
-
-def pick_random_character_any():
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT id FROM characters ORDER BY RANDOM() LIMIT 1")
-            row = cur.fetchone()
-    return row[0] if row else None
-
-def spawn_character_in_chat(chat_id: int):
-    active = has_active_spawn(chat_id)
-    if active and active[2] is None:
-        return None
-
-    rarity_key = weighted_choice_rarity()
-    cid = pick_random_character_by_rarity(rarity_key)
-    if cid is None:
-        cid = pick_random_character_any()
-        if cid is None:
-            return None
-
-    c = get_character(cid)
-    if not c:
-        return None
-
-    caption = (
-        "✨ A new character has just spawned in the chat!\n"
-        "Use /hunt [Name] to hunt them for yourself."
-    )
-    msg = bot.send_photo(chat_id, c["image_file_id"], caption=caption)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO active_spawns (chat_id, char_id, spawned_msg_id, spawned_at, claimed_by, claimed_at)
-                VALUES (%s, %s, %s, %s, NULL, NULL)
-                ON CONFLICT (chat_id) DO UPDATE SET
-                    char_id=EXCLUDED.char_id,
-                    spawned_msg_id=EXCLUDED.spawned_msg_id,
-                    spawned_at=EXCLUDED.spawned_at,
-                    claimed_by=NULL,
-                    claimed_at=NULL
-            """, (chat_id, c["id"], msg.message_id, int(time.time())))
-        con.commit()
-
-    return c["id"]
-
-def claim_spawn(chat_id: int, user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, spawned_msg_id, claimed_by FROM active_spawns WHERE chat_id=%s", (chat_id,))
-            row = cur.fetchone()
-            if not row:
-                return (False, "❌ No active spawn.")
-            char_id, spawned_msg_id, claimed_by = row
-            if claimed_by is not None:
-                return (False, "❌ This spawn is already claimed.")
-
-            now = int(time.time())
-            cur.execute("UPDATE active_spawns SET claimed_by=%s, claimed_at=%s WHERE chat_id=%s",
-                        (user_id, now, chat_id))
-            cur.execute("INSERT INTO inventory (user_id, chat_id, char_id, obtained_at) VALUES (%s, %s, %s, %s)",
-                        (user_id, chat_id, char_id, now))
-        con.commit()
-    return (True, (char_id, spawned_msg_id))
-
-def name_matches(user_text: str, real_name: str) -> bool:
-    u = normalize(user_text)
-    r = normalize(real_name)
-    if not u or len(u) < 2:
-        return False
-    return (u == r)
-
-# =========================
-# HAREM + FAV helpers
-# =========================
-def get_user_fav_char_id(user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id FROM favorites WHERE user_id=%s", (user_id,))
-            row = cur.fetchone()
-    return int(row[0]) if row else None
-
-def user_owns_char_in_chat(chat_id: int, user_id: int, char_id: int) -> bool:
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT 1 FROM inventory
-                WHERE chat_id=%s AND user_id=%s AND char_id=%s
-                LIMIT 1
-            """, (chat_id, user_id, char_id))
-            ok = cur.fetchone() is not None
-    return ok
-
-def get_harem_cover_file_id(chat_id: int, user_id: int):
-    fav_id = get_user_fav_char_id(user_id)
-    if fav_id and user_owns_char_in_chat(chat_id, user_id, fav_id):
-        c = get_character(fav_id)
-        if c:
-            return c["image_file_id"]
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.image_file_id
-                FROM inventory i
-                JOIN characters c ON c.id=i.char_id
-                WHERE i.chat_id=%s AND i.user_id=%s
-                ORDER BY i.obtained_at DESC
-                LIMIT 1
-            """, (chat_id, user_id))
-            row = cur.fetchone()
-    return row[0] if row else None
-
-def get_user_collection_counts(chat_id: int, user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.anime, c.id, c.name, c.rarity_key, c.event_key, COUNT(*) as cnt
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.chat_id=%s AND i.user_id=%s
-                GROUP BY c.anime, c.id, c.name, c.rarity_key, c.event_key
-                ORDER BY LOWER(c.anime) ASC, c.id ASC
-            """, (chat_id, user_id))
-            rows = cur.fetchall()
-
-    if not rows:
-        return 0, []
-
-    per = {}
-    for anime, cid, name, rk, ek, cnt in rows:
-        if anime not in per:
-            per[anime] = {"anime": anime, "total_unique": 0, "samples": []}
-        per[anime]["total_unique"] += 1
-        if len(per[anime]["samples"]) < 6:
-            per[anime]["samples"].append((cid, name, rk, ek, cnt))
-
-    per_list = list(per.values())
-    total_unique = sum(x["total_unique"] for x in per_list)
-    return total_unique, per_list
-
-def render_harem_page(title_name: str, total_unique: int, per_anime: list, page: int, page_size: int = 4):
-    total_pages = max(1, (len(per_anime) + page_size - 1) // page_size)
-    page = max(1, min(page, total_pages))
-    start = (page - 1) * page_size
-    chunk = per_anime[start:start + page_size]
-
-    lines = []
-    lines.append(f"🗂 {title_name}'s Harem — Page: {page}/{total_pages}")
-    lines.append("")
-    for block in chunk:
-        anime = block["anime"]
-        lines.append(f"⚜️ {anime} ({block['total_unique']})")
-        lines.append("————————————")
-        for (cid, name, rk, ek, cnt) in block["samples"]:
-            r = RARITIES.get(rk, {"emoji": "❔", "title": rk})
-            extra = f" (x{cnt})" if cnt and cnt > 1 else ""
-            lines.append(f"{r['emoji']} [{cid}] | {name}{extra}")
-        lines.append("")
-
-    return "\n".join(lines).strip(), total_pages, page
-
-def harem_keyboard(total_unique: int, page: int, total_pages: int, target_user_id: int):
-    kb = types.InlineKeyboardMarkup(row_width=3)
-    row = []
-    if page > 1:
-        row.append(types.InlineKeyboardButton("⬅️", callback_data=f"harem:{page-1}:{target_user_id}"))
-    row.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
-    if page < total_pages:
-        row.append(types.InlineKeyboardButton("➡️", callback_data=f"harem:{page+1}:{target_user_id}"))
-    kb.row(*row)
-
-    kb.row(types.InlineKeyboardButton(
-        f"See Collection ({total_unique})",
-        switch_inline_query_current_chat=f"mycards {target_user_id}"
-    ))
-    return kb
-
-def rarity_deck_stats(user_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT rarity_key, COUNT(*)
-                FROM characters
-                GROUP BY rarity_key
-            """)
-            total_rows = cur.fetchall()
-            total_map = {rk: int(cnt) for rk, cnt in total_rows}
-
-            cur.execute("""
-                SELECT c.rarity_key, COUNT(DISTINCT i.char_id)
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.user_id=%s
-                GROUP BY c.rarity_key
-            """, (user_id,))
-            owned_rows = cur.fetchall()
-            owned_map = {rk: int(cnt) for rk, cnt in owned_rows}
-
-    for rk in RARITIES.keys():
-        total_map.setdefault(rk, 0)
-        owned_map.setdefault(rk, 0)
-
-    return total_map, owned_map
-
-# =========================
-# Commands
-# =========================
-@bot.message_handler(commands=["start"])
-def start(message):
-    role = "OWNER" if is_owner(message.from_user.id) else ("UPLOADER" if is_uploader(message.from_user.id) else "USER")
-    bot.reply_to(
-        message,
-        f"✅ Bot is online!\n{VERSION}\nRole: {role}\n\n"
-        "Player:\n"
-        "- /hunt Name   (example: /hunt Rangiku)\n"
-        "- /harem (or reply to someone: /harem)\n"
-        "- /fav ID   (set harem cover)\n"
-        "- /search text (search cards in DB)\n\n"
-        "Owner (spawn settings per chat):\n"
-        "- /changetime 20\n"
-        "- /spawn on | /spawn off\n"
-        "- /spawnstatus\n"
-        "- /forcespawn\n"
-        "- /clearspawn\n"
-        "- /reset (reply to user)\n\n"
-        "Uploader:\n"
-        "- reply /upload\n"
-        "- reply /uploadid 25\n\n"
-        "Owner edit:\n"
-        "- /delete 25\n"
-        "- /update 25 name New Name\n"
-        "- /update 25 anime New Anime\n"
-        "- /update 25 rarity 🌌 Cosmic\n"
-        "- /update 25 event none\n"
-        "- reply /updatephoto 25\n"
-        "- /check 25\n"
-        "- /rarity\n"
-    )
-
-@bot.message_handler(commands=["ping"])
-def ping(message):
-    bot.reply_to(message, "🏓 Pong!")
-
-# =========================
-# /search
-# =========================
-@bot.message_handler(regexp=r"^/search(\s+.+)?$")
-def search_cmd(message):
-    m = re.match(r"^/search\s+(.+)$", (message.text or "").strip(), flags=re.I)
-    if not m:
-        return bot.reply_to(message, "Usage: /search NameOrAnime\nExample: /search Rangiku")
-
-    q = m.group(1).strip()
-    rows = search_characters_in_db(q)
-
-    kb = types.InlineKeyboardMarkup()
-    kb.row(types.InlineKeyboardButton("🔍 View results (inline)", switch_inline_query_current_chat=f"search {q}"))
-
-    if not rows:
-        return bot.reply_to(message, f"❌ No cards found for: {q}", reply_markup=kb)
-
-    preview = short_search_preview(rows, limit=12)
-    bot.reply_to(
-        message,
-        f"✅ Search results for: {q}\n"
-        f"Found: {len(rows)} card(s)\n"
-        f"IDs: {preview}",
-        reply_markup=kb
-    )
-
-# =========================
-# Spawn settings (Owner)
-# =========================
-@bot.message_handler(regexp=r"^/changetime(\s+\d+)?$")
-def changetime(message):
-    if not is_owner(message.from_user.id):
-        return
-    if message.chat.type not in ("group", "supergroup"):
-        return bot.reply_to(message, "Use in group.")
-    m = re.match(r"^/changetime\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /changetime 20")
-    n = int(m.group(1))
-    if n < 1:
-        return bot.reply_to(message, "❌ عدد باید حداقل 1 باشه.")
-    set_chat_settings(message.chat.id, every=n)
-    bot.reply_to(message, f"✅ Spawn interval set to every {n} messages (this chat).")
-
-@bot.message_handler(regexp=r"^/spawn(\s+(on|off))?$")
-def spawn_toggle(message):
-    if not is_owner(message.from_user.id):
-        return
-    if message.chat.type not in ("group", "supergroup"):
-        return bot.reply_to(message, "Use in group.")
-    m = re.match(r"^/spawn\s+(on|off)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /spawn on  OR  /spawn off")
-    val = (m.group(1) == "on")
-    set_chat_settings(message.chat.id, enabled=val)
-    bot.reply_to(message, f"✅ Spawn {'enabled' if val else 'disabled'} for this chat.")
-
-# =========================
-# Spawn debug (Owner)
-# =========================
-@bot.message_handler(commands=["spawnstatus"])
-def spawn_status(message):
-    if message.chat.type not in ("group", "supergroup"):
-        return bot.reply_to(message, "Use in group.")
-    s = get_or_create_chat_settings(message.chat.id)
-    active = has_active_spawn(message.chat.id)
-
-    txt = (
-        f"📊 Spawn Status\n"
-        f"- enabled: {s['enabled']}\n"
-        f"- every: {s['every']}\n"
-        f"- counter: {s['counter']}\n"
-    )
-    if active:
-        txt += f"- active_spawn: YES | char_id={active[0]} | claimed_by={active[2]}\n"
-        if active[2] is None:
-            txt += "⚠️ Active spawn is UNCLAIMED → new spawns are blocked until hunted.\n"
-    else:
-        txt += "- active_spawn: NO\n"
-    bot.reply_to(message, txt)
-
-@bot.message_handler(commands=["forcespawn"])
-def force_spawn(message):
-    if not is_owner(message.from_user.id):
-        return
-    if message.chat.type not in ("group", "supergroup"):
-        return bot.reply_to(message, "Use in group.")
-    try:
-        cid = spawn_character_in_chat(message.chat.id)
-        if cid is None:
-            bot.reply_to(message, "❌ Force spawn failed (maybe no characters in DB OR active spawn locked).")
-        else:
-            bot.reply_to(message, f"✅ Forced spawn done. char_id={cid}")
-    except Exception as e:
-        bot.reply_to(message, f"❌ Force spawn error:\n{e}")
-
-@bot.message_handler(commands=["clearspawn"])
-def clear_spawn(message):
-    if not is_owner(message.from_user.id):
-        return
-    if message.chat.type not in ("group", "supergroup"):
-        return bot.reply_to(message, "Use in group.")
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM active_spawns WHERE chat_id=%s", (message.chat.id,))
-        con.commit()
-    bot.reply_to(message, "✅ Active spawn cleared for this chat.")
-
-# =========================
-# Hunt (Players)
-# =========================
-@bot.message_handler(regexp=r"^/hunt(\s+.+)?$")
-def hunt_cmd(message):
-    if message.chat.type == "private":
-        return bot.reply_to(message, "❌ /hunt works only inside groups.")
-
-    m = re.match(r"^/hunt\s+(.+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /hunt Name\nExample: /hunt Rangiku")
-
-    guess = m.group(1).strip()
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT char_id, claimed_by FROM active_spawns WHERE chat_id=%s", (message.chat.id,))
-            row = cur.fetchone()
-
-    if not row:
-        return bot.reply_to(message, "❌ No active spawn right now.")
-
-    char_id, claimed_by = row
-    if claimed_by is not None:
-        return bot.reply_to(message, "❌ This character is already claimed.")
-
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ Spawn data not found.")
-
-    if not name_matches(guess, c["name"]):
-        return bot.reply_to(message, "❌ Wrong name!")
-
-    # GLOBAL CAPACITY 25
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE user_id=%s", (message.from_user.id,))
-            count = int(cur.fetchone()[0] or 0)
-
-    MAX_CAPACITY = 25
-    if count >= MAX_CAPACITY:
-        return bot.reply_to(
-            message,
-            "🚫 Storage Limit Reached!\n\n"
-            "Your total collection capacity is full (25/25).\n"
-            "You can't hunt more characters until the Owner resets your storage."
-        )
-
-    ok, info = claim_spawn(message.chat.id, message.from_user.id)
-    if not ok:
-        return bot.reply_to(message, info)
-
-    r = RARITIES[c["rarity_key"]]
-    e_title = event_title(c["event_key"])
-
-    bot.reply_to(
-        message,
-        f"🏹 {message.from_user.first_name} claimed!\n"
-        f"ID: {c['id']} | {c['name']} ({c['anime']})\n"
-        f"{r['emoji']} {r['title']} | Event: {e_title}"
-    )
-
-@bot.message_handler(commands=["reset"])
-def reset_collection(message):
-    if not is_owner(message.from_user.id):
-        return bot.reply_to(message, "⛔ Only the Owner can use this command.")
-
-    if message.reply_to_message:
-        target_id = message.reply_to_message.from_user.id
-        target_name = message.reply_to_message.from_user.first_name
-    else:
-        target_id = message.from_user.id
-        target_name = message.from_user.first_name
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE user_id=%s", (target_id,))
-            total = int(cur.fetchone()[0] or 0)
-            cur.execute("DELETE FROM inventory WHERE user_id=%s", (target_id,))
-        con.commit()
-
-    bot.reply_to(
-        message,
-        f"♻️ {target_name}'s storage has been fully reset.\n"
-        f"{total} cards removed.\n"
-        f"They can now collect up to 25 new characters again."
-    )
-
-# =========================
-# /fav
-# =========================
-@bot.message_handler(regexp=r"^/fav(\s+\d+)?$")
-def fav_cmd(message):
-    if message.chat.type == "private":
-        return bot.reply_to(message, "❌ /fav فقط داخل گروه کار می‌کنه.")
-    m = re.match(r"^/fav\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /fav ID (مثال: /fav 25)")
-    cid = int(m.group(1))
-    if not get_character(cid):
-        return bot.reply_to(message, "❌ این ID وجود نداره.")
-    if not user_owns_char_in_chat(message.chat.id, message.from_user.id, cid):
-        return bot.reply_to(message, "❌ این کارت رو توی همین گروه نداری.")
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO favorites (user_id, char_id)
-                VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET char_id=EXCLUDED.char_id
-            """, (message.from_user.id, cid))
-        con.commit()
-
-    bot.reply_to(message, f"✅ Favorite set to #{cid} (for your /harem cover).")
-
-# =========================
-# /harem
-# =========================
-@bot.message_handler(commands=["harem"])
-def harem_cmd(message):
-    if message.chat.type == "private":
-        return bot.reply_to(message, "❌ /harem فقط داخل گروه کار می‌کنه.")
-
-    target_user_id = message.from_user.id
-    target_name = message.from_user.first_name
-
-    if message.reply_to_message and message.reply_to_message.from_user:
-        target_user_id = message.reply_to_message.from_user.id
-        target_name = message.reply_to_message.from_user.first_name
-
-    total_unique, per_anime = get_user_collection_counts(message.chat.id, target_user_id)
-    if total_unique == 0:
-        return bot.reply_to(message, "You Have Not Hunted any Characters Yet.")
-
-    cover = get_harem_cover_file_id(message.chat.id, target_user_id)
-    text, total_pages, page = render_harem_page(target_name, total_unique, per_anime, page=1)
-    kb = harem_keyboard(total_unique, page, total_pages, target_user_id)
-
-    if cover:
-        bot.send_photo(message.chat.id, cover, caption=text, reply_markup=kb)
-    else:
-        bot.reply_to(message, text, reply_markup=kb)
-
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("harem:"))
-def harem_page_callback(call):
-    try:
-        _, page_str, target_str = call.data.split(":")
-        page = int(page_str)
-        target_user_id = int(target_str)
-    except:
-        return bot.answer_callback_query(call.id)
-
-    chat_id = call.message.chat.id
-
-    total_unique, per_anime = get_user_collection_counts(chat_id, target_user_id)
-    if total_unique == 0:
-        bot.answer_callback_query(call.id, "No cards.")
-        try:
-            bot.edit_message_caption("You Have Not Hunted any Characters Yet.", chat_id, call.message.message_id)
-        except:
-            try:
-                bot.edit_message_text("You Have Not Hunted any Characters Yet.", chat_id, call.message.message_id)
-            except:
-                pass
-        return
-
-    title_name = "Harem"
-    try:
-        u = bot.get_chat(target_user_id)
-        title_name = u.first_name or "Player"
-    except:
-        title_name = "Player"
-
-    text, total_pages, page = render_harem_page(title_name, total_unique, per_anime, page=page)
-    kb = harem_keyboard(total_unique, page, total_pages, target_user_id)
-
-    try:
-        bot.edit_message_caption(chat_id=chat_id, message_id=call.message.message_id, caption=text, reply_markup=kb)
-    except:
-        try:
-            bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id, text=text, reply_markup=kb)
-        except:
-            pass
-
-    bot.answer_callback_query(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data == "noop")
-def noop(call):
-    bot.answer_callback_query(call.id)
-
-# =========================
-# Inline Mode: mycards + search
-# =========================
-@bot.inline_handler(func=lambda inline_query: True)
-def inline_handler(inline_query):
-    q_raw = (inline_query.query or "").strip()
-    q = q_raw.lower()
-
-    # SEARCH MODE
-    if q.startswith("search "):
-        search_text = q_raw[7:].strip()
-        rows = search_characters_in_db(search_text)
-
-        if not rows:
-            results = [
-                types.InlineQueryResultArticle(
-                    id="search_empty",
-                    title="No results",
-                    input_message_content=types.InputTextMessageContent(f"No cards found for: {search_text}")
-                )
-            ]
-            bot.answer_inline_query(inline_query.id, results, cache_time=1, is_personal=False)
-            return
-
-        try:
-            offset = int(inline_query.offset or "0")
-        except:
-            offset = 0
-
-        page_size = 15
-        chunk = rows[offset:offset + page_size]
-        next_offset = str(offset + page_size) if (offset + page_size) < len(rows) else ""
-
-        results = []
-        for idx, (cid, name, anime, rk, ek, file_id) in enumerate(chunk):
-            r = RARITIES.get(rk, {"emoji": "❔", "title": rk})
-            e_title = event_title(ek)
-            caption = f"ID: {cid} | {name} ({anime})\n{r['emoji']} {r['title']} | Event: {e_title}"
-
-            results.append(
-                types.InlineQueryResultCachedPhoto(
-                    id=f"search_{cid}_{offset}_{idx}",
-                    photo_file_id=file_id,
-                    caption=caption
-                )
-            )
-
-        bot.answer_inline_query(
-            inline_query.id,
-            results,
-            cache_time=1,
-            is_personal=False,
-            next_offset=next_offset
-        )
-        return
-
-    # MYCARDS MODE
-    if not q.startswith("mycards"):
-        return
-
-    m = re.match(r"^mycards\s+(\d+)$", q_raw.strip(), flags=re.I)
-    if m:
-        target_user_id = int(m.group(1))
-    else:
-        target_user_id = inline_query.from_user.id
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                SELECT c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id, COUNT(*) as cnt
-                FROM inventory i
-                JOIN characters c ON c.id = i.char_id
-                WHERE i.user_id=%s
-                GROUP BY c.id, c.name, c.anime, c.rarity_key, c.event_key, c.image_file_id
-                ORDER BY c.id ASC
-            """, (target_user_id,))
-            rows = cur.fetchall()
-
-    if not rows:
-        results = [
-            types.InlineQueryResultArticle(
-                id="empty",
-                title="No characters yet",
-                input_message_content=types.InputTextMessageContent("No characters yet.")
-            )
-        ]
-        bot.answer_inline_query(inline_query.id, results, cache_time=1, is_personal=True)
-        return
-
-    try:
-        offset = int(inline_query.offset or "0")
-    except:
-        offset = 0
-
-    page_size = 15
-    chunk = rows[offset:offset + page_size]
-    next_offset = str(offset + page_size) if (offset + page_size) < len(rows) else ""
-
-    results = []
-    for idx, (cid, name, anime, rk, ek, file_id, cnt) in enumerate(chunk):
-        r = RARITIES.get(rk, {"emoji": "❔", "title": rk})
-        e_title = event_title(ek)
-        extra = f" (x{cnt})" if cnt and cnt > 1 else ""
-        caption = f"ID: {cid} | {name}{extra} ({anime})\n{r['emoji']} {r['title']} | Event: {e_title}"
-
-        results.append(
-            types.InlineQueryResultCachedPhoto(
-                id=f"{cid}_{offset}_{idx}",
-                photo_file_id=file_id,
-                caption=caption
-            )
-        )
-
-    bot.answer_inline_query(
-        inline_query.id,
-        results,
-        cache_time=1,
-        is_personal=True,
-        next_offset=next_offset
-    )
-
-# =========================
-# Uploader/Admin management
-# =========================
-@bot.message_handler(commands=["adduploader"])
-def add_uploader(message):
-    if not is_owner(message.from_user.id):
-        return bot.reply_to(message, "⛔ فقط Owner.")
-    if not message.reply_to_message:
-        return bot.reply_to(message, "❌ روی پیام شخص ریپلای کن بعد /adduploader بزن.")
-    target = message.reply_to_message.from_user
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO uploaders (tg_id, added_by, added_at)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (tg_id) DO NOTHING
-            """, (target.id, OWNER_ID, int(time.time())))
-        con.commit()
-    bot.reply_to(message, f"✅ Uploader added: {target.first_name} (ID: {target.id})")
-
-@bot.message_handler(commands=["deluploader"])
-def del_uploader(message):
-    if not is_owner(message.from_user.id):
-        return bot.reply_to(message, "⛔ فقط Owner.")
-    if not message.reply_to_message:
-        return bot.reply_to(message, "❌ روی پیام شخص ریپلای کن بعد /deluploader بزن.")
-    target = message.reply_to_message.from_user
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM uploaders WHERE tg_id=%s", (target.id,))
-        con.commit()
-    bot.reply_to(message, f"🗑 Uploader removed: {target.first_name} (ID: {target.id})")
-
-# =========================
-# Upload / UploadID
-# =========================
-@bot.message_handler(commands=["upload"])
-def upload_auto(message):
-    if not is_uploader(message.from_user.id):
-        return bot.reply_to(message, "⛔ You are not an uploader.")
-    card, err = extract_card_from_reply(message)
-    if err:
-        return bot.reply_to(message, err)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                INSERT INTO characters (name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                card["name"], card["anime"], card["rarity_key"], card["event_key"],
-                card["file_id"], message.from_user.id, int(time.time())
-            ))
-            new_id = int(cur.fetchone()[0])
-        con.commit()
-
-    try:
-        repost_to_channel(new_id)
-        bot.reply_to(message, f"✅ Uploaded #{new_id} and posted to {DB_CHANNEL_USERNAME}")
-    except Exception as ex:
-        bot.reply_to(message, f"✅ Uploaded #{new_id} (DB saved)\n⚠️ Channel post failed:\n{ex}")
-
-@bot.message_handler(regexp=r"^/uploadid(\s+\d+)?$")
-def upload_manual_id(message):
-    if not is_uploader(message.from_user.id):
-        return bot.reply_to(message, "⛔ You are not an uploader.")
-    m = re.match(r"^/uploadid\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /uploadid 25 (reply to photo)")
-    desired_id = int(m.group(1))
-    if desired_id <= 0:
-        return bot.reply_to(message, "❌ ID باید مثبت باشه.")
-
-    card, err = extract_card_from_reply(message)
-    if err:
-        return bot.reply_to(message, err)
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT 1 FROM characters WHERE id=%s", (desired_id,))
-            if cur.fetchone():
-                return bot.reply_to(message, f"❌ ID {desired_id} قبلاً وجود داره.")
-
-            cur.execute("""
-                INSERT INTO characters (id, name, anime, rarity_key, event_key, image_file_id, uploaded_by, uploaded_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                desired_id, card["name"], card["anime"], card["rarity_key"], card["event_key"],
-                card["file_id"], message.from_user.id, int(time.time())
-            ))
-        con.commit()
-
-    try:
-        repost_to_channel(desired_id)
-        bot.reply_to(message, f"✅ Uploaded with ID #{desired_id} and posted to {DB_CHANNEL_USERNAME}")
-    except Exception as ex:
-        bot.reply_to(message, f"✅ Uploaded with ID #{desired_id} (DB saved)\n⚠️ Channel post failed:\n{ex}")
-
-# =========================
-# Delete
-# =========================
-@bot.message_handler(regexp=r"^/delete(\s+\d+)?$")
-def delete_character_cmd(message):
-    if not is_owner(message.from_user.id):
-        return
-    m = re.match(r"^/delete\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /delete 25")
-    char_id = int(m.group(1))
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ not found.")
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("DELETE FROM characters WHERE id=%s", (char_id,))
-            cur.execute("DELETE FROM inventory WHERE char_id=%s", (char_id,))
-            cur.execute("DELETE FROM active_spawns WHERE char_id=%s", (char_id,))
-        con.commit()
-
-    if c["channel_msg_id"]:
+def poll_updates():
+    # infinity_polling, minus de_json for every update
+    while True:
         try:
-            bot.delete_message(DB_CHAT_ID, c["channel_msg_id"])
-        except Exception:
-            pass
-
-    bot.reply_to(message, f"🗑 Deleted #{char_id} ✅")
-
-# =========================
-# Update fields + Update photo
-# =========================
-@bot.message_handler(regexp=r"^/update(\s+.+)?$")
-def update_field_cmd(message):
-    if not is_owner(message.from_user.id):
-        return
-    parts = (message.text or "").strip().split(maxsplit=3)
-    if len(parts) < 4:
-        return bot.reply_to(message,
-                            "Usage:\n"
-                            "/update 25 name New Name\n"
-                            "/update 25 anime New Anime\n"
-                            "/update 25 rarity 🌌 Cosmic\n"
-                            "/update 25 event none")
-    _, sid, field, new_value = parts
-    try:
-        char_id = int(sid)
-    except:
-        return bot.reply_to(message, "❌ ID باید عدد باشه.")
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ not found.")
-
-    field = field.lower().strip()
-
-    with db() as con:
-        with con.cursor() as cur:
-            if field == "name":
-                cur.execute("UPDATE characters SET name=%s WHERE id=%s", (new_value.strip(), char_id))
-            elif field == "anime":
-                cur.execute("UPDATE characters SET anime=%s WHERE id=%s", (new_value.strip(), char_id))
-            elif field == "rarity":
-                rk = parse_rarity(new_value)
-                if not rk:
-                    return bot.reply_to(message, "❌ Rarity نامعتبره. مثال: 🌌 Cosmic")
-                cur.execute("UPDATE characters SET rarity_key=%s WHERE id=%s", (rk, char_id))
-            elif field == "event":
-                ek = parse_event_optional(new_value)
-                cur.execute("UPDATE characters SET event_key=%s WHERE id=%s", (ek, char_id))
-            else:
-                return bot.reply_to(message, "❌ field فقط: name | anime | rarity | event")
-        con.commit()
-
-    try:
-        repost_to_channel(char_id)
-    except Exception:
-        pass
-
-    bot.reply_to(message, f"✅ Updated #{char_id} ({field})")
-
-@bot.message_handler(regexp=r"^/updatephoto(\s+\d+)?$")
-def update_photo_cmd(message):
-    if not is_owner(message.from_user.id):
-        return
-    m = re.match(r"^/updatephoto\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: reply to NEW photo: /updatephoto 25")
-    char_id = int(m.group(1))
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ not found.")
-    if not message.reply_to_message or not message.reply_to_message.photo:
-        return bot.reply_to(message, "❌ باید روی عکس جدید ریپلای کنی.")
-    new_file_id = message.reply_to_message.photo[-1].file_id
-
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("UPDATE characters SET image_file_id=%s WHERE id=%s", (new_file_id, char_id))
-        con.commit()
-
-    try:
-        repost_to_channel(char_id)
-    except Exception:
-        pass
-
-    bot.reply_to(message, f"🖼 Updated photo for #{char_id} ✅")
-
-# =========================
-# /rarity
-# =========================
-@bot.message_handler(commands=["rarity"])
-def rarity_cmd(message):
-    user_id = message.from_user.id
-    total_map, owned_map = rarity_deck_stats(user_id)
-
-    total_owned_all = sum(owned_map.values())
-    total_all = sum(total_map.values())
-
-    lines = []
-    lines.append(f"🗂 {message.from_user.first_name}'s Rarity Deck")
-    lines.append(f"Total Collected: {total_owned_all} (unique)")
-    lines.append(f"Collection: {total_owned_all}/{total_all} ({(total_owned_all/total_all*100 if total_all else 0):.1f}%)")
-    lines.append("————————————")
-
-    order = ["oblivion","infinity","transcendent","cosmic","flat","legendary","epic","rare","common"]
-
-    for rk in order:
-        meta = RARITIES.get(rk, {"emoji": "❔", "title": rk})
-        owned = owned_map.get(rk, 0)
-        total = total_map.get(rk, 0)
-        pct = (owned / total * 100) if total else 0.0
-
-        lines.append(f"{meta['emoji']} {meta['title']} ({owned}/{total})")
-        lines.append(f"Progress: {pct:.0f}%")
-        lines.append("")
-
-    bot.reply_to(message, "\n".join(lines))
-
-# =========================
-# /check
-# =========================
-def get_card_global_stats(char_id: int):
-    with db() as con:
-        with con.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM inventory WHERE char_id=%s", (char_id,))
-            total_copies = int(cur.fetchone()[0] or 0)
-
-            cur.execute("SELECT COUNT(DISTINCT user_id) FROM inventory WHERE char_id=%s", (char_id,))
-            total_unique_users = int(cur.fetchone()[0] or 0)
-
-            cur.execute("""
-                SELECT user_id, COUNT(*) as cnt
-                FROM inventory
-                WHERE char_id=%s
-                GROUP BY user_id
-                ORDER BY cnt DESC
-                LIMIT 10
-            """, (char_id,))
-            top_users = cur.fetchall()
-
-    return total_copies, total_unique_users, top_users
-
-@bot.message_handler(regexp=r"^/check(\s+\d+)?$")
-def check_cmd(message):
-    m = re.match(r"^/check\s+(\d+)$", (message.text or "").strip())
-    if not m:
-        return bot.reply_to(message, "Usage: /check 25")
-
-    char_id = int(m.group(1))
-    c = get_character(char_id)
-    if not c:
-        return bot.reply_to(message, "❌ Character not found.")
-
-    total_copies, total_unique_users, top_users = get_card_global_stats(char_id)
-
-    r = RARITIES.get(c["rarity_key"], {"emoji": "❔", "title": c["rarity_key"]})
-    e_title = event_title(c["event_key"])
-
-    lines = []
-    lines.append(f"🔎 Card Check — ID: {c['id']}")
-    lines.append(f"👤 Name: {c['name']}")
-    lines.append(f"🎬 Anime: {c['anime']}")
-    lines.append(f"✨ Rarity: {r['emoji']} {r['title']}")
-    lines.append(f"🎉 Event: {e_title}")
-    lines.append("")
-    lines.append(f"📦 Total Obtained (all chats): {total_copies}")
-    lines.append(f"👥 Unique Owners: {total_unique_users}")
-    lines.append("")
-    lines.append("🏆 Top Owners (Top 10):")
-
-    if not top_users:
-        lines.append("— None")
-    else:
-        for i, (uid, cnt) in enumerate(top_users, start=1):
-            try:
-                u = bot.get_chat(uid)
-                name = (u.first_name or "User").strip()
-                if u.username:
-                    name = f"@{u.username}"
-            except Exception:
-                name = str(uid)
-            lines.append(f"{i}. {name} — x{cnt}")
-
-    text = "\n".join(lines)
-
-    try:
-        bot.send_photo(message.chat.id, c["image_file_id"], caption=text)
-    except Exception:
-        bot.reply_to(message, text)
-
-# =========================
-# Message counter -> spawn every N messages
-# =========================
-@bot.message_handler(func=lambda m: True, content_types=["text", "photo", "sticker", "video", "animation", "document"])
-def every_message_counter(message):
-    if message.chat.type not in ("group", "supergroup"):
-        return
-
-    if message.content_type == "text" and message.text and message.text.startswith("/"):
-        return
-
-    counter, every, enabled = increment_counter(message.chat.id)
-    if not enabled or every <= 0:
-        return
-
-    if counter % every == 0:
+            raw = telebot.apihelper.get_updates(TOKEN, offset=bot.last_update_id + 1, limit=100, timeout=30,
+                                                allowed_updates=ALLOWED_UPDATES, long_polling_timeout=30)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            print("getUpdates failed:", e)
+            time.sleep(3)
+            continue
+        if raw:
+            bot.last_update_id = raw[-1]["update_id"]
+            process_raw_updates(raw)
+        if bot.worker_pool.exception_event.is_set():
+            print("handler error:", bot.worker_pool.exception_info)
+            bot.worker_pool.clear_exceptions()
+
+# =========================
+# Sharded workers (WORKER_SHARDS=N, Postgres only)
+# one router process long-polls Telegram and forwards every update to the worker that
+# owns its chat (abs(chat_id) % N); each worker keeps registry/timers/sweeper for its own
+# chats only. Spawns and claims also take pg_advisory_xact_lock per chat in storage.
+# =========================
+WORKER_SHARDS = int(os.environ.get("WORKER_SHARDS", "1"))
+SHARD_QUEUE_SIZE = 1000
+
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+
+def shard_of(key: int, count: int) -> int:
+    return abs(key) % count
+
+def my_shard():
+    return (SHARD_INDEX, SHARD_COUNT) if SHARD_COUNT > 1 else None
+
+def update_shard_key(u: dict) -> int:
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member"):
+        if kind in u:
+            return u[kind]["chat"]["id"]
+    if "callback_query" in u:
+        cq = u["callback_query"]
+        return cq["message"]["chat"]["id"] if cq.get("message") else cq["from"]["id"]
+    for kind in ("inline_query", "chosen_inline_result"):
+        if kind in u:
+            return u[kind]["from"]["id"]
+    return 0
+
+def start_background():
+    storage.warm_up("startup")
+    threading.Thread(target=db_keepalive_loop, name="db-keepalive", daemon=True).start()
+    load_spawn_registry()
+    load_spawn_timers()
+    threading.Thread(target=spawn_admission_loop, name="spawn-admission", daemon=True).start()
+    threading.Thread(target=spawn_timer_loop, name="spawn-timer", daemon=True).start()
+    if SPAWN_TTL_SECONDS > 0:
+        threading.Thread(target=spawn_sweeper_loop, name="spawn-sweeper", daemon=True).start()
+    if SHARD_INDEX == 0:
+        threading.Thread(target=cleanup_loop, name="cleanup", daemon=True).start()
+
+def shard_worker(index: int, count: int, queue):
+    global SHARD_INDEX, SHARD_COUNT, SPAWN_BUDGET_PER_SEC, SPAWN_BUDGET_BURST
+    SHARD_INDEX, SHARD_COUNT = index, count
+    # the spawn bucket is per process: split the budget so the shards add up to it
+    SPAWN_BUDGET_PER_SEC /= count
+    SPAWN_BUDGET_BURST = max(1, SPAWN_BUDGET_BURST // count)
+    _spawn_bucket.update(tokens=float(SPAWN_BUDGET_BURST), at=time.time())
+    # threads don't survive fork: give this process its own handler pool
+    bot.worker_pool = telebot.util.ThreadPool(bot, num_threads=bot.worker_pool.num_threads)
+    start_background()
+    print(f"Shard worker {index}/{count} ready")
+    while True:
+        batch = queue.get()
+        updates = [u for u in batch if "update_id" in u]
+        for u in batch:
+            if "spawn_chat" in u:
+                request_spawn(u["spawn_chat"])
+        if updates:
+            process_raw_updates(updates)
+
+def run_sharded(count: int):
+    if storage.backend_name() != "postgres":
+        raise SystemExit("WORKER_SHARDS > 1 needs a Postgres DATABASE_URL")
+    ctx = multiprocessing.get_context("fork")
+    queues = [ctx.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(count)]
+    procs = [ctx.Process(target=shard_worker, args=(i, count, queues[i]), name=f"shard-{i}", daemon=True)
+             for i in range(count)]
+    for p in procs:
+        p.start()
+    bot.remove_webhook()
+
+    def route_updates(raw):
+        batches = [[] for _ in range(count)]
+        for u in raw:
+            batches[shard_of(update_shard_key(u), count)].append(u)
+        for queue, batch in zip(queues, batches):
+            if batch:
+                queue.put(batch)
+
+    def route_spawn(chat_id):
+        queues[shard_of(chat_id, count)].put([{"spawn_chat": chat_id}])
+
+    offset = catch_up_backlog(route_updates, route_spawn)
+    threading.Thread(target=save_offset_loop, args=(lambda: offset,), name="offset-saver", daemon=True).start()
+    print(f"Bot is running... ({count} shard workers)")
+    while True:
+        dead = [p.name for p in procs if not p.is_alive()]
+        if dead:
+            raise SystemExit(f"shard worker died: {', '.join(dead)}")
         try:
-            spawn_character_in_chat(message.chat.id)
+            raw = telebot.apihelper.get_updates(TOKEN, offset=offset, limit=100, timeout=30,
+                                                allowed_updates=ALLOWED_UPDATES, long_polling_timeout=30)
         except Exception as e:
-            print("spawn error:", e)
-
-print("Bot is running...")
-bot.infinity_polling(timeout=30, long_polling_timeout=30)
+            print("getUpdates failed:", e)
+            time.sleep(3)
+            continue
+        if raw:
+            offset = raw[-1]["update_id"] + 1
+            route_updates(raw)
+
+if __name__ == "__main__":
+    if WORKER_SHARDS > 1:
+        run_sharded(WORKER_SHARDS)
+    else:
+        start_background()
+        bot.remove_webhook()
+        offset = catch_up_backlog(process_raw_updates, request_spawn)
+        if offset:
+            bot.last_update_id = offset - 1  # polling continues from here
+        threading.Thread(target=save_offset_loop, args=(lambda: bot.last_update_id + 1 if bot.last_update_id else None,),
+                         name="offset-saver", daemon=True).start()
+        print("Bot is running...")
+        poll_updates()